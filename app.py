@@ -1,155 +1,461 @@
 
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, Response, g, request, jsonify, render_template, redirect, url_for
 import database as dbm
 import broker_actions as bk
-import sqlite3
 import esp_configuration as espwifi 
+import ingest
+import command_dispatcher as cmd
+from command_tracker import CommandTracker
+from device_registry import DeviceRegistry
+from device_events import EventHub
+import heartbeat
+import history
+import metrics
+import inventory
+import profiling
+import scheduler
+import serialization
+from leader_election import LeaderLease
+import log_config
+import base64
+import functools
+import gzip
+import itertools
+import json
+import logging
+import os
+import queue
 import time
 
 
+log_config.setup_logging()
+logger = logging.getLogger(__name__)
+
 app = Flask(__name__)
+STARTED_AT = time.time()
+
+# /readyz falla también si no hay conexión con el broker (por defecto solo la
+# BD: sin broker se puede seguir consultando la lista de dispositivos)
+READYZ_REQUIRE_BROKER = os.getenv('READYZ_REQUIRE_BROKER', '0') == '1'
+
+# Perfilado opcional de requests y mensajes MQTT (PROFILING=1, ver /debug/profiles)
+profiler = profiling.Profiler().start()
 
 # Inicializa la base de datos
 DB_NAME = dbm.init_db()
 
-#Variable global para permitir agregar dispositivos manualmente
-ADD_DEVICE_SESSION_COUNT = 0
-# Conecta al broker MQTT y arranca el loop
-client = bk.connect_mqtt()
-client.loop_start()
-
+# "single": un solo proceso. "multi": varios workers (p. ej. gunicorn -w 4
+# -k gthread --threads 8: /devices/stream necesita workers con hilos o gevent);
+# el estado compartido vive en la BD y un solo worker, elegido con un lease,
+# se suscribe al broker. Todos pueden publicar.
+DEPLOY_MODE = os.getenv('DEPLOY_MODE', 'single')
+MULTI_WORKER = DEPLOY_MODE == 'multi'
+
+# "embedded": este proceso se suscribe y escribe los anuncios en la BD.
+# "external": el ingest corre en ingest_service.py y aquí solo se publica.
+INGEST_MODE = os.getenv('INGEST_MODE', 'embedded')
+EMBEDDED_INGEST = INGEST_MODE != 'external'
+
+# Intervalo (s) con que se detectan cambios escritos por otros procesos
+DB_WATCH_INTERVAL = float(os.getenv('DB_WATCH_INTERVAL', 1))
+# Con varios workers, ?since= reenvía los cambios de esta ventana (ms)
+DELTA_SLACK_MS = int(2000 + 2000 * DB_WATCH_INTERVAL) if MULTI_WORKER or not EMBEDDED_INGEST else 0
+
+# Copia en memoria de la tabla devices (se carga una sola vez al iniciar);
+# sus cambios se publican en device_events para /devices/stream
+device_events = EventHub()
+registry = DeviceRegistry(events=device_events)
+registry.load()
+
+# Trabajos de configuración de ESP nuevos (POST /configure)
+provisioner = espwifi.Provisioner().start()
+
+# Conecta al broker MQTT en segundo plano (el hilo del loop hace la primera
+# conexión y las reconexiones), así la app arranca aunque el broker no esté
+# disponible. En modo multi la suscripción se activa solo en el worker que
+# tome el lease.
+client = bk.connect_mqtt(subscribe=EMBEDDED_INGEST and not MULTI_WORKER, lazy=True)
+bk.start_network_loop(client)
+
+# Confirmaciones "ack_" de los comandos, reintentos y reconciliación del
+# estado deseado. Corre solo en el proceso suscrito al broker (este con el
+# lease, o ingest_service.py con INGEST_MODE=external), que recibe de vuelta
+# los comandos de todos los workers; en modo multi deja una copia de su
+# estado en app_state para el resto
+command_tracker = CommandTracker(client, registry.desired_power_states, share=MULTI_WORKER)
+
+def on_power_commands_sent(device_ids, action):
+    """Refleja en la BD y el registro el device_status de los comandos ya publicados."""
+    if action in ('on', 'off'):
+        device_status = 1 if action == 'on' else 0
+        dbm.update_devices_power_status(device_ids, device_status)
+        for device_id in device_ids:
+            registry.upsert(device_id, device_status=device_status)
+
+# Agrupa las ráfagas de on/off a un mismo dispositivo (COMMAND_DEBOUNCE_MS)
+command_dispatcher = cmd.CommandDispatcher(client, on_sent=on_power_commands_sent).start()
 
-# Variable global para las credenciales WiFi del servidor
-wifi_credentials = {}
 
+# --------------------------------------------------------------
+# Estado compartido entre workers (antes variables globales del módulo)
+
+WIFI_CREDENTIALS_KEY = 'wifi_credentials'
+_wifi_cache = {'value': {}, 'checked_at': 0.0}
+
+if not MULTI_WORKER:
+    # Con un solo proceso la contraseña queda solo en memoria, como antes de
+    # compartir el estado; se borra la copia que haya guardado un modo multi
+    dbm.delete_state(WIFI_CREDENTIALS_KEY)
+
+def get_wifi_credentials():
+    """
+    Credenciales WiFi del servidor. En modo multi se leen de app_state (las
+    define cualquier worker) y se cachean unos segundos para no leer la BD
+    en cada request; con un solo proceso viven solo en memoria.
+    """
+    if not MULTI_WORKER:
+        return _wifi_cache['value']
+    now = time.monotonic()
+    if _wifi_cache['value'] and now - _wifi_cache['checked_at'] < 5:
+        return _wifi_cache['value']
+    value = dbm.get_state(WIFI_CREDENTIALS_KEY)
+    _wifi_cache['value'] = json.loads(value) if value else {}
+    _wifi_cache['checked_at'] = now
+    return _wifi_cache['value']
+
+def set_wifi_credentials(credentials):
+    if MULTI_WORKER:
+        # La contraseña queda en texto plano en devices.db: solo el usuario
+        # del servidor puede leer el archivo
+        dbm.restrict_permissions()
+        dbm.set_state(WIFI_CREDENTIALS_KEY, json.dumps(credentials))
+    _wifi_cache['value'] = credentials
+    _wifi_cache['checked_at'] = time.monotonic()
+
+# Historial de transiciones y rollups de uptime (base separada de devices.db)
+history_store = history.HistoryStore()
+history_store.init()
+history_recorder = history.HistoryRecorder(history_store)
+
+def mark_expired_devices(device_ids, cutoff):
+    """Callback del monitor de heartbeats: pasa a offline los dispositivos vencidos."""
+    # El UPDATE deja online a los que se anunciaron después de cutoff
+    went_offline = dbm.mark_devices_offline(device_ids, cutoff)
+    for device_id in went_offline:
+        if registry.get(device_id) is not None:
+            registry.upsert(device_id, status='offline')
+    history_recorder.record_offline(went_offline, cutoff)
+    command_tracker.forget_reported(went_offline)
+    logger.info("[HEARTBEAT] %d dispositivos marcados como offline (timeout)", len(went_offline))
+
+# Vencimientos de heartbeat por dispositivo, con timeouts configurables por grupo
+heartbeat_monitor = heartbeat.HeartbeatMonitor(
+    group_timeouts=heartbeat.parse_group_timeouts(heartbeat.HEARTBEAT_GROUP_TIMEOUTS),
+    on_expired=mark_expired_devices)
+
+def on_ingest_flush(announcements, result):
+    registry.apply_announcements(announcements, result)
+    history_recorder.record_announcements(announcements, result)
+    written = set(result['updated']) | set(result['inserted'])
+    for a in announcements:
+        if a.device_id in written:
+            heartbeat_monitor.touch(a.device_id, a.group, a.received_at)
+
+# Escritor en segundo plano para los anuncios "dc_" recibidos por MQTT
+ingest_queue = ingest.IngestQueue(allow_new=ingest.add_device_window_open,
+                                  on_flush=on_ingest_flush)
+
+# Handlers de los mensajes MQTT por prefijo ("dc_", "ack_", ...)
+message_router = ingest.build_router(ingest_queue, on_ack=command_tracker.record_ack,
+                                     on_command=command_tracker.record_command)
+
+@profiler.wrap('mqtt')
 def mqtt_on_message(client, userdata, msg):
         """
         Callback que se ejecuta al recibir un mensaje MQTT.
         Se esperan mensajes con este formato:
           "dc_{device_id}_1_{ip}_{group}_{name}"
+          "ack_{device_id}_{on|off|reset}" (confirmación de un comando)
 
-        Se extraen device_id, IP, grupo y nombre, y se registra o actualiza el dispositivo en la BD.
-        El tópico que se almacena se construye como "streelet/{group}".
+        message_router entrega cada mensaje a su handler: los anuncios se
+        encolan y el hilo de ingest_queue los registra o actualiza en la BD por
+        lotes. El tópico que se almacena se construye como "streelet/{group}".
         """
         try:
-            # Decodificar y limpiar el mensaje recibido
-            message = msg.payload.decode('utf-8').strip()
-            print(f"Mensaje recibido en {msg.topic}: {message}") # Mantener print para ver en consola
-
-            device_id, ip, group, name = None, None, None, None
-
-            if message.startswith("dc_"):
-                parts = message.split("_")
-                # Se esperan 6 partes: "dc", device_id, "1", ip, group, name
-                if len(parts) == 6:
-                    device_id = parts[1].strip()
-                    ip = parts[3].strip()
-                    group = parts[4].strip()
-                    name = parts[5].strip()
-
-                else:
-
-                    print(f"Formato incorrecto en mensaje 'dc_'. Se esperaban 6 partes: dc, device_id, 1, ip, group, name. Se recibieron {len(parts)} partes: {parts}")
-                    return
-
-            else:
-
-                print(f"Formato de mensaje no reconocido: {message}")
-                return
-
-            if device_id and ip and group and name:
-
-                print(f"Extraído -> device_id: {device_id}, IP: {ip}, Grupo: {group}, Nombre: {name}")
-            else:
-
-                print("Error: No se pudieron extraer todos los campos necesarios (ID, IP, Grupo, Nombre).")
-                return
-
-
-            final_topic = f"streelet/{group}"
-
-            # Registrar o actualizar el dispositivo en la BD
-            with sqlite3.connect(DB_NAME) as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT id, topic, name FROM devices WHERE id = ?", (device_id,))
-                device = cursor.fetchone()
-                now = int(time.time())
-
-                if device:
-                    cursor.execute("UPDATE devices SET ip = ?, status = ?, last_seen = ?, name = ? WHERE id = ?",
-                                   (ip, 'online', now, name, device_id))
-                    conn.commit()
-                    print(f"Dispositivo {device_id} actualizado: IP={ip}, online, last_seen={now}, Nombre={name}")
-                    existing_topic = device[1]
-                    if existing_topic != final_topic:
-                        cursor.execute("UPDATE devices SET topic = ? WHERE id = ?", (final_topic, device_id))
-                        conn.commit()
-                        print(f"Tópico actualizado de {existing_topic} a {final_topic}")
-                    existing_name = device[2]
-                    if existing_name != name:
-                        cursor.execute("UPDATE devices SET name = ? WHERE id = ?", (name, device_id))
-                        conn.commit()
-                        print(f"Nombre actualizado de {existing_name} a {name}")
-                else:
-                    global ADD_DEVICE_SESSION_COUNT
-                    if ADD_DEVICE_SESSION_COUNT > 0:
-                        # Registrar un nuevo dispositivo
-                        cursor.execute(
-                            """INSERT INTO devices (id, name, topic, ip, status, device_status, last_seen)
-                               VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                            (device_id, name, final_topic, ip, 'online', 0, now)
-                        )
-                        conn.commit()
-
-                        print(f"Nuevo dispositivo registrado: ID={device_id}, Name={name}, Topic={final_topic}, IP={ip}")
-                        print(ADD_DEVICE_SESSION_COUNT)
-                    else:
-                       print("Nuevo dispositivo no agregado (ADD_DEVICE_SESSION_COUNT <= 0).")
-                       print(ADD_DEVICE_SESSION_COUNT)
+            message_router.dispatch(msg.topic, msg.payload)
 
         except Exception as e:
 
-            print(f"Error en mqtt_on_message: {e}")
+            logger.exception("Error en mqtt_on_message: %s", e)
+
+def start_embedded_ingest():
+    """Arranca el ingest en este proceso y se suscribe al broker."""
+    for device in registry.all():
+        if device['status'] == 'online':
+            heartbeat_monitor.touch(device['id'], heartbeat.group_from_topic(device['topic']), device['last_seen'] or 0)
+    history_recorder.start()
+    heartbeat_monitor.start()
+    command_tracker.start()
+    ingest_queue.start()
+    message_router.start()
+    # Asignar el callback MQTT y suscribirse a MQTT_SUBSCRIPTION ("streelet/#")
+    client.on_message = mqtt_on_message
+    bk.set_subscription(client, True)
+
+def stop_embedded_ingest():
+    """Deja de suscribirse y vacía el ingest (otro worker tomó el lease)."""
+    bk.set_subscription(client, False)
+    message_router.stop()
+    ingest_queue.stop()
+    heartbeat_monitor.stop()
+    command_tracker.stop()
+    history_recorder.stop()
+
+if MULTI_WORKER or not EMBEDDED_INGEST:
+    # Otros procesos escriben en la BD; el registro se sincroniza cuando
+    # cambia la versión de la tabla devices por un commit de otro proceso
+    db_watcher = dbm.ChangeWatcher(registry.refresh, interval=DB_WATCH_INTERVAL,
+                                   key=dbm.DEVICES_VERSION_KEY).start()
+
+if EMBEDDED_INGEST and MULTI_WORKER:
+    # Un único suscriptor entre todos los workers
+    subscriber_lease = LeaderLease('mqtt-subscriber', start_embedded_ingest, stop_embedded_ingest).start()
+elif EMBEDDED_INGEST:
+    start_embedded_ingest()
+
+
+
+# --------------------------------------------------------------
+# Métricas para /metrics
+
+HTTP_LATENCY = metrics.histogram('iot_http_request_seconds', 'Latencia de las requests HTTP por endpoint',
+                                 ['endpoint', 'method', 'status'])
+metrics.gauge('iot_devices', 'Dispositivos por estado de conexión', ['status']).set_function(
+    lambda: {'online': 0, 'offline': 0, **registry.status_counts()})
+metrics.gauge('iot_ingest_queue_depth', 'Anuncios pendientes de escribir').set_function(
+    lambda: ingest_queue.stats()['queue_depth'])
+metrics.gauge('iot_mqtt_connected', '1 si hay conexión con el broker').set_function(
+    lambda: int(bk.get_stats()['connected']))
+metrics.gauge('iot_provisioning_queue_depth', 'Configuraciones de ESP en espera').set_function(
+    lambda: provisioner.stats()['queue_depth'])
+metrics.gauge('iot_mqtt_buffered_commands', 'Comandos guardados a la espera del broker').set_function(
+    lambda: len(bk.command_buffer))
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.profile = profiler.begin('http', f"{request.method} {request.endpoint or 'unmatched'}")
+
+@app.after_request
+def record_request_latency(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_LATENCY.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                             request.method, response.status_code)
+    active = g.pop('profile', None)
+    if active is not None:
+        if response.is_streamed:
+            # El cuerpo se genera después de esta función: se mide hasta que se termina de enviar
+            response.call_on_close(lambda: profiler.end(active, response.status_code))
+        else:
+            profiler.end(active, response.status_code)
+    return response
 
-        
-# Asignar el callback MQTT y suscribirse a "streelet/"
-client.on_message = mqtt_on_message
+@app.teardown_request
+def end_failed_request_profile(exc):
+    # after_request no corre si la vista lanzó una excepción no manejada
+    profiler.end(g.pop('profile', None), 500)
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
+# --------------------------------------------------------------
+# Liveness / readiness para el orquestador o el balanceador
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    """El proceso responde; no consulta la BD ni el broker."""
+    return jsonify({'status': 'ok', 'uptime_s': round(time.time() - STARTED_AT, 1)})
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """
+    Listo para recibir tráfico: la BD responde y, con READYZ_REQUIRE_BROKER=1,
+    hay conexión con el broker. Retorna 503 si no está listo.
+    """
+    started = time.perf_counter()
+    try:
+        dbm.ping()
+        db = {'ok': True, 'latency_ms': round((time.perf_counter() - started) * 1000.0, 2)}
+    except Exception as e:
+        db = {'ok': False, 'error': str(e)}
+    stats = bk.get_stats()
+    broker = {'connected': stats['connected'], 'buffered': stats['buffered'],
+              'disconnected_seconds_total': round(stats['disconnected_seconds_total'], 1)}
+    ready = db['ok'] and (broker['connected'] or not READYZ_REQUIRE_BROKER)
+    return jsonify({'ready': ready, 'db': db, 'broker': broker}), 200 if ready else 503
 
 # --------------------------------------------------------------
 # Antes de cada request, se asegura que las credenciales WiFi estén definidas
 @app.before_request
 def ensure_wifi_credentials():
-    global wifi_credentials
-    if request.endpoint not in ['wifi_setup', 'static'] and not wifi_credentials:
+    if request.endpoint not in ['wifi_setup', 'static', 'metrics_endpoint', 'healthz', 'readyz'] and not get_wifi_credentials():
         return redirect(url_for('wifi_setup'))
 
 # --------------------------------------------------------------
 # Endpoints para obtener o agregar dispositivos manualmente
 
+DEVICE_QUERY_PARAMS = ('status', 'group', 'q', 'limit', 'cursor')
+DEVICES_DEFAULT_PAGE = 100
+DEVICES_MAX_PAGE = 1000
+
+def encode_cursor(device_id):
+    return base64.urlsafe_b64encode(device_id.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor.replace('-', '+').replace('_', '/') + '=' * (-len(cursor) % 4)
+        return base64.b64decode(padded, validate=True).decode('utf-8')
+    except ValueError:
+        raise ValueError('Cursor inválido')
+
+def parse_device_query():
+    """Filtros y página de GET /devices. Lanza ValueError si algún parámetro es inválido."""
+    status = request.args.get('status') or None
+    if status is not None and status not in ('online', 'offline'):
+        raise ValueError('status debe ser online u offline')
+    limit = request.args.get('limit', DEVICES_DEFAULT_PAGE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError('limit debe ser un entero')
+    if not 1 <= limit <= DEVICES_MAX_PAGE:
+        raise ValueError(f'limit debe estar entre 1 y {DEVICES_MAX_PAGE}')
+    cursor = request.args.get('cursor')
+    return {'status': status, 'group': request.args.get('group') or None, 'text': request.args.get('q') or None,
+            'limit': limit, 'after': decode_cursor(cursor) if cursor else None}
+
 @app.route('/devices', methods=['GET'])
 def get_devices_endpoint():
-    devices = []
+    """
+    Lista de dispositivos. Soporta GET condicional (ETag / If-None-Match) y
+    sincronización incremental con ?since=<version>, que retorna solo los
+    dispositivos cambiados y los ids eliminados desde esa versión.
+
+    Con ?status=&group=&q=&limit=&cursor= retorna una página filtrada
+    {'version', 'devices', 'next_cursor'}; next_cursor es null en la última.
+
+    La lista completa se genera en streaming. ?shape=compact omite el
+    duplicado device_id y ?shape=columns retorna
+    {'version', 'count', 'ids': [...], '<campo>': [...]}; ?fields=id,status
+    limita los campos de ambas formas.
+    """
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return jsonify({'error': 'El parámetro since debe ser un entero'}), 400
+
+    shape = request.args.get('shape', serialization.ROWS)
+    if shape not in serialization.SHAPES:
+        return jsonify({'error': f"shape debe ser uno de: {', '.join(serialization.SHAPES)}"}), 400
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id, name, topic, ip, status, device_status, last_seen FROM devices")
-            rows = cursor.fetchall()
-            for row in rows:
-                devices.append({
-                    'id': row[0],
-                    'device_id': row[0],
-                    'name': row[1],
-                    'topic': row[2],
-                    'ip': row[3],
-                    'status': row[4],
-                    'device_status': row[5],
-                    'last_seen': row[6]
-                })
-    except Exception as e:
-        print(f"Error: {e}")  
-    return jsonify(devices)
+        fields = serialization.parse_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if shape == serialization.ROWS and 'id' not in fields:
+        return jsonify({'error': 'La forma rows requiere el campo id'}), 400
+
+    paginated = any(param in request.args for param in DEVICE_QUERY_PARAMS)
+    if paginated:
+        if since is not None:
+            return jsonify({'error': 'since no se puede combinar con filtros ni paginación'}), 400
+        try:
+            query = parse_device_query()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+    version = registry.version
+    etag = str(version)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    elif paginated:
+        devices, last_id = registry.query(**query)
+        if shape == serialization.ROWS:
+            for device in devices:
+                device['device_id'] = device['id']
+        response = serialization.json_response({'version': version, 'devices': devices,
+                                                'next_cursor': encode_cursor(last_id) if last_id is not None else None},
+                                               request.accept_encodings)
+    elif since is not None:
+        version, full, devices, deleted = registry.changes_since(since, slack_ms=DELTA_SLACK_MS)
+        etag = str(version)
+        response = serialization.json_response({'version': version, 'full': full, 'devices': devices,
+                                                'deleted': deleted}, request.accept_encodings)
+    else:
+        version, columns = registry.columns(fields)
+        etag = str(version)
+        count = len(columns[fields[0]])
+        if shape == serialization.COLUMNS:
+            chunks = serialization.iter_columns(columns, fields, {'version': version, 'count': count})
+        else:
+            chunks = serialization.iter_rows(columns, fields, with_device_id=shape == serialization.ROWS)
+        response = serialization.stream_response(chunks, request.accept_encodings,
+                                                 count * serialization.ESTIMATED_DEVICE_BYTES)
+
+    response.set_etag(etag)
+    response.headers['X-Devices-Version'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/devices/summary', methods=['GET'])
+def devices_summary_endpoint():
+    """Cantidad de dispositivos por estado y por grupo (sin listar los dispositivos)."""
+    summary = registry.summary()
+    summary['version'] = registry.version
+    return jsonify(summary)
+
+def sse_blocks_worker(environ):
+    """
+    True con los workers sync de gunicorn: atienden una request a la vez y un
+    stream abierto ocupa el worker para siempre, así unos pocos dashboards
+    bloquean toda la API. Los workers gthread, gevent y eventlet marcan
+    wsgi.multithread.
+    """
+    return environ.get('SERVER_SOFTWARE', '').startswith('gunicorn') and not environ.get('wsgi.multithread')
+
+@app.route('/devices/stream', methods=['GET'])
+def devices_stream_endpoint():
+    """
+    Server-Sent Events: envía primero la lista completa ("snapshot") y luego
+    solo los cambios ("upsert", "delete"). Un "resync" indica que el cliente
+    debe reconectarse para recibir un snapshot nuevo.
+    """
+    if sse_blocks_worker(request.environ):
+        return jsonify({'error': 'El stream requiere workers con hilos o asíncronos '
+                                 '(gunicorn -k gthread --threads N o -k gevent); use GET /devices.'}), 503
+    # Suscribirse antes de tomar el snapshot para no perder cambios intermedios
+    subscription = device_events.subscribe()
+    snapshot = registry.all()
+
+    def generate():
+        try:
+            yield f"event: snapshot\ndata: {json.dumps(snapshot)}\n\n"
+            while True:
+                try:
+                    event = subscription.get(timeout=15)
+                except queue.Empty:
+                    # Comentario SSE para mantener viva la conexión
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+        finally:
+            device_events.unsubscribe(subscription)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/devices', methods=['POST'])
 def add_device_endpoint():
@@ -163,6 +469,7 @@ def add_device_endpoint():
             return jsonify({'error': 'Faltan device_id o topic'}), 400
         result = dbm.add_device(device_id, name, topic, ip)
         if result == 1:
+            registry.upsert(device_id, name=name, topic=topic, ip=ip, status='offline', device_status=0)
             return jsonify({'message': 'Dispositivo agregado correctamente'}), 201
         elif result == -1:
             return jsonify({'error': f'El dispositivo con device_id "{device_id}" ya existe'}), 409
@@ -172,40 +479,86 @@ def add_device_endpoint():
         return jsonify({'error': str(e)}), 500
     
     
-    # ... (tus imports y configuraciones) ...
+@app.route('/devices/import', methods=['POST'])
+def import_devices_endpoint():
+    """
+    Importación masiva del inventario en NDJSON o CSV (según Content-Type o
+    ?format=ndjson|csv; el cuerpo puede venir con Content-Encoding: gzip).
+    ?on_conflict=skip (por defecto) omite los ids existentes y
+    ?on_conflict=update les actualiza nombre, tópico e IP. Retorna el resumen
+    con los errores por línea; 400 si el archivo no se pudo leer completo.
+    """
+    try:
+        fmt = inventory.detect_format(request.mimetype, request.args.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    on_conflict = request.args.get('on_conflict', 'skip')
+    if on_conflict not in ('skip', 'update'):
+        return jsonify({'error': 'on_conflict debe ser skip o update'}), 400
+    stream = request.stream
+    if request.content_encoding == 'gzip':
+        stream = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif request.content_encoding:
+        return jsonify({'error': f'Content-Encoding no soportado: {request.content_encoding}'}), 415
+
+    def apply_imported(rows):
+        for device_id, name, topic, ip in rows:
+            registry.upsert(device_id, name=name, topic=topic, ip=ip)
+
+    summary = inventory.import_devices(stream, fmt, update=on_conflict == 'update', on_chunk=apply_imported)
+    return jsonify(summary), 400 if summary['aborted'] else 200
+
+@app.route('/devices/export', methods=['GET'])
+def export_devices_endpoint():
+    """Inventario completo en NDJSON (por defecto) o CSV con ?format=csv, generado en streaming."""
+    fmt = request.args.get('format', inventory.NDJSON)
+    if fmt not in inventory.CONTENT_TYPES:
+        return jsonify({'error': f"format debe ser uno de: {', '.join(inventory.CONTENT_TYPES)}"}), 400
+    response = serialization.stream_response(inventory.export_chunks(fmt), request.accept_encodings,
+                                             len(registry) * serialization.ESTIMATED_DEVICE_BYTES,
+                                             content_type=inventory.CONTENT_TYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=devices.{fmt}'
+    return response
+
 
 @app.route('/devices/<string:device_id>/delete', methods=['POST'])
 def delete_device_endpoint(device_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-
-            # Obtener el tópico del dispositivo antes de eliminarlo
-            cursor.execute("SELECT topic FROM devices WHERE id = ?", (device_id,))
-            result = cursor.fetchone()
-            if result:
-                topic_to_reset = result[0]
-                print(f"Dispositivo encontrado: {device_id}, tópico: {topic_to_reset}")
-                reset_message = "reset"  # Puedes definir otro mensaje si lo deseas
-                bk.publish_message(client, topic_to_reset, reset_message)
-                print(f"Mensaje de reset enviado al tópico: {topic_to_reset} para el dispositivo con ID: {device_id}")
-
-                # Eliminar el dispositivo de la base de datos
-                cursor.execute("DELETE FROM devices WHERE id = ?", (device_id,))
-                conn.commit()
-                global ADD_DEVICE_SESSION_COUNT
-                ADD_DEVICE_SESSION_COUNT = 0
-                return jsonify({'message': f'Dispositivo con ID "{device_id}" eliminado correctamente'}), 200
-            else:
-                return jsonify({'error': f'No se encontró el dispositivo con ID "{device_id}"'}), 404
+        # Obtener el tópico del dispositivo antes de eliminarlo
+        topic_to_reset = registry.topic_for(device_id)
+        if topic_to_reset is None:
+            return jsonify({'error': f'No se encontró el dispositivo con ID "{device_id}"'}), 404
+
+        logger.info("Dispositivo encontrado: %s, tópico: %s", device_id, topic_to_reset)
+        reset_message = "reset"  # Puedes definir otro mensaje si lo deseas
+        bk.publish_message(client, topic_to_reset, reset_message)
+        logger.info("Mensaje de reset enviado al tópico: %s para el dispositivo con ID: %s", topic_to_reset, device_id)
+
+        # Eliminar el dispositivo de la base de datos
+        result = dbm.delete_device(device_id)
+        if result == -3:
+            return jsonify({'error': f'Error al eliminar el dispositivo con ID "{device_id}"'}), 500
+        registry.remove(device_id)
+        heartbeat_monitor.forget(device_id)
+        dbm.set_state(ingest.ADD_DEVICE_SESSIONS_KEY, 0)
+        return jsonify({'message': f'Dispositivo con ID "{device_id}" eliminado correctamente'}), 200
     except Exception as e:
-        print(f"Error al eliminar el dispositivo {device_id}: {e}")
+        logger.error("Error al eliminar el dispositivo %s: %s", device_id, e)
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/devices/reload', methods=['POST'])
+def reload_devices_endpoint():
+    """Invalida la copia en memoria y la vuelve a cargar desde la BD."""
+    count = registry.invalidate()
+    return jsonify({'message': f'{count} dispositivos recargados desde la BD'}), 200
+
+
 @app.route('/configure', methods=['POST'])
 def configure_device():
-    data = request.get_json()
+    """Encola la configuración del ESP y retorna el id del trabajo (202)."""
+    data = request.get_json(silent=True) or {}
+    wifi_credentials = get_wifi_credentials()
     ssid = wifi_credentials.get('ssid')
     password = wifi_credentials.get('password')
     grupo = data.get('grupo')
@@ -213,10 +566,21 @@ def configure_device():
     if not ssid or not password or not grupo or not name:
         return jsonify({'message': 'Datos incompletos para configurar el ESP'}), 400
     try:
-        message = espwifi.configure_esp(ssid, password, grupo, name)  # Pass the name
-        return jsonify({'message': message})
+        job_id = provisioner.submit(ssid, password, grupo, name)
+    except espwifi.ProvisioningQueueFull as e:
+        return jsonify({'message': f'Demasiadas configuraciones en curso, intente más tarde ({e})'}), 503
     except Exception as e:
         return jsonify({'message': f'Error al configurar ESP: {e}'}), 500
+    return jsonify({'message': 'Configuración iniciada, espere por favor...', 'job_id': job_id,
+                    'state': espwifi.QUEUED, 'status_url': url_for('configure_job_status', job_id=job_id)}), 202
+
+@app.route('/configure/<job_id>', methods=['GET'])
+def configure_job_status(job_id):
+    job = dbm.get_provisioning_job(job_id)
+    if job is None:
+        return jsonify({'message': f'No existe el trabajo de configuración "{job_id}"'}), 404
+    job['done'] = job['state'] not in espwifi.ACTIVE_STATES
+    return jsonify(job), 200
     
     
 # --------------------------------------------------------------
@@ -224,13 +588,12 @@ def configure_device():
 
 @app.route('/wifi', methods=['GET', 'POST'])
 def wifi_setup():
-    global wifi_credentials
     if request.method == 'POST':
         ssid = request.form.get('ssid')
         password = request.form.get('password')
         if not ssid or not password:
             return "Error: Debes ingresar tanto el SSID como la contraseña", 400
-        wifi_credentials = {"ssid": ssid, "password": password}
+        set_wifi_credentials({"ssid": ssid, "password": password})
         return redirect(url_for('home'))
     else:
         return render_template('wifi_setup.html')
@@ -239,36 +602,402 @@ def wifi_setup():
 # Rutas de la interfaz web
 @app.route('/')
 def home():
+    wifi_credentials = get_wifi_credentials()
     return render_template('dashboard.html', wifi_ssid=wifi_credentials.get('ssid'), wifi_password=wifi_credentials.get('password'))
 
 @app.route('/add_device')
 def add_device_page():
-    global ADD_DEVICE_SESSION_COUNT
-    ADD_DEVICE_SESSION_COUNT += 1
-    print(ADD_DEVICE_SESSION_COUNT)
+    sessions = dbm.increment_state(ingest.ADD_DEVICE_SESSIONS_KEY)
+    logger.debug("Páginas de alta abiertas: %s", sessions)
     return render_template('add_device_page.html')
 
 
 
+# --------------------------------------------------------------
+# Contadores de la cola de ingest (profundidad y latencia de escritura)
+@app.route('/ingest/stats', methods=['GET'])
+def ingest_stats_endpoint():
+    return jsonify({**ingest_queue.stats(), 'heartbeat': heartbeat_monitor.stats(),
+                    'history': history_recorder.stats()})
+
+# Últimos registros de log guardados en memoria.
+# Filtros: ?level=WARNING&logger=ingest&since=<ts>&limit=200
+@app.route('/debug/logs', methods=['GET'])
+def debug_logs_endpoint():
+    try:
+        since = request.args.get('since', type=float)
+        limit = min(request.args.get('limit', 200, type=int), 2000)
+        records = log_config.ring_buffer.records(level=request.args.get('level'), logger=request.args.get('logger'),
+                                                 since=since, limit=limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'records': records, 'dropped': log_config.DroppingQueueHandler.dropped})
+
+# Requests y mensajes MQTT lentos (PROFILING=1): desglose SQLite / MQTT /
+# serialización, muestras de pila y, opcionalmente, cProfile.
+# Filtros: ?name=GET%20get_devices_endpoint&limit=20
+@app.route('/debug/profiles', methods=['GET', 'DELETE'])
+def debug_profiles_endpoint():
+    if request.method == 'DELETE':
+        profiler.clear()
+        return jsonify({'message': 'Perfiles eliminados'})
+    limit = min(request.args.get('limit', 20, type=int), profiling.PROFILE_STORE_SIZE)
+    return jsonify({'enabled': profiler.enabled, 'slow_ms': profiler.slow_ms, 'summary': profiler.summary(),
+                    'profiles': profiler.profiles(name=request.args.get('name'), limit=limit)})
+
+@app.route('/debug/profiles/<int:profile_id>', methods=['GET'])
+def debug_profile_endpoint(profile_id):
+    profile = profiler.get(profile_id)
+    if profile is None:
+        return jsonify({'error': f'No se encontró el perfil {profile_id}'}), 404
+    return jsonify(profile)
+
+# Estado de la conexión con el broker y del buffer de comandos salientes
+@app.route('/broker/stats', methods=['GET'])
+def broker_stats_endpoint():
+    return jsonify({**bk.get_stats(), 'commands': command_dispatcher.stats(), 'acks': command_tracker.stats(),
+                    'router': message_router.stats()})
+
+# Comandos publicados que todavía no tienen "ack_" (los más antiguos primero)
+@app.route('/commands/pending', methods=['GET'])
+def pending_commands_endpoint():
+    limit = min(request.args.get('limit', 100, type=int), 1000)
+    return jsonify({'pending': command_tracker.pending(limit)})
+
+# Estado de encendido deseado (device_status) y el último confirmado por el dispositivo
+@app.route('/devices/<string:device_id>/power', methods=['GET'])
+def device_power_state_endpoint(device_id):
+    device = registry.get(device_id)
+    if device is None:
+        return jsonify({'error': f'Device with id "{device_id}" not found.'}), 404
+    return jsonify({'device_id': device_id, 'desired': 'on' if device['device_status'] == 1 else 'off',
+                    **command_tracker.power_state(device_id)})
+
+
+# --------------------------------------------------------------
+# Idempotency-Key: un reintento con la misma clave recibe la respuesta
+# original en lugar de publicar el comando otra vez
+
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))
+_idempotency_claims = itertools.count(1)
+
+def idempotent(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 255:
+            return jsonify({'error': 'Idempotency-Key demasiado larga (máximo 255)'}), 400
+        scoped_key = f"{request.method} {request.path} {key}"
+        if next(_idempotency_claims) % 500 == 0:
+            dbm.delete_expired_idempotency_keys()
+        previous = dbm.claim_idempotency_key(scoped_key, IDEMPOTENCY_TTL)
+        if previous is not None:
+            status, body = previous
+            if status is None:
+                return jsonify({'error': 'Hay una request con esta Idempotency-Key en curso'}), 409
+            command_dispatcher.record_duplicate()
+            response = Response(body, status=status, mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        try:
+            response = app.make_response(view(*args, **kwargs))
+        except Exception:
+            dbm.release_idempotency_key(scoped_key)
+            raise
+        if response.status_code >= 500:
+            # Los errores del servidor se pueden reintentar
+            dbm.release_idempotency_key(scoped_key)
+        else:
+            dbm.complete_idempotency_key(scoped_key, response.status_code, response.get_data(as_text=True))
+        return response
+    return wrapper
+
 # --------------------------------------------------------------
 # Endpoint para controlar el encendido/apagado de dispositivos
+# Los comandos que llegan dentro de la ventana de agrupamiento responden 202:
+# se publicarán (solo el último) al cerrarse la ventana. También responden 202
+# (dispatch "buffered") los que quedan en el buffer porque el broker no está
+# disponible; device_status no cambia hasta que se publique uno aceptado.
 @app.route('/devices/<string:device_id>/power/<string:action>', methods=['POST'])
+@idempotent
 def control_device_power(device_id, action):
     try:
-        device = dbm.get_device_status_by_id(device_id)
-        if not device:
+        topic = registry.topic_for(device_id)
+        if topic is None:
             return jsonify({'error': f'Device with id "{device_id}" not found.'}), 404
 
-        topic = device[2]
+        dispatch = command_dispatcher.submit(device_id, topic, action)
+        if dispatch == cmd.SENT:
+            return jsonify({'message': f'Device "{device_id}" command "{action}" sent successfully.',
+                            'dispatch': dispatch}), 200
+        if dispatch == cmd.BUFFERED:
+            return jsonify({'message': f'Broker unavailable: device "{device_id}" command "{action}" '
+                                       'will be sent on reconnect.', 'dispatch': dispatch}), 202
+        return jsonify({'message': f'Device "{device_id}" command "{action}" queued.', 'dispatch': dispatch}), 202
+    
+    except Exception as e:
+        return jsonify({'error': f'Failed to send command to device "{device_id}". Error: {str(e)}'}), 500
 
-        message = f"{action}_{device_id}"
 
-        bk.publish_message(client, topic, message)
 
-        return jsonify({'message': f'Device "{device_id}" command "{action}" sent successfully.'}), 200
-    
+# --------------------------------------------------------------
+# Comandos de encendido/apagado para grupos y listas de dispositivos
+
+POWER_ACTIONS = ('on', 'off')
+
+def dispatch_power_command(targets, action):
+    """
+    Envía "{action}_{device_id}" a cada (device_id, topic) de targets en una
+    sola ráfaga ordenada por tópico y actualiza device_status de los enviados.
+    Retorna la lista de resultados por dispositivo.
+    """
+    targets = sorted(targets, key=lambda target: target[1])
+    published = command_dispatcher.send_many(targets, action)
+    return [{'device_id': device_id, 'topic': topic, 'sent': result['sent'], 'error': result['error']}
+            for (device_id, topic), result in zip(targets, published)]
+
+def power_results_response(results, **extra):
+    sent = sum(1 for r in results if r['sent'])
+    body = {**extra, 'sent': sent, 'failed': len(results) - sent, 'results': results}
+    return jsonify(body), 200 if sent == len(results) else 207
+
+@app.route('/groups/<string:group>/power/<string:action>', methods=['POST'])
+@idempotent
+def control_group_power(group, action):
+    if action not in POWER_ACTIONS:
+        return jsonify({'error': f'Acción inválida "{action}". Use on u off.'}), 400
+    topic = f"streelet/{group}"
+    device_ids = registry.devices_in_topic(topic)
+    if not device_ids:
+        return jsonify({'error': f'No hay dispositivos en el grupo "{group}".'}), 404
+    try:
+        results = dispatch_power_command([(device_id, topic) for device_id in device_ids], action)
     except Exception as e:
-        return jsonify({'error': f'Failed to send command to device "{device_id}". Error: {str(e)}'}), 500
+        return jsonify({'error': f'Failed to send command to group "{group}". Error: {str(e)}'}), 500
+    return power_results_response(results, group=group, action=action)
+
+@app.route('/devices/power', methods=['POST'])
+@idempotent
+def control_devices_power():
+    """
+    Comando masivo. Cuerpo: {"ids": ["959f5e", ...], "action": "on" | "off"}.
+    """
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    action = data.get('action')
+    if not isinstance(ids, list) or not ids:
+        return jsonify({'error': 'Se requiere una lista "ids" no vacía'}), 400
+    if action not in POWER_ACTIONS:
+        return jsonify({'error': f'Acción inválida "{action}". Use on u off.'}), 400
+
+    ids = list(dict.fromkeys(str(device_id) for device_id in ids))
+    topics = registry.topics_for(ids)
+    try:
+        results = dispatch_power_command(list(topics.items()), action)
+    except Exception as e:
+        return jsonify({'error': f'Failed to send bulk command. Error: {str(e)}'}), 500
+    results.extend({'device_id': device_id, 'topic': None, 'sent': False, 'error': 'not found'}
+                   for device_id in ids if device_id not in topics)
+    return power_results_response(results, action=action)
+
+
+# --------------------------------------------------------------
+# Trabajos programados (scheduler.py)
+
+def run_scheduled_jobs(jobs):
+    """
+    Callback del scheduler con los trabajos que vencieron juntos. Se resuelve
+    el estado final de cada dispositivo (si dos trabajos lo tocan gana el más
+    reciente) y se envía una ráfaga por acción, ordenada por tópico.
+    """
+    final = {}
+    for job in sorted(jobs, key=lambda job: job['next_run'] or 0):
+        if job['target_type'] == 'group':
+            topic = f"streelet/{job['target']}"
+            targets = [(device_id, topic) for device_id in registry.devices_in_topic(topic)]
+        else:
+            topic = registry.topic_for(job['target'])
+            targets = [(job['target'], topic)] if topic else []
+        if not targets:
+            logger.warning("[SCHEDULER] El trabajo %s (%s) no tiene dispositivos", job['id'], job['name'])
+        for device_id, topic in targets:
+            final[device_id] = (job['action'], topic)
+
+    by_action = {}
+    for device_id, (action, topic) in final.items():
+        by_action.setdefault(action, []).append((device_id, topic))
+    for action, targets in by_action.items():
+        results = dispatch_power_command(targets, action)
+        sent = sum(1 for r in results if r['sent'])
+        logger.info("[SCHEDULER] '%s' enviado a %d/%d dispositivos", action, sent, len(results))
+
+job_scheduler = scheduler.Scheduler(run_scheduled_jobs)
+
+def jobs_changed():
+    """Tras un alta, edición o baja: recarga local y aviso a los demás workers."""
+    dbm.increment_state(scheduler.JOBS_VERSION_KEY)
+    if job_scheduler.stats()['running']:
+        job_scheduler.reload()
+
+def job_response(job):
+    return {**job, 'next_run_iso': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(job['next_run']))
+            if job['next_run'] else None}
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs_endpoint():
+    return jsonify([job_response(job) for job in dbm.get_jobs()])
+
+@app.route('/jobs/summary', methods=['GET'])
+def jobs_summary_endpoint():
+    total, enabled, next_run = dbm.count_jobs()
+    stats = job_scheduler.stats()
+    return jsonify({'total': total, 'enabled': enabled, 'next_run': next_run,
+                    'scheduler': stats if stats['running'] else None})
+
+@app.route('/jobs', methods=['POST'])
+def create_job_endpoint():
+    try:
+        job = scheduler.parse_job(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    next_run = scheduler.compute_next_run(job['schedule'], time.time())
+    job_id = dbm.create_job(**{**job, 'enabled': job['enabled'] and next_run is not None}, next_run=next_run)
+    jobs_changed()
+    return jsonify(job_response(dbm.get_job(job_id))), 201
+
+@app.route('/jobs/<int:job_id>', methods=['GET'])
+def get_job_endpoint(job_id):
+    job = dbm.get_job(job_id)
+    if job is None:
+        return jsonify({'error': f'No existe el trabajo {job_id}'}), 404
+    return jsonify(job_response(job))
+
+@app.route('/jobs/<int:job_id>', methods=['PUT'])
+def update_job_endpoint(job_id):
+    """Acepta el trabajo completo o solo los campos a cambiar."""
+    current = dbm.get_job(job_id)
+    if current is None:
+        return jsonify({'error': f'No existe el trabajo {job_id}'}), 404
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'Se esperaba un objeto JSON'}), 400
+    try:
+        job = scheduler.parse_job({**current, **data})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    next_run = scheduler.compute_next_run(job['schedule'], time.time())
+    dbm.update_job(job_id, **{**job, 'enabled': job['enabled'] and next_run is not None}, next_run=next_run)
+    jobs_changed()
+    return jsonify(job_response(dbm.get_job(job_id)))
+
+@app.route('/jobs/<int:job_id>', methods=['DELETE'])
+def delete_job_endpoint(job_id):
+    if not dbm.delete_job(job_id):
+        return jsonify({'error': f'No existe el trabajo {job_id}'}), 404
+    jobs_changed()
+    return jsonify({'message': f'Trabajo {job_id} eliminado'})
+
+if MULTI_WORKER:
+    # Un solo worker ejecuta los trabajos; los demás solo los editan y el
+    # que los ejecuta recarga al ver cambiar JOBS_VERSION_KEY
+    scheduler_lease = LeaderLease('scheduler', job_scheduler.start, job_scheduler.stop).start()
+    jobs_watcher = dbm.ChangeWatcher(job_scheduler.refresh_if_changed, interval=DB_WATCH_INTERVAL,
+                                     key=scheduler.JOBS_VERSION_KEY).start()
+else:
+    job_scheduler.start()
+
+
+# --------------------------------------------------------------
+# Historial de disponibilidad (lee los rollups de history.db)
+
+# Máximo de buckets por respuesta de /devices/<id>/history
+HISTORY_MAX_BUCKETS = 2000
+
+def parse_history_range():
+    """
+    Lee ?from=&to= (epoch en segundos) y ?resolution=hour|day. Por defecto
+    las últimas 24 horas; la resolución por defecto es por hora hasta 2 días
+    y por día en rangos mayores. El rango se extiende a buckets completos (UTC).
+    Retorna (start, end, resolution) o lanza ValueError.
+    """
+    end = int(request.args.get('to', time.time()))
+    start = int(request.args.get('from', end - history.DAY))
+    if start >= end:
+        raise ValueError('from debe ser menor que to')
+    resolution = request.args.get('resolution') or ('hour' if end - start <= 2 * history.DAY else 'day')
+    if resolution not in history.RESOLUTIONS:
+        raise ValueError('resolution debe ser hour o day')
+    size = history.RESOLUTIONS[resolution]
+    start -= start % size
+    end += -end % size
+    return start, end, resolution
+
+@app.route('/devices/<string:device_id>/history', methods=['GET'])
+def device_history_endpoint(device_id):
+    """Uptime del dispositivo por hora o por día, leído de los rollups."""
+    try:
+        start, end, resolution = parse_history_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    size = history.RESOLUTIONS[resolution]
+    if (end - start) // size > HISTORY_MAX_BUCKETS:
+        return jsonify({'error': f'El rango supera {HISTORY_MAX_BUCKETS} buckets; use resolution=day'}), 400
+    device_key = history_store.device_key(device_id)
+    if device_key is None:
+        return jsonify({'error': f'No hay historial para el dispositivo "{device_id}"'}), 404
+
+    stored = history_store.uptime(device_key, start, end, size)
+    buckets = []
+    for bucket in range(start, end, size):
+        online_seconds, outages = stored.get(bucket, (0, 0))
+        buckets.append({'start': bucket, 'online_seconds': online_seconds,
+                        'uptime': round(online_seconds / size, 4), 'outages': outages})
+    online_total = sum(b['online_seconds'] for b in buckets)
+    return jsonify({'device_id': device_id, 'from': start, 'to': end, 'resolution': resolution,
+                    'online_seconds': online_total, 'uptime': round(online_total / (end - start), 4),
+                    'outages': sum(b['outages'] for b in buckets), 'buckets': buckets})
+
+@app.route('/devices/<string:device_id>/history/events', methods=['GET'])
+def device_history_events_endpoint(device_id):
+    """Transiciones online/offline y cambios de IP crudos (retención HISTORY_RAW_DAYS)."""
+    try:
+        end = int(request.args.get('to', time.time()))
+        start = int(request.args.get('from', end - history.DAY))
+        limit = min(int(request.args.get('limit', 1000)), 10000)
+    except ValueError:
+        return jsonify({'error': 'from, to y limit deben ser enteros'}), 400
+    device_key = history_store.device_key(device_id)
+    if device_key is None:
+        return jsonify({'error': f'No hay historial para el dispositivo "{device_id}"'}), 404
+    return jsonify({'device_id': device_id, 'from': start, 'to': end,
+                    'events': history_store.events(device_key, start, end, limit)})
+
+@app.route('/history/availability', methods=['GET'])
+def availability_report_endpoint():
+    """
+    Reporte de disponibilidad de todos los dispositivos (o de ?group=) en el
+    rango, ordenado de menor a mayor uptime.
+    """
+    try:
+        start, end, resolution = parse_history_range()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    totals = history_store.availability(start, end, history.RESOLUTIONS[resolution])
+
+    group = request.args.get('group')
+    device_ids = registry.devices_in_topic(f"streelet/{group}") if group else [d['id'] for d in registry.all()]
+    span = end - start
+    devices = []
+    for device_id in device_ids:
+        online_seconds, outages = totals.get(device_id, (0, 0))
+        devices.append({'device_id': device_id, 'online_seconds': online_seconds,
+                        'uptime': round(online_seconds / span, 4), 'outages': outages})
+    devices.sort(key=lambda d: d['uptime'])
+    average = round(sum(d['uptime'] for d in devices) / len(devices), 4) if devices else None
+    return jsonify({'from': start, 'to': end, 'resolution': resolution, 'group': group,
+                    'average_uptime': average, 'devices': devices})
 
 
 
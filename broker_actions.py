@@ -1,80 +1,322 @@
 import paho.mqtt.client as mqtt
+import logging
 import os
+import random
+import threading
 import time
+from collections import OrderedDict
 from dotenv import load_dotenv
 
+import metrics
+import profiling
+
+logger = logging.getLogger(__name__)
+
 # Cargar variables de entorno desde el archivo .env
 load_dotenv()
 
 # Recuperar las variables de entorno
-MQTT_BROKER = os.getenv('MQTT_BROKER_HOST')
-MQTT_PORT = int(os.getenv('MQTT_PORT'))
+MQTT_BROKER = os.getenv('MQTT_BROKER_HOST', 'localhost')
+MQTT_PORT = int(os.getenv('MQTT_PORT', 1883))
 MQTT_TOPIC = os.getenv('MQTT_TOPIC')  # Tópico base, por ejemplo "streelet"
+# Filtro de suscripción del ingest: anuncios y confirmaciones de todos los grupos
+MQTT_SUBSCRIPTION = os.getenv('MQTT_SUBSCRIPTION', 'streelet/#')
+
+# Espera mínima y máxima (segundos) entre intentos de reconexión
+MQTT_RECONNECT_MIN = float(os.getenv('MQTT_RECONNECT_MIN', 1))
+MQTT_RECONNECT_MAX = float(os.getenv('MQTT_RECONNECT_MAX', 60))
+# Comandos que se guardan mientras el broker no está disponible
+MQTT_BUFFER_SIZE = int(os.getenv('MQTT_BUFFER_SIZE', 1000))
 
 mqtt_client = None
 
-def connect_mqtt():
+PUBLISHED = metrics.counter('iot_mqtt_publish_total', 'Comandos publicados por resultado', ['result'])
+RECONNECTS = metrics.counter('iot_mqtt_reconnects_total', 'Reconexiones al broker')
+DISCONNECTS = metrics.counter('iot_mqtt_disconnects_total', 'Desconexiones del broker')
+
+
+class CommandBuffer:
+    """
+    Cola acotada de comandos salientes mientras no hay conexión con el broker.
+
+    Los comandos se agrupan por (tópico, dispositivo): un "off_x" reemplaza a un
+    "on_x" pendiente y los duplicados se descartan, de modo que al reconectar
+    solo se envía el último estado deseado de cada dispositivo, en el orden en
+    que se pidió. Si se llena se descarta el comando más antiguo.
     """
-    Conecta al broker MQTT y maneja la reconexión automática en caso de fallo.
+
+    def __init__(self, maxsize=MQTT_BUFFER_SIZE):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._maxsize = maxsize
+        self.coalesced = 0
+        self.dropped = 0
+
+    @staticmethod
+    def _key(topic, message):
+        # "on_959f5e" y "off_959f5e" comparten clave; "reset" tiene la suya
+        _, _, device_id = message.partition('_')
+        return topic, device_id or message
+
+    def add(self, topic, message):
+        key = self._key(topic, message)
+        with self._lock:
+            if key in self._items:
+                del self._items[key]
+                self.coalesced += 1
+            elif len(self._items) >= self._maxsize:
+                self._items.popitem(last=False)
+                self.dropped += 1
+            self._items[key] = (topic, message)
+
+    def drain(self):
+        with self._lock:
+            items = list(self._items.values())
+            self._items.clear()
+        return items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._items)
+
+
+command_buffer = CommandBuffer()
+
+_stats_lock = threading.Lock()
+_stats = {
+    'reconnects': 0,
+    'disconnects': 0,
+    'replayed': 0,
+    'disconnected_seconds_total': 0.0,
+}
+_disconnected_since = time.monotonic()
+_network_thread = None
+_network_stop = threading.Event()
+
+
+def _mark_connected():
+    global _disconnected_since
+    with _stats_lock:
+        if _disconnected_since is not None:
+            _stats['disconnected_seconds_total'] += time.monotonic() - _disconnected_since
+            _disconnected_since = None
+
+
+def _mark_disconnected():
+    global _disconnected_since
+    with _stats_lock:
+        if _disconnected_since is None:
+            _disconnected_since = time.monotonic()
+            _stats['disconnects'] += 1
+            DISCONNECTS.inc()
+
+
+def get_stats():
+    """Métricas de la conexión: reconexiones, tiempo desconectado y buffer."""
+    with _stats_lock:
+        stats = dict(_stats)
+        if _disconnected_since is not None:
+            stats['disconnected_seconds_total'] += time.monotonic() - _disconnected_since
+        stats['connected'] = _disconnected_since is None
+    stats['buffered'] = len(command_buffer)
+    stats['buffer_coalesced'] = command_buffer.coalesced
+    stats['buffer_dropped'] = command_buffer.dropped
+    return stats
+
+
+def replay_buffered(client):
+    """Reenvía en orden los comandos guardados durante la desconexión."""
+    pending = command_buffer.drain()
+    for topic, message in pending:
+        info = client.publish(topic, message)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            command_buffer.add(topic, message)
+    if pending:
+        with _stats_lock:
+            _stats['replayed'] += len(pending)
+        logger.info("[MQTT] Replayed %d buffered commands", len(pending))
+
+
+def connect_mqtt(subscribe=True, lazy=False):
+    """
+    Conecta al broker MQTT. La reconexión la hace el hilo de start_network_loop
+    (con espera exponencial y jitter), nunca el hilo de los callbacks.
+
+    Con subscribe=False el cliente solo publica (el ingest corre en otro proceso
+    o en otro worker); se puede cambiar después con set_subscription().
+
+    Con lazy=True no se conecta aquí: la primera conexión la hace el hilo de
+    start_network_loop, así quien llama no se bloquea ni falla si el broker no
+    está disponible (los comandos se guardan en command_buffer mientras tanto).
     
     Retorna:
       - client: Instancia del cliente MQTT conectado.
     """
-    client = mqtt.Client()
+    client = mqtt.Client(userdata={'subscribe': subscribe})
     
     def on_connect(client, userdata, flags, rc):
         if rc == 0:
-            print(f"Connected to the broker {MQTT_BROKER} on port {MQTT_PORT}")
-            client.subscribe("streelet")
+            logger.info("Connected to the broker %s on port %s", MQTT_BROKER, MQTT_PORT)
+            _mark_connected()
+            if userdata['subscribe']:
+                client.subscribe(MQTT_SUBSCRIPTION)
+            replay_buffered(client)
         else:
-            print(f"Connection failed with error code {rc}")
+            logger.error("Connection failed with error code %s", rc)
     
     def on_disconnect(client, userdata, rc):
-        print("[MQTT] Disconnected. Attempting to reconnect...")
-        while True:
-            try:
-                client.reconnect()
-                print("[MQTT] Reconnected successfully.")
-                break
-            except Exception as e:
-                print(f"[MQTT] Reconnection error: {e}")
-                time.sleep(5)  # Espera antes de reintentar
+        _mark_disconnected()
+        logger.warning("[MQTT] Disconnected (rc=%s). Reconnecting in background...", rc)
     
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
     
+    if lazy:
+        client.connect_async(MQTT_BROKER, MQTT_PORT)
+        return client
+
     try:
         client.connect(MQTT_BROKER, MQTT_PORT)
     except Exception as e:
-        print(f"Error connecting to the broker: {e}")
+        logger.error("Error connecting to the broker: %s", e)
         
         raise
     
     return client
 
+
+def set_subscription(client, enabled):
+    """
+    Activa o desactiva la suscripción del cliente (se mantiene al reconectar).
+    En modo multi-worker solo el worker elegido queda suscrito.
+    """
+    userdata = client._userdata
+    if userdata['subscribe'] == enabled:
+        return
+    userdata['subscribe'] = enabled
+    if client.is_connected():
+        if enabled:
+            client.subscribe(MQTT_SUBSCRIPTION)
+        else:
+            client.unsubscribe(MQTT_SUBSCRIPTION)
+
+
+def _network_loop(client):
+    delay = MQTT_RECONNECT_MIN
+    # Con connect_mqtt(lazy=True) la primera conexión no es una reconexión
+    first = client.socket() is None
+    while not _network_stop.is_set():
+        if client.socket() is None:
+            try:
+                client.reconnect()
+                if not first:
+                    with _stats_lock:
+                        _stats['reconnects'] += 1
+                    RECONNECTS.inc()
+                first = False
+                delay = MQTT_RECONNECT_MIN
+            except Exception as e:
+                # Espera exponencial con jitter para no sincronizar reintentos
+                wait = delay / 2 + random.uniform(0, delay / 2)
+                logger.warning("[MQTT] Reconnection error: %s. Retrying in %.1fs", e, wait)
+                _network_stop.wait(wait)
+                delay = min(delay * 2, MQTT_RECONNECT_MAX)
+                continue
+        rc = client.loop(timeout=1.0)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            _mark_disconnected()
+            _network_stop.wait(0.1)
+
+
+def start_network_loop(client):
+    """
+    Reemplaza client.loop_start(): corre el loop de red de paho en un hilo
+    propio que además se encarga de reconectar sin bloquear los callbacks.
+    """
+    global _network_thread
+    if _network_thread is None:
+        _network_stop.clear()
+        _network_thread = threading.Thread(target=_network_loop, args=(client,), name='mqtt-network', daemon=True)
+        _network_thread.start()
+    return _network_thread
+
+
+def stop_network_loop(client, timeout=5):
+    global _network_thread
+    _network_stop.set()
+    if _network_thread is not None:
+        _network_thread.join(timeout)
+        _network_thread = None
+    client.disconnect()
+
 def get_mqtt_client():
     """
     Retorna el cliente MQTT, conectándolo si es necesario o si la conexión se perdió.
     """
     global mqtt_client
     if mqtt_client is None or not mqtt_client.is_connected():
-        print("MQTT client is not connected. Connecting...")
+        logger.info("MQTT client is not connected. Connecting...")
         mqtt_client = connect_mqtt()
     else:
-        print("MQTT client already connected.")
+        logger.debug("MQTT client already connected.")
     return mqtt_client
 
+@profiling.spanned('mqtt')
 def publish_message(client, topic, message):
     """
-    Publica un mensaje en el tópico especificado.
+    Publica un mensaje en el tópico especificado. Si el broker no está
+    disponible el mensaje se guarda en command_buffer y se envía al reconectar.
+
+    Retorna el MQTTMessageInfo de paho, o None si el mensaje quedó en el buffer.
     """
     try:
-        client.publish(topic, message)
-        print(f"Published message '{message}' to topic '{topic}'")
+        if client.is_connected():
+            info = client.publish(topic, message)
+            if info.rc != mqtt.MQTT_ERR_NO_CONN:
+                logger.debug("Published message '%s' to topic '%s'", message, topic)
+                PUBLISHED.inc('sent' if info.rc == mqtt.MQTT_ERR_SUCCESS else 'error')
+                return info
+        command_buffer.add(topic, message)
+        PUBLISHED.inc('buffered')
+        logger.warning("Broker unavailable, buffered message '%s' for topic '%s'", message, topic)
+        return None
     except Exception as e:
-        print(f"Error publishing message to topic {topic}: {e}")
+        PUBLISHED.inc('error')
+        logger.error("Error publishing message to topic %s: %s", topic, e)
         raise
 
+@profiling.spanned('mqtt')
+def publish_many(client, messages):
+    """
+    Publica una lista de (topic, message) sin esperar confirmación entre uno y
+    otro: paho los encola y el hilo de red los envía en ráfaga.
+
+    Retorna una lista de dicts {topic, message, sent, error} en el mismo orden;
+    los que quedan en command_buffer por falta de conexión llevan error "buffered".
+    """
+    results = []
+    connected = client.is_connected()
+    for topic, message in messages:
+        try:
+            info = client.publish(topic, message) if connected else None
+            if info is None or info.rc == mqtt.MQTT_ERR_NO_CONN:
+                command_buffer.add(topic, message)
+                results.append({'topic': topic, 'message': message, 'sent': False, 'error': 'buffered'})
+            elif info.rc == mqtt.MQTT_ERR_SUCCESS:
+                results.append({'topic': topic, 'message': message, 'sent': True, 'error': None})
+            else:
+                results.append({'topic': topic, 'message': message, 'sent': False,
+                                'error': mqtt.error_string(info.rc)})
+        except Exception as e:
+            results.append({'topic': topic, 'message': message, 'sent': False, 'error': str(e)})
+    sent = sum(1 for r in results if r['sent'])
+    buffered = sum(1 for r in results if r['error'] == 'buffered')
+    PUBLISHED.inc('sent', value=sent)
+    PUBLISHED.inc('buffered', value=buffered)
+    PUBLISHED.inc('error', value=len(results) - sent - buffered)
+    logger.debug("Published %d/%d messages in batch", sent, len(results))
+    return results
+
 def turn_on_device(client, device_id, topic=None):
     """
     Enciende un dispositivo enviando un comando MQTT en formato "on_<id>".
@@ -84,9 +326,9 @@ def turn_on_device(client, device_id, topic=None):
     message = f"on_{device_id}"
     try:
         publish_message(client, topic, message)
-        print(f"Device {device_id} turned on (published '{message}' to '{topic}').")
+        logger.info("Device %s turned on (published '%s' to '%s').", device_id, message, topic)
     except Exception as e:
-        print(f"Error turning on device {device_id}: {e}")
+        logger.error("Error turning on device %s: %s", device_id, e)
         raise
 
 def turn_off_device(client, device_id, topic=None):
@@ -98,7 +340,7 @@ def turn_off_device(client, device_id, topic=None):
     message = f"off_{device_id}"
     try:
         publish_message(client, topic, message)
-        print(f"Device {device_id} turned off (published '{message}' to '{topic}').")
+        logger.info("Device %s turned off (published '%s' to '%s').", device_id, message, topic)
     except Exception as e:
-        print(f"Error turning off device {device_id}: {e}")
+        logger.error("Error turning off device %s: %s", device_id, e)
         raise
\ No newline at end of file
@@ -0,0 +1,290 @@
+"""
+Envío de comandos de encendido/apagado con agrupamiento por dispositivo.
+
+Un comando para un dispositivo que no recibió otro en los últimos
+COMMAND_DEBOUNCE_MS se publica enseguida. Los que llegan dentro de esa
+ventana no se publican: quedan como pendientes y cada nuevo comando
+reemplaza al anterior, de modo que al cerrar la ventana solo sale el último
+estado pedido (y nada, si coincide con el que ya se envió). Así una ráfaga de
+on/off desde el dashboard cuesta como máximo dos mensajes y dos conmutaciones
+del relé.
+
+Las ventanas son por proceso: con varios workers cada uno agrupa los comandos
+que recibe.
+"""
+import heapq
+import logging
+import os
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import broker_actions as bk
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ventana (ms) en la que los comandos a un mismo dispositivo se agrupan
+COMMAND_DEBOUNCE_MS = int(os.getenv('COMMAND_DEBOUNCE_MS', 300))
+# Acciones que fijan un estado y por lo tanto se pueden reemplazar entre sí
+COALESCED_ACTIONS = ('on', 'off')
+
+SENT = 'sent'
+BUFFERED = 'buffered'
+SCHEDULED = 'scheduled'
+COALESCED = 'coalesced'
+
+COMMANDS = metrics.counter('iot_commands_total', 'Comandos recibidos por resultado del agrupamiento', ['result'])
+SAVED = metrics.counter('iot_commands_saved_total', 'Mensajes MQTT que no se enviaron', ['reason'])
+
+
+class _DeviceWindow:
+    __slots__ = ('topic', 'sent_action', 'pending')
+
+    def __init__(self, topic, sent_action):
+        self.topic = topic
+        self.sent_action = sent_action
+        self.pending = None
+
+
+class CommandDispatcher:
+    """
+    Publica "{action}_{device_id}" aplicando la ventana de agrupamiento.
+
+    on_sent(device_ids, action) se llama después de publicar (en el hilo que
+    publica) para reflejar el nuevo device_status en la BD y el registro y
+    seguir la confirmación del comando. Solo recibe los comandos que paho
+    aceptó: los que quedaron en bk.command_buffer porque el broker no estaba
+    disponible no cuentan como enviados.
+    Cada dispositivo con ventana abierta tiene una entrada en un heap ordenado
+    por cierre de ventana; un hilo la cierra, publica el pendiente si lo hay y
+    olvida el dispositivo.
+    """
+
+    def __init__(self, client, window_ms=COMMAND_DEBOUNCE_MS, on_sent=None):
+        self._client = client
+        self._window = window_ms / 1000.0
+        self._on_sent = on_sent
+        self._cond = threading.Condition()
+        self._windows = {}
+        self._heap = []
+        self._thread = None
+        self._running = False
+        self._stats = {'received': 0, 'published': 0, 'coalesced': 0, 'unchanged': 0, 'duplicates': 0, 'buffered': 0,
+                       'errors': 0}
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='command-dispatcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Publica lo pendiente sin esperar a que cierren las ventanas."""
+        if self._thread is not None:
+            with self._cond:
+                self._running = False
+                self._cond.notify()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def submit(self, device_id, topic, action):
+        """
+        Pide enviar `action` a un dispositivo. Retorna SENT si se publicó,
+        BUFFERED si el broker no está disponible y el comando quedó en
+        bk.command_buffer, SCHEDULED si saldrá al cerrar la ventana o
+        COALESCED si reemplazó a otro comando pendiente. Lanza RuntimeError
+        si paho rechazó la publicación.
+        """
+        if self._window <= 0 or action not in COALESCED_ACTIONS:
+            with self._cond:
+                self._stats['received'] += 1
+            result = self._publish_one(device_id, topic, action)
+            COMMANDS.inc(result)
+            return result
+
+        now = time.monotonic()
+        with self._cond:
+            self._stats['received'] += 1
+            window = self._windows.get(device_id)
+            if window is None:
+                self._open_window(device_id, topic, action, now)
+                result = SENT
+            else:
+                result = COALESCED if window.pending is not None else SCHEDULED
+                window.topic = topic
+                window.pending = action
+                if result == COALESCED:
+                    self._stats['coalesced'] += 1
+        if result == SENT:
+            try:
+                result = self._publish_one(device_id, topic, action)
+            except Exception:
+                self._forget_sent([device_id], action)
+                raise
+            if result != SENT:
+                self._forget_sent([device_id], action)
+        elif result == COALESCED:
+            SAVED.inc('coalesced')
+        COMMANDS.inc(result)
+        return result
+
+    def send_many(self, targets, action):
+        """
+        Publica `action` a todos los (device_id, topic) en una ráfaga, sin
+        ventana. Descarta los comandos pendientes de esos dispositivos (los
+        reemplaza este) y abre una ventana para los siguientes.
+        Retorna los resultados de bk.publish_many; on_sent recibe solo los
+        que tienen sent=True.
+        """
+        now = time.monotonic()
+        with self._cond:
+            self._stats['received'] += len(targets)
+            for device_id, topic in targets:
+                window = self._windows.get(device_id)
+                if window is None:
+                    self._open_window(device_id, topic, action, now)
+                    continue
+                if window.pending is not None:
+                    window.pending = None
+                    self._stats['coalesced'] += 1
+                    SAVED.inc('coalesced')
+                window.sent_action = action
+        try:
+            results = bk.publish_many(self._client, [(topic, f"{action}_{device_id}") for device_id, topic in targets])
+        except Exception:
+            self._forget_sent([device_id for device_id, _ in targets], action)
+            raise
+        sent_ids = [device_id for (device_id, _), result in zip(targets, results) if result['sent']]
+        if len(sent_ids) < len(targets):
+            self._forget_sent([device_id for (device_id, _), result in zip(targets, results) if not result['sent']],
+                              action)
+        buffered = sum(1 for result in results if result['error'] == BUFFERED)
+        with self._cond:
+            self._stats['published'] += len(sent_ids)
+            self._stats['buffered'] += buffered
+            self._stats['errors'] += len(results) - len(sent_ids) - buffered
+        self._notify_sent(sent_ids, action)
+        COMMANDS.inc(SENT, value=len(sent_ids))
+        COMMANDS.inc(BUFFERED, value=buffered)
+        return results
+
+    def record_duplicate(self):
+        """Cuenta un comando repetido (misma Idempotency-Key) que no se publicó."""
+        with self._cond:
+            self._stats['duplicates'] += 1
+        SAVED.inc('duplicate')
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['open_windows'] = len(self._windows)
+            stats['pending'] = sum(1 for w in self._windows.values() if w.pending is not None)
+        stats['saved'] = stats['coalesced'] + stats['unchanged'] + stats['duplicates']
+        stats['window_ms'] = int(self._window * 1000)
+        return stats
+
+    def _open_window(self, device_id, topic, action, now):
+        # Se llama con el lock tomado
+        self._windows[device_id] = _DeviceWindow(topic, action)
+        heapq.heappush(self._heap, (now + self._window, device_id))
+        if self._heap[0][1] == device_id:
+            self._cond.notify()
+
+    def _forget_sent(self, device_ids, action):
+        """
+        Ventanas abiertas para comandos que no llegaron a paho (error o
+        buffer): el dispositivo no está en `action`, así que el próximo
+        comando de la ventana no se debe descartar por repetido. La ventana
+        queda para no dejar su entrada del heap apuntando a otra.
+        """
+        with self._cond:
+            for device_id in device_ids:
+                window = self._windows.get(device_id)
+                if window is not None and window.sent_action == action:
+                    window.sent_action = None
+
+    def _publish_one(self, device_id, topic, action):
+        sent, buffered, failed = self._publish([(device_id, topic)], action)
+        if failed:
+            raise RuntimeError(failed[0][1])
+        return SENT if sent else BUFFERED
+
+    def _publish(self, targets, action):
+        """
+        Publica cada comando y llama a on_sent con los aceptados por paho.
+        Retorna (enviados, en el buffer, [(device_id, error)]).
+        """
+        sent, buffered, failed = [], [], []
+        for device_id, topic in targets:
+            info = bk.publish_message(self._client, topic, f"{action}_{device_id}")
+            if info is None:
+                buffered.append(device_id)
+            elif info.rc == mqtt.MQTT_ERR_SUCCESS:
+                sent.append(device_id)
+            else:
+                failed.append((device_id, mqtt.error_string(info.rc)))
+        with self._cond:
+            self._stats['published'] += len(sent)
+            self._stats['buffered'] += len(buffered)
+            self._stats['errors'] += len(failed)
+        self._notify_sent(sent, action)
+        return sent, buffered, failed
+
+    def _notify_sent(self, device_ids, action):
+        if device_ids and self._on_sent is not None:
+            self._on_sent(device_ids, action)
+
+    def _pop_closed(self, now, flush_all=False):
+        """Cierra las ventanas vencidas y retorna {action: [(device_id, topic)]} a publicar."""
+        due = {}
+        while self._heap and (flush_all or self._heap[0][0] <= now):
+            _, device_id = heapq.heappop(self._heap)
+            window = self._windows.get(device_id)
+            if window is None:
+                continue
+            action = window.pending
+            if action is None:
+                del self._windows[device_id]
+            elif action == window.sent_action:
+                # on -> off -> on dentro de la ventana: el dispositivo ya está así
+                del self._windows[device_id]
+                self._stats['unchanged'] += 1
+                SAVED.inc('unchanged')
+            else:
+                # El pendiente sale ahora y abre una ventana nueva
+                window.pending = None
+                window.sent_action = action
+                if not flush_all:
+                    heapq.heappush(self._heap, (now + self._window, device_id))
+                due.setdefault(action, []).append((device_id, window.topic))
+        if flush_all:
+            self._windows.clear()
+        return due
+
+    def _run(self):
+        running = True
+        while running:
+            with self._cond:
+                while self._running:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+                running = self._running
+                due = self._pop_closed(time.monotonic(), flush_all=not running)
+
+            for action, targets in due.items():
+                try:
+                    _, buffered, failed = self._publish(targets, action)
+                    if buffered or failed:
+                        self._forget_sent(buffered + [device_id for device_id, _ in failed], action)
+                        logger.warning("Comandos agrupados '%s': %d en el buffer, %d con error",
+                                       action, len(buffered), len(failed))
+                except Exception as e:
+                    self._forget_sent([device_id for device_id, _ in targets], action)
+                    logger.exception("Error al publicar comandos agrupados '%s': %s", action, e)
+                    with self._cond:
+                        self._stats['errors'] += 1
@@ -0,0 +1,372 @@
+"""
+Seguimiento de los comandos enviados a los dispositivos y de sus confirmaciones.
+
+El firmware confirma cada comando publicando "ack_{device_id}_{estado}"
+(estado: on, off o reset) en el tópico de anuncios. El tracker guarda en
+memoria el último comando sin confirmar de cada dispositivo, mide la latencia
+comando -> ack, lo reenvía si no llega la confirmación y, cada
+COMMAND_RECONCILE_S segundos, reenvía el estado deseado (device_status) a
+los dispositivos online cuyo estado reportado es distinto.
+
+Corre solo en el proceso suscrito al broker (app.py con el lease, o
+ingest_service.py con INGEST_MODE=external). Los comandos no se registran
+al publicarlos: la suscripción (MQTT_SUBSCRIPTION, "streelet/#") también
+entrega los "on_"/"off_"/"reset" que publica cualquier worker, y el router
+se los pasa a record_command(). Así los demás procesos alimentan el tracker
+sin escribir en la BD y el suscriptor no consulta nada periódicamente.
+
+Con share=True el tracker publica cada COMMAND_SHARE_S segundos, si hubo
+cambios, una copia de su estado en app_state (una sola escritura por
+intervalo); los procesos que no corren el tracker la leen en
+pending(), power_state() y stats().
+
+No se consulta a los dispositivos: el estado reportado es el del último ack.
+"""
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+
+import broker_actions as bk
+import database as dbm
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Segundos sin ack antes de reenviar un comando; se duplica en cada reintento
+COMMAND_ACK_TIMEOUT = float(os.getenv('COMMAND_ACK_TIMEOUT', 5))
+COMMAND_MAX_RETRIES = int(os.getenv('COMMAND_MAX_RETRIES', 3))
+# Intervalo de la reconciliación estado deseado / reportado (0 = desactivada)
+COMMAND_RECONCILE_S = float(os.getenv('COMMAND_RECONCILE_S', 60))
+# Intervalo mínimo entre copias del estado en app_state (share=True)
+COMMAND_SHARE_S = float(os.getenv('COMMAND_SHARE_S', 2))
+
+# Clave de app_state con la copia del estado del tracker
+COMMAND_TRACKER_KEY = 'command_tracker'
+
+POWER_STATES = ('on', 'off')
+
+ACK_LATENCY = metrics.histogram('iot_command_ack_seconds', 'Tiempo entre el envío de un comando y su ack', ['action'])
+ACK_RESULTS = metrics.counter('iot_command_acks_total', 'Comandos por resultado del seguimiento', ['result'])
+
+
+def command_message(device_id, action):
+    # "reset" se publica sin device_id (lo atienden los dispositivos del tópico)
+    return 'reset' if action == 'reset' else f"{action}_{device_id}"
+
+
+class _Pending:
+    __slots__ = ('topic', 'action', 'first_sent', 'sent_at', 'attempts', 'deadline')
+
+    def __init__(self, topic, action, now, timeout):
+        self.topic = topic
+        self.action = action
+        self.first_sent = now
+        self.sent_at = now
+        self.attempts = 1
+        self.deadline = now + timeout
+
+
+class CommandTracker:
+    """
+    Comandos pendientes de confirmación, uno por dispositivo (un comando nuevo
+    reemplaza al anterior). Los vencimientos se guardan en un heap como en
+    heartbeat.HeartbeatMonitor, así cada revisión cuesta del orden de los
+    comandos que vencen.
+
+    record_command() y record_ack() los llama el callback de MQTT: solo
+    encolan, y el hilo del tracker aplica la cola.
+
+    desired_states() retorna {device_id: (estado, topic)} con el estado
+    ('on' u 'off') que debería tener cada dispositivo online. publish(messages)
+    publica una lista de (topic, message); por defecto bk.publish_many(client, ...).
+    """
+
+    def __init__(self, client, desired_states, ack_timeout=COMMAND_ACK_TIMEOUT,
+                 max_retries=COMMAND_MAX_RETRIES, reconcile_s=COMMAND_RECONCILE_S,
+                 publish=None, share=False, share_s=COMMAND_SHARE_S):
+        self._client = client
+        self._desired_states = desired_states
+        self._ack_timeout = ack_timeout
+        self._max_retries = max_retries
+        self._reconcile_s = reconcile_s
+        self._publish_messages = publish or (lambda messages: bk.publish_many(self._client, messages))
+        self._share = share
+        self._share_s = share_s
+        self._cond = threading.Condition()
+        self._inbox = []
+        self._pending = {}
+        self._reported = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._thread = None
+        self._running = False
+        self._next_reconcile = None
+        self._next_share = None
+        self._dirty = False
+        self._shared = {'value': None, 'checked_at': None}
+        self._stats = {'sent': 0, 'acked': 0, 'unsolicited_acks': 0, 'retries': 0, 'failed': 0,
+                       'superseded': 0, 'reconciled': 0, 'total_ack_ms': 0.0, 'max_ack_ms': 0.0}
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            now = time.monotonic()
+            self._next_reconcile = now + self._reconcile_s if self._reconcile_s > 0 else None
+            # La primera copia reemplaza la del dueño anterior
+            self._next_share = now
+            self._dirty = True
+            self._thread = threading.Thread(target=self._run, name='command-tracker', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Deja de seguir comandos; los pendientes se olvidan."""
+        if self._thread is not None:
+            with self._cond:
+                self._running = False
+                self._inbox.clear()
+                self._pending.clear()
+                self._heap.clear()
+                self._cond.notify()
+            self._thread.join(timeout)
+            self._thread = None
+
+    # ----------------------------------------------------------
+    # Entradas (callback de MQTT)
+
+    def record_command(self, topic, device_id, action):
+        """
+        Comando publicado por cualquier proceso, recibido de vuelta por la
+        suscripción. device_id es None para "reset", que va a todo el tópico.
+        """
+        with self._cond:
+            if self._running:
+                self._inbox.append(('sent', topic, device_id, action, time.monotonic()))
+                self._cond.notify()
+
+    def record_ack(self, device_id, state):
+        """Callback del ingest para cada "ack_" recibido."""
+        with self._cond:
+            if not self._running:
+                logger.warning("ack de %s recibido con el seguimiento de comandos detenido", device_id)
+                return
+            self._inbox.append(('ack', device_id, state, time.monotonic()))
+            self._cond.notify()
+
+    def forget_reported(self, device_ids):
+        """Dispositivos que pasaron a offline: al volver su relé puede estar en otro estado."""
+        with self._cond:
+            for device_id in device_ids:
+                self._reported.pop(device_id, None)
+                self._pending.pop(device_id, None)
+            self._dirty = True
+            self._cond.notify()
+
+    # ----------------------------------------------------------
+    # Lecturas: de la memoria en el proceso que corre el tracker y de la
+    # copia en app_state en el resto
+
+    def _shared_state(self):
+        now = time.monotonic()
+        checked_at = self._shared['checked_at']
+        if checked_at is None or now - checked_at >= self._share_s:
+            value = dbm.get_state(COMMAND_TRACKER_KEY)
+            self._shared['value'] = json.loads(value) if value else None
+            self._shared['checked_at'] = now
+        return self._shared['value'] or {'written_at': time.time(), 'stats': {}, 'reported': {}, 'pending': {}}
+
+    def power_state(self, device_id):
+        """Retorna {'reported', 'pending', 'attempts'} de un dispositivo."""
+        with self._cond:
+            if self._running:
+                pending = self._pending.get(device_id)
+                return {'reported': self._reported.get(device_id),
+                        'pending': pending.action if pending else None,
+                        'attempts': pending.attempts if pending else 0}
+        shared = self._shared_state()
+        action, attempts, _ = shared['pending'].get(device_id, (None, 0, 0))
+        return {'reported': shared['reported'].get(device_id), 'pending': action, 'attempts': attempts}
+
+    def pending(self, limit=100):
+        with self._cond:
+            if self._running:
+                now = time.monotonic()
+                items = sorted(self._pending.items(), key=lambda item: item[1].first_sent)[:limit]
+                return [{'device_id': device_id, 'action': p.action, 'attempts': p.attempts,
+                         'age_ms': round((now - p.first_sent) * 1000.0, 1)} for device_id, p in items]
+        shared = self._shared_state()
+        elapsed_ms = max(time.time() - shared['written_at'], 0.0) * 1000.0
+        return [{'device_id': device_id, 'action': action, 'attempts': attempts,
+                 'age_ms': round(age_ms + elapsed_ms, 1)}
+                for device_id, (action, attempts, age_ms) in itertools.islice(shared['pending'].items(), limit)]
+
+    def stats(self):
+        with self._cond:
+            running = self._running
+            if running:
+                stats = dict(self._stats)
+                stats['pending'] = len(self._pending)
+                stats['reported'] = len(self._reported)
+        if not running:
+            shared = self._shared_state()
+            stats = {**dict.fromkeys(self._stats, 0), **shared['stats'],
+                     'pending': len(shared['pending']), 'reported': len(shared['reported'])}
+        stats['running'] = running
+        stats['avg_ack_ms'] = stats['total_ack_ms'] / stats['acked'] if stats['acked'] else 0.0
+        return stats
+
+    # ----------------------------------------------------------
+    # Hilo de acks, reintentos y reconciliación
+
+    def _record_sent(self, device_id, topic, action, now):
+        pending = self._pending.get(device_id)
+        if pending is not None and pending.action == action and pending.topic == topic:
+            # Reintento del propio tracker o el mismo comando repetido: sigue
+            # contando los intentos del pendiente
+            return
+        if pending is not None:
+            self._stats['superseded'] += 1
+        pending = self._pending[device_id] = _Pending(topic, action, now, self._ack_timeout)
+        heapq.heappush(self._heap, (pending.deadline, next(self._sequence), device_id))
+        self._stats['sent'] += 1
+
+    def _record_ack(self, device_id, state, now):
+        if state in POWER_STATES:
+            self._reported[device_id] = state
+        pending = self._pending.get(device_id)
+        if pending is None or pending.action != state:
+            # Ack repetido o de un comando reemplazado
+            self._stats['unsolicited_acks'] += 1
+            ACK_RESULTS.inc('unsolicited')
+            return
+        del self._pending[device_id]
+        latency_ms = (now - pending.sent_at) * 1000.0
+        self._stats['acked'] += 1
+        self._stats['total_ack_ms'] += latency_ms
+        self._stats['max_ack_ms'] = max(self._stats['max_ack_ms'], latency_ms)
+        ACK_LATENCY.observe(latency_ms / 1000.0, state)
+        ACK_RESULTS.inc('acked' if pending.attempts == 1 else 'acked_after_retry')
+
+    def _apply(self, events):
+        # "reset" no trae device_id: se sigue en los dispositivos online del tópico
+        desired = self._desired_states() if any(e[0] == 'sent' and e[2] is None for e in events) else {}
+        with self._cond:
+            for event in events:
+                if event[0] == 'ack':
+                    self._record_ack(*event[1:])
+                    continue
+                _, topic, device_id, action, received_at = event
+                device_ids = [device_id] if device_id is not None else \
+                    [d for d, (_, device_topic) in desired.items() if device_topic == topic]
+                for device_id in device_ids:
+                    self._record_sent(device_id, topic, action, received_at)
+            self._dirty = True
+
+    def _pop_expired(self, now):
+        """Retorna [(device_id, topic, action)] a reenviar y descarta los agotados."""
+        resend = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, device_id = heapq.heappop(self._heap)
+            pending = self._pending.get(device_id)
+            if pending is None or pending.deadline != deadline:
+                continue
+            self._dirty = True
+            # reset no se reintenta: el dispositivo se reinicia y puede no confirmarlo
+            if pending.action == 'reset' or pending.attempts > self._max_retries:
+                del self._pending[device_id]
+                self._stats['failed'] += 1
+                ACK_RESULTS.inc('failed')
+                logger.warning("Comando '%s' a %s sin confirmación después de %d intentos",
+                               pending.action, device_id, pending.attempts)
+                continue
+            pending.attempts += 1
+            pending.sent_at = now
+            pending.deadline = now + self._ack_timeout * 2 ** (pending.attempts - 1)
+            heapq.heappush(self._heap, (pending.deadline, next(self._sequence), device_id))
+            self._stats['retries'] += 1
+            resend.append((device_id, pending.topic, pending.action))
+        return resend
+
+    def _mismatched(self):
+        """
+        Retorna {estado: {device_id: topic}} de los dispositivos online cuyo
+        último ack difiere del estado deseado y no tienen un comando pendiente.
+        Los que nunca confirmaron (estado reportado desconocido) no se tocan.
+        """
+        desired = self._desired_states()
+        mismatched = {}
+        with self._cond:
+            for device_id, (state, topic) in desired.items():
+                reported = self._reported.get(device_id)
+                if reported is not None and reported != state and device_id not in self._pending:
+                    mismatched.setdefault(state, {})[device_id] = topic
+        return mismatched
+
+    def _publish(self, messages):
+        if messages:
+            self._publish_messages(messages)
+
+    def _write_shared(self):
+        now = time.monotonic()
+        with self._cond:
+            items = sorted(self._pending.items(), key=lambda item: item[1].first_sent)
+            state = {'written_at': time.time(), 'stats': dict(self._stats), 'reported': dict(self._reported),
+                     'pending': {device_id: (p.action, p.attempts, round((now - p.first_sent) * 1000.0, 1))
+                                 for device_id, p in items}}
+            self._dirty = False
+        dbm.set_state(COMMAND_TRACKER_KEY, json.dumps(state))
+
+    def _next_wake(self):
+        times = (self._heap[0][0] if self._heap else None, self._next_reconcile,
+                 self._next_share if self._share and self._dirty else None)
+        return min([t for t in times if t is not None], default=None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and not self._inbox:
+                    now = time.monotonic()
+                    next_wake = self._next_wake()
+                    if next_wake is not None and next_wake <= now:
+                        break
+                    self._cond.wait(None if next_wake is None else next_wake - now)
+                if not self._running:
+                    return
+                events, self._inbox = self._inbox, []
+
+            try:
+                if events:
+                    self._apply(events)
+                with self._cond:
+                    now = time.monotonic()
+                    resend = self._pop_expired(now)
+                    reconcile = self._next_reconcile is not None and self._next_reconcile <= now
+                    if reconcile:
+                        self._next_reconcile = now + self._reconcile_s
+                    share = self._share and self._dirty and self._next_share <= now
+                    if share:
+                        self._next_share = now + self._share_s
+                self._publish([(topic, command_message(device_id, action)) for device_id, topic, action in resend])
+                if reconcile:
+                    self._reconcile()
+                if share:
+                    self._write_shared()
+            except Exception as e:
+                logger.exception("Error en el seguimiento de comandos: %s", e)
+
+    def _reconcile(self):
+        # Los comandos publicados vuelven por la suscripción y quedan pendientes
+        mismatched = self._mismatched()
+        count = 0
+        for action, topics in mismatched.items():
+            self._publish([(topic, command_message(device_id, action)) for device_id, topic in topics.items()])
+            count += len(topics)
+        if count:
+            with self._cond:
+                self._stats['reconciled'] += count
+            ACK_RESULTS.inc('reconciled', value=count)
+            logger.info("Reconciliación: reenviado el estado deseado a %d dispositivos", count)
@@ -1,51 +1,519 @@
+import json
+import logging
 import sqlite3
 import os
+import queue
+import threading
 import time
+from contextlib import contextmanager
 import broker_actions as bk
+import metrics
+import profiling
+
+logger = logging.getLogger(__name__)
 
 DB_NAME = 'devices.db'
 
+# Conexiones persistentes compartidas por todos los hilos (Flask, ingest, heartbeat)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_BUSY_TIMEOUT = float(os.getenv('DB_BUSY_TIMEOUT', 10))
+
+# Tiempo de cada función de este módulo (incluye la espera por una conexión)
+DB_TIME = metrics.histogram('iot_db_function_seconds', 'Tiempo de las funciones de database.py', ['function'])
+
+_pool = queue.LifoQueue()
+_pool_lock = threading.Lock()
+_pool_created = 0
+
+
+def _new_connection():
+    """
+    Abre una conexión configurada para acceso concurrente: WAL permite lectores
+    mientras el ingest escribe, synchronous=NORMAL es seguro con WAL y evita un
+    fsync por commit, y cached_statements conserva las sentencias preparadas.
+    """
+    conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT,
+                           check_same_thread=False, cached_statements=256)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA cache_size=-8000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+
+@contextmanager
+def get_connection():
+    """
+    Presta una conexión del pool. Al salir hace commit (o rollback si hubo una
+    excepción) y devuelve la conexión al pool en lugar de cerrarla.
+
+    Si ya hay DB_POOL_SIZE conexiones prestadas se espera a que alguna vuelva.
+    """
+    global _pool_created
+    # Con PROFILING=1 el tiempo con la conexión prestada cuenta como "sqlite"
+    with profiling.span('sqlite'):
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            with _pool_lock:
+                create = _pool_created < DB_POOL_SIZE
+                if create:
+                    _pool_created += 1
+            if create:
+                try:
+                    conn = _new_connection()
+                except Exception:
+                    with _pool_lock:
+                        _pool_created -= 1
+                    raise
+            else:
+                conn = _pool.get(timeout=DB_BUSY_TIMEOUT)
+
+        try:
+            yield conn
+            if conn.in_transaction:
+                conn.commit()
+        except BaseException:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            raise
+        finally:
+            _pool.put(conn)
+
+
+def close_connections():
+    """Cierra todas las conexiones libres del pool (p. ej. al cambiar DB_NAME)."""
+    global _pool_created
+    while True:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            break
+        conn.close()
+        with _pool_lock:
+            _pool_created -= 1
+
+# Clave de app_state que cuenta los commits que escriben la tabla devices
+DEVICES_VERSION_KEY = 'devices_version'
+
+# Versiones escritas por este proceso, por clave; solo se guardan las de las
+# claves que vigila algún ChangeWatcher
+_own_versions = {}
+_own_versions_lock = threading.Lock()
+
+
+@contextmanager
+def _versioned_connection(key):
+    """
+    Como get_connection(), pero si hubo cambios incrementa la versión `key`
+    de app_state en la misma conexión. La versión se recuerda como propia
+    recién después del commit: el ChangeWatcher de este proceso no recarga
+    por sus propias escrituras.
+    """
+    with get_connection() as conn:
+        changes = conn.total_changes
+        yield conn
+        if conn.total_changes == changes:
+            return
+        version = conn.execute(
+            """INSERT INTO app_state (key, value, updated_at) VALUES (?, '1', ?)
+               ON CONFLICT(key) DO UPDATE SET value = CAST(app_state.value AS INTEGER) + 1,
+                                              updated_at = excluded.updated_at
+               RETURNING value""", (key, int(time.time()))).fetchone()[0]
+    with _own_versions_lock:
+        own = _own_versions.get(key)
+        if own is not None:
+            own.add(int(version))
+
+
+class ChangeWatcher:
+    """
+    Detecta cambios hechos por otro proceso (p. ej. ingest_service.py) y
+    llama a callback(). Cada `interval` segundos lee la versión `key` de
+    app_state, que solo cambia cuando se escribe esa tabla, e ignora las
+    versiones que escribió este mismo proceso.
+
+    Sin key usa PRAGMA data_version, que cambia con el commit de cualquier
+    otra conexión (también las del pool de este proceso y las que solo tocan
+    app_state): sirve cuando el callback ya es barato si no hubo cambios.
+    """
+
+    def __init__(self, callback, interval=1.0, key=None):
+        self._callback = callback
+        self._interval = interval
+        self._key = key
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            if self._key is not None:
+                with _own_versions_lock:
+                    _own_versions.setdefault(self._key, set())
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='db-watcher', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _version(self, conn):
+        if self._key is None:
+            return conn.execute("PRAGMA data_version").fetchone()[0]
+        row = conn.execute("SELECT value FROM app_state WHERE key = ?", (self._key,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _changed_elsewhere(self, last, current):
+        """True si entre last y current hay alguna versión que no escribió este proceso."""
+        if self._key is None:
+            return True
+        with _own_versions_lock:
+            own = _own_versions[self._key]
+            foreign = current < last or current - last > len(own) or \
+                any(version not in own for version in range(last + 1, current + 1))
+            own.difference_update([version for version in own if version <= current])
+        return foreign
+
+    def _run(self):
+        conn = sqlite3.connect(DB_NAME, timeout=DB_BUSY_TIMEOUT, check_same_thread=False)
+        try:
+            last = self._version(conn)
+            while not self._stop.wait(self._interval):
+                current = self._version(conn)
+                if current != last:
+                    changed = self._changed_elsewhere(last, current)
+                    last = current
+                    if not changed:
+                        continue
+                    try:
+                        self._callback()
+                    except Exception as e:
+                        logger.exception("Error en ChangeWatcher: %s", e)
+        finally:
+            conn.close()
+
+@metrics.timed(DB_TIME)
 def init_db():
-    if not os.path.exists(DB_NAME):
-        with sqlite3.connect(DB_NAME) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''
-                CREATE TABLE devices (
-                    id TEXT PRIMARY KEY,
-                    name TEXT NOT NULL UNIQUE,
-                    topic TEXT NOT NULL,
-                    ip TEXT,
-                    status TEXT NOT NULL DEFAULT 'offline',
-                    device_status INTEGER NOT NULL DEFAULT 0,
-                    last_seen INTEGER
-                )
-            ''')
-            conn.commit()
-        return DB_NAME
-    else:
-        print(f"Database '{DB_NAME}' already exists.")
-        return DB_NAME
+    exists = os.path.exists(DB_NAME)
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE,
+                topic TEXT NOT NULL,
+                ip TEXT,
+                status TEXT NOT NULL DEFAULT 'offline',
+                device_status INTEGER NOT NULL DEFAULT 0,
+                last_seen INTEGER
+            )
+        ''')
+        # (status, last_seen) sirve a los filtros por estado y al barrido de
+        # check_heartbeats; es uno solo porque last_seen cambia con cada anuncio
+        # y cada índice que lo incluya se reescribe en el ingest
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_status_last_seen ON devices (status, last_seen)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_topic ON devices (topic)")
+        # Estado compartido entre procesos/workers (ventana de alta, WiFi, leases)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS app_state (
+                key TEXT PRIMARY KEY,
+                value TEXT,
+                updated_at INTEGER
+            )
+        ''')
+        # Trabajos programados (encendido/apagado por hora o por el sol)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT NOT NULL,
+                target_type TEXT NOT NULL,
+                target TEXT NOT NULL,
+                action TEXT NOT NULL,
+                schedule TEXT NOT NULL,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                next_run REAL,
+                last_run REAL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        # Respuestas guardadas por Idempotency-Key (reintentos de comandos)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                key TEXT PRIMARY KEY,
+                status INTEGER,
+                body TEXT,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        # Trabajos de configuración de ESP (visibles desde cualquier worker)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS provisioning_jobs (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                grupo TEXT NOT NULL,
+                esp_ip TEXT NOT NULL,
+                state TEXT NOT NULL,
+                message TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_provisioning_jobs_created ON provisioning_jobs (created_at)")
+        # Tablas del seguimiento de comandos en SQLite, reemplazado por el
+        # estado en memoria del suscriptor (command_tracker.py)
+        cursor.execute("DROP TABLE IF EXISTS pending_commands")
+        cursor.execute("DROP TABLE IF EXISTS reported_power")
+        conn.commit()
+    if exists:
+        logger.info("Database '%s' already exists.", DB_NAME)
+    return DB_NAME
+
+def ping():
+    """Ejecuta una consulta mínima; lanza la excepción de SQLite si la BD no responde."""
+    with get_connection() as conn:
+        conn.execute("SELECT 1").fetchone()
+
+@metrics.timed(DB_TIME)
+def get_state(key, default=None):
+    with get_connection() as conn:
+        row = conn.execute("SELECT value FROM app_state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+@metrics.timed(DB_TIME)
+def set_state(key, value):
+    with get_connection() as conn:
+        conn.execute(
+            """INSERT INTO app_state (key, value, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at""",
+            (key, value, int(time.time())))
+
+@metrics.timed(DB_TIME)
+def delete_state(key):
+    with get_connection() as conn:
+        conn.execute("DELETE FROM app_state WHERE key = ?", (key,))
+
+def restrict_permissions():
+    """Deja la BD (y sus archivos -wal y -shm) legible solo por el usuario del proceso."""
+    for path in (DB_NAME, f"{DB_NAME}-wal", f"{DB_NAME}-shm"):
+        try:
+            os.chmod(path, 0o600)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("No se pudieron restringir los permisos de %s: %s", path, e)
+
+@metrics.timed(DB_TIME)
+def increment_state(key, delta=1):
+    """Suma delta a un valor entero de app_state de forma atómica y retorna el nuevo valor."""
+    with get_connection() as conn:
+        conn.execute(
+            """INSERT INTO app_state (key, value, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET value = CAST(app_state.value AS INTEGER) + ?,
+                                              updated_at = excluded.updated_at""",
+            (key, str(delta), int(time.time()), delta))
+        row = conn.execute("SELECT value FROM app_state WHERE key = ?", (key,)).fetchone()
+        return int(row[0])
+
+@metrics.timed(DB_TIME)
+def try_acquire_lease(name, owner, ttl):
+    """
+    Toma o renueva el lease `name` para `owner` durante ttl segundos. Solo se
+    puede tomar si está libre, vencido o ya pertenece a owner.
+    Retorna True si owner tiene el lease.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO app_state (key, value, updated_at) VALUES (?, ?, ?)
+               ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
+               WHERE app_state.value = excluded.value OR app_state.updated_at < ?""",
+            (f"lease:{name}", owner, int(now + ttl), int(now)))
+        return cursor.rowcount == 1
+
+@metrics.timed(DB_TIME)
+def release_lease(name, owner):
+    with get_connection() as conn:
+        conn.execute("DELETE FROM app_state WHERE key = ? AND value = ?", (f"lease:{name}", owner))
+
+@metrics.timed(DB_TIME)
+def claim_idempotency_key(key, ttl):
+    """
+    Reserva `key` durante ttl segundos. Retorna None si se reservó (la request
+    es nueva) o (status, body) de la que la reservó antes; status es None si
+    esa todavía no terminó.
+    """
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO idempotency_keys (key, status, body, expires_at) VALUES (?, NULL, NULL, ?)
+               ON CONFLICT(key) DO UPDATE SET status = NULL, body = NULL, expires_at = excluded.expires_at
+               WHERE idempotency_keys.expires_at < ?""",
+            (key, now + ttl, now))
+        if cursor.rowcount == 1:
+            return None
+        return conn.execute("SELECT status, body FROM idempotency_keys WHERE key = ?", (key,)).fetchone()
+
+@metrics.timed(DB_TIME)
+def complete_idempotency_key(key, status, body):
+    with get_connection() as conn:
+        conn.execute("UPDATE idempotency_keys SET status = ?, body = ? WHERE key = ?", (status, body, key))
+
+@metrics.timed(DB_TIME)
+def release_idempotency_key(key):
+    with get_connection() as conn:
+        conn.execute("DELETE FROM idempotency_keys WHERE key = ?", (key,))
+
+@metrics.timed(DB_TIME)
+def delete_expired_idempotency_keys():
+    with get_connection() as conn:
+        return conn.execute("DELETE FROM idempotency_keys WHERE expires_at < ?", (time.time(),)).rowcount
+
+@metrics.timed(DB_TIME)
+def get_desired_power_states():
+    """Retorna {device_id: ('on'|'off', topic)} de los dispositivos online (como DeviceRegistry)."""
+    with get_connection() as conn:
+        rows = conn.execute("SELECT id, device_status, topic FROM devices WHERE status = 'online'")
+        return {device_id: ('on' if device_status == 1 else 'off', topic) for device_id, device_status, topic in rows}
 
-def add_device(device_id, topic, ip=''):
+JOB_COLUMNS = ('id', 'name', 'target_type', 'target', 'action', 'schedule', 'enabled',
+               'next_run', 'last_run', 'created_at', 'updated_at')
+
+def _job_from_row(row):
+    job = dict(zip(JOB_COLUMNS, row))
+    job['schedule'] = json.loads(job['schedule'])
+    job['enabled'] = bool(job['enabled'])
+    return job
+
+@metrics.timed(DB_TIME)
+def create_job(name, target_type, target, action, schedule, enabled, next_run):
+    now = time.time()
+    with get_connection() as conn:
+        cursor = conn.execute(
+            """INSERT INTO jobs (name, target_type, target, action, schedule, enabled, next_run, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (name, target_type, target, action, json.dumps(schedule), int(enabled), next_run, now, now))
+        return cursor.lastrowid
+
+@metrics.timed(DB_TIME)
+def update_job(job_id, name, target_type, target, action, schedule, enabled, next_run):
+    """Retorna False si el trabajo no existe."""
+    with get_connection() as conn:
+        cursor = conn.execute(
+            """UPDATE jobs SET name = ?, target_type = ?, target = ?, action = ?, schedule = ?, enabled = ?,
+                              next_run = ?, updated_at = ?
+               WHERE id = ?""",
+            (name, target_type, target, action, json.dumps(schedule), int(enabled), next_run, time.time(), job_id))
+        return cursor.rowcount == 1
+
+@metrics.timed(DB_TIME)
+def update_job_runs(runs):
+    """Guarda en una sola transacción [(job_id, last_run, next_run, enabled)] después de ejecutar."""
+    with get_connection() as conn:
+        conn.executemany("UPDATE jobs SET last_run = ?, next_run = ?, enabled = ? WHERE id = ?",
+                         [(last_run, next_run, int(enabled), job_id) for job_id, last_run, next_run, enabled in runs])
+
+@metrics.timed(DB_TIME)
+def count_jobs():
+    """Retorna (total, habilitados, próxima ejecución) sin leer los trabajos."""
+    with get_connection() as conn:
+        return conn.execute("SELECT COUNT(*), COALESCE(SUM(enabled), 0), MIN(CASE WHEN enabled THEN next_run END) "
+                            "FROM jobs").fetchone()
+
+@metrics.timed(DB_TIME)
+def delete_job(job_id):
+    with get_connection() as conn:
+        return conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,)).rowcount == 1
+
+@metrics.timed(DB_TIME)
+def get_job(job_id):
+    with get_connection() as conn:
+        row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return _job_from_row(row) if row else None
+
+@metrics.timed(DB_TIME)
+def get_jobs():
+    with get_connection() as conn:
+        rows = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs ORDER BY id").fetchall()
+        return [_job_from_row(row) for row in rows]
+
+PROVISIONING_JOB_COLUMNS = ('id', 'name', 'grupo', 'esp_ip', 'state', 'message', 'created_at', 'updated_at')
+
+@metrics.timed(DB_TIME)
+def create_provisioning_job(job_id, name, grupo, esp_ip, state):
+    now = time.time()
+    with get_connection() as conn:
+        conn.execute(
+            """INSERT INTO provisioning_jobs (id, name, grupo, esp_ip, state, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            (job_id, name, grupo, esp_ip, state, now, now))
+
+@metrics.timed(DB_TIME)
+def update_provisioning_job(job_id, state, message=None):
+    with get_connection() as conn:
+        conn.execute(
+            """UPDATE provisioning_jobs SET state = ?, message = COALESCE(?, message), updated_at = ?
+               WHERE id = ?""",
+            (state, message, time.time(), job_id))
+
+@metrics.timed(DB_TIME)
+def get_provisioning_job(job_id):
+    with get_connection() as conn:
+        row = conn.execute(f"SELECT {', '.join(PROVISIONING_JOB_COLUMNS)} FROM provisioning_jobs WHERE id = ?",
+                           (job_id,)).fetchone()
+        return dict(zip(PROVISIONING_JOB_COLUMNS, row)) if row else None
+
+@metrics.timed(DB_TIME)
+def get_provisioning_jobs(limit=50):
+    """Los trabajos más recientes primero."""
+    with get_connection() as conn:
+        rows = conn.execute(f"SELECT {', '.join(PROVISIONING_JOB_COLUMNS)} FROM provisioning_jobs "
+                            "ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(zip(PROVISIONING_JOB_COLUMNS, row)) for row in rows]
+
+@metrics.timed(DB_TIME)
+def fail_stale_provisioning_jobs(states, before, message):
+    """Marca como 'failed' los trabajos en `states` sin cambios desde `before` (su proceso terminó)."""
+    with get_connection() as conn:
+        return conn.execute(
+            f"""UPDATE provisioning_jobs SET state = 'failed', message = ?, updated_at = ?
+                WHERE state IN ({', '.join('?' * len(states))}) AND updated_at < ?""",
+            (message, time.time(), *states, before)).rowcount
+
+@metrics.timed(DB_TIME)
+def delete_provisioning_jobs_before(cutoff):
+    with get_connection() as conn:
+        return conn.execute("DELETE FROM provisioning_jobs WHERE created_at < ?", (cutoff,)).rowcount
+
+@metrics.timed(DB_TIME)
+def add_device(device_id, name, topic, ip=''):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _versioned_connection(DEVICES_VERSION_KEY) as conn:
             cursor = conn.cursor()
             # Se inserta el device_id directamente en la columna id
             cursor.execute("INSERT INTO devices (id, name, topic, ip, status, device_status) VALUES (?, ?, ?, ?, ?, ?)",
-                            (device_id, device_id, topic, ip, 'offline', 0))
+                            (device_id, name, topic, ip, 'offline', 0))
             conn.commit()
             return 1
     except sqlite3.IntegrityError:
-        print(f"Error: El dispositivo con device_id '{device_id}' ya existe.")
+        logger.warning("Error: El dispositivo con device_id '%s' ya existe.", device_id)
         return -1
     except Exception as e:
-        print(f"Error adding device: {e}")
+        logger.error("Error adding device: %s", e)
         return -1
 
+@metrics.timed(DB_TIME)
 def update_device_online_status_by_id(id, ip):
     now = int(time.time())
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _versioned_connection(DEVICES_VERSION_KEY) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT ip, status FROM devices WHERE id = ?", (id,))
             result = cursor.fetchone()
@@ -54,34 +522,209 @@ def update_device_online_status_by_id(id, ip):
                 if current_status == 'online' and current_ip == ip:
                     cursor.execute("UPDATE devices SET last_seen = ? WHERE id = ?", (now, id))
                     conn.commit()
-                    print(f"[HEARTBEAT] Actualizado solo last_seen para {id}")
+                    logger.debug("[HEARTBEAT] Actualizado solo last_seen para %s", id)
                     return
             cursor.execute("UPDATE devices SET ip = ?, status = 'online', last_seen = ? WHERE id = ?", (ip, now, id))
             conn.commit()
-            print(f"[HEARTBEAT] Actualizado {id} como online con IP {ip}")
+            logger.debug("[HEARTBEAT] Actualizado %s como online con IP %s", id, ip)
     except Exception as ex:
-        print("Error al actualizar estado en DB:", ex)
+        logger.error("Error al actualizar estado en DB: %s", ex)
+
+@metrics.timed(DB_TIME)
+def upsert_devices(rows, allow_insert=False):
+    """
+    Aplica en una sola transacción un lote de anuncios de dispositivos.
+
+    rows: lista de tuplas (device_id, name, topic, ip, last_seen), un solo
+    elemento por device_id. Los existentes se marcan online y se actualizan;
+    los nuevos solo se insertan si allow_insert es True.
+
+    Retorna un dict con las listas de ids 'updated', 'inserted', 'skipped'
+    (nuevos no permitidos) y 'rejected' (violan alguna restricción, p. ej.
+    nombre repetido).
+    """
+    result = {'updated': [], 'inserted': [], 'skipped': [], 'rejected': []}
+    if not rows:
+        return result
+    with _versioned_connection(DEVICES_VERSION_KEY) as conn:
+        cursor = conn.cursor()
+        existing = set()
+        ids = [row[0] for row in rows]
+        # SQLite limita la cantidad de parámetros por consulta
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor.execute(f"SELECT id FROM devices WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            existing.update(r[0] for r in cursor.fetchall())
+
+        updates = [(name, topic, ip, last_seen, device_id)
+                   for device_id, name, topic, ip, last_seen in rows if device_id in existing]
+        inserts = [(device_id, name, topic, ip, last_seen)
+                   for device_id, name, topic, ip, last_seen in rows if device_id not in existing]
 
+        update_sql = "UPDATE devices SET name = ?, topic = ?, ip = ?, status = 'online', last_seen = ? WHERE id = ?"
+        insert_sql = """INSERT INTO devices (id, name, topic, ip, status, device_status, last_seen)
+                        VALUES (?, ?, ?, ?, 'online', 0, ?)"""
+
+        cursor.execute("SAVEPOINT batch_updates")
+        try:
+            cursor.executemany(update_sql, updates)
+            result['updated'] = [u[4] for u in updates]
+        except sqlite3.IntegrityError:
+            # Algún nombre choca con otro dispositivo: se reintenta fila por fila
+            cursor.execute("ROLLBACK TO batch_updates")
+            for params in updates:
+                try:
+                    cursor.execute(update_sql, params)
+                    result['updated'].append(params[4])
+                except sqlite3.IntegrityError:
+                    result['rejected'].append(params[4])
+
+        if not allow_insert:
+            result['skipped'] = [i[0] for i in inserts]
+        else:
+            cursor.execute("SAVEPOINT batch_inserts")
+            try:
+                cursor.executemany(insert_sql, inserts)
+                result['inserted'] = [i[0] for i in inserts]
+            except sqlite3.IntegrityError:
+                cursor.execute("ROLLBACK TO batch_inserts")
+                for params in inserts:
+                    try:
+                        cursor.execute(insert_sql, params)
+                        result['inserted'].append(params[0])
+                    except sqlite3.IntegrityError:
+                        result['rejected'].append(params[0])
+        conn.commit()
+    return result
+
+def _execute_batch(cursor, savepoint, sql, params, id_index):
+    """
+    executemany dentro de un savepoint; si alguna fila viola una restricción
+    se reintenta fila por fila. Retorna (ids aplicados, [(id, error)]).
+    """
+    cursor.execute(f"SAVEPOINT {savepoint}")
+    try:
+        cursor.executemany(sql, params)
+        return [p[id_index] for p in params], []
+    except sqlite3.IntegrityError:
+        cursor.execute(f"ROLLBACK TO {savepoint}")
+    applied, rejected = [], []
+    for p in params:
+        try:
+            cursor.execute(sql, p)
+            applied.append(p[id_index])
+        except sqlite3.IntegrityError as e:
+            rejected.append((p[id_index], str(e)))
+    return applied, rejected
+
+@metrics.timed(DB_TIME)
+def import_devices(rows, update=False):
+    """
+    Aplica en una sola transacción un bloque del inventario importado.
+
+    rows: lista de tuplas (device_id, name, topic, ip). Los nuevos se insertan
+    como offline; los existentes se omiten, o con update=True se les
+    actualiza nombre, tópico e IP (el estado no se toca).
+
+    Retorna un dict con las listas de ids 'inserted', 'updated', 'skipped' y
+    'rejected' (pares (id, error) de las filas que violan alguna restricción,
+    p. ej. nombre repetido).
+    """
+    result = {'inserted': [], 'updated': [], 'skipped': [], 'rejected': []}
+    if not rows:
+        return result
+    with _versioned_connection(DEVICES_VERSION_KEY) as conn:
+        cursor = conn.cursor()
+        existing = set()
+        ids = [row[0] for row in rows]
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            cursor.execute(f"SELECT id FROM devices WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            existing.update(r[0] for r in cursor.fetchall())
+
+        inserts = [row for row in rows if row[0] not in existing]
+        result['inserted'], rejected = _execute_batch(
+            cursor, 'import_inserts',
+            "INSERT INTO devices (id, name, topic, ip, status, device_status) VALUES (?, ?, ?, ?, 'offline', 0)",
+            inserts, 0)
+        result['rejected'].extend(rejected)
+
+        if update:
+            updates = [(name, topic, ip, device_id) for device_id, name, topic, ip in rows if device_id in existing]
+            result['updated'], rejected = _execute_batch(
+                cursor, 'import_updates', "UPDATE devices SET name = ?, topic = ?, ip = ? WHERE id = ?", updates, 3)
+            result['rejected'].extend(rejected)
+        else:
+            result['skipped'] = [row[0] for row in rows if row[0] in existing]
+        conn.commit()
+    return result
+
+def iter_devices(chunk_size=1000):
+    """
+    Recorre la tabla devices ordenada por id en bloques de chunk_size filas
+    (paginación por clave). Cada bloque es una consulta corta: entre bloques
+    no se retiene ninguna conexión del pool.
+    """
+    after = ''
+    while True:
+        with get_connection() as conn:
+            rows = conn.execute(
+                """SELECT id, name, topic, ip, status, device_status, last_seen FROM devices
+                   WHERE id > ? ORDER BY id LIMIT ?""", (after, chunk_size)).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][0]
+
+@metrics.timed(DB_TIME)
+def mark_devices_offline(device_ids, cutoff):
+    """
+    Marca como offline, con un solo UPDATE por bloque de ids, los dispositivos
+    vencidos que siguen online y cuyo last_seen no es posterior a cutoff (si
+    volvieron a anunciarse mientras tanto se dejan como están).
+
+    Retorna los ids que se marcaron.
+    """
+    marked = []
+    with _versioned_connection(DEVICES_VERSION_KEY) as conn:
+        cursor = conn.cursor()
+        for i in range(0, len(device_ids), 500):
+            chunk = device_ids[i:i + 500]
+            cursor.execute(
+                f"""UPDATE devices SET status = 'offline'
+                    WHERE status = 'online' AND (last_seen IS NULL OR last_seen <= ?)
+                    AND id IN ({','.join('?' * len(chunk))})
+                    RETURNING id""",
+                [cutoff, *chunk])
+            marked.extend(row[0] for row in cursor.fetchall())
+    return marked
+
+@metrics.timed(DB_TIME)
 def check_heartbeats(timeout=20):
-    now = int(time.time())
+    """
+    Barrido completo de respaldo: marca offline en un solo UPDATE a todos los
+    dispositivos online sin anuncios en los últimos `timeout` segundos.
+    La detección normal la hace heartbeat.HeartbeatMonitor.
+    """
+    cutoff = int(time.time()) - timeout
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _versioned_connection(DEVICES_VERSION_KEY) as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT id, last_seen FROM devices WHERE status = 'online'")
-            devices = cursor.fetchall()
-            for device in devices:
-                device_id, last_seen = device
-                if last_seen is None or (now - last_seen) > timeout:
-                    cursor.execute("UPDATE devices SET status = 'offline' WHERE id = ?", (device_id,))
-                    print(f"[HEARTBEAT] Dispositivo {device_id} marcado como offline (timeout)")
-            conn.commit()
+            cursor.execute("UPDATE devices SET status = 'offline' WHERE status = 'online' AND (last_seen IS NULL OR last_seen < ?)",
+                           (cutoff,))
+            if cursor.rowcount:
+                logger.info("[HEARTBEAT] %d dispositivos marcados como offline (timeout)", cursor.rowcount)
+            return cursor.rowcount
     except Exception as ex:
-        print("Error en check_heartbeats:", ex)
+        logger.error("Error en check_heartbeats: %s", ex)
+        return -3
 
 # Resto de funciones (update_device, delete_device, etc.) se mantienen...
+@metrics.timed(DB_TIME)
 def update_device(device_db_id, name=None, status=None, device_status=None):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _versioned_connection(DEVICES_VERSION_KEY) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM devices WHERE id = ?", (device_db_id,))
             device = cursor.fetchone()
@@ -96,12 +739,26 @@ def update_device(device_db_id, name=None, status=None, device_status=None):
             conn.commit()
             return 1
     except Exception as e:
-        print(f"Error updating device: {e}")
+        logger.error("Error updating device: %s", e)
         return -3
 
+@metrics.timed(DB_TIME)
+def update_devices_power_status(device_ids, device_status):
+    """Actualiza device_status de varios dispositivos con un UPDATE por bloque de ids."""
+    updated = 0
+    with _versioned_connection(DEVICES_VERSION_KEY) as conn:
+        cursor = conn.cursor()
+        for i in range(0, len(device_ids), 500):
+            chunk = device_ids[i:i + 500]
+            cursor.execute(f"UPDATE devices SET device_status = ? WHERE id IN ({','.join('?' * len(chunk))})",
+                           [device_status, *chunk])
+            updated += cursor.rowcount
+    return updated
+
+@metrics.timed(DB_TIME)
 def delete_device(device_db_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with _versioned_connection(DEVICES_VERSION_KEY) as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM devices WHERE id = ?", (device_db_id,))
             device = cursor.fetchone()
@@ -111,14 +768,15 @@ def delete_device(device_db_id):
             conn.commit()
             return 1
     except Exception as e:
-        print(f"Error deleting device: {e}")
+        logger.error("Error deleting device: %s", e)
         return -3
 
+@metrics.timed(DB_TIME)
 def update_device_connection_status(device_db_id, status):
     try:
         if status not in ["online", "offline"]:
             raise ValueError("Estado inválido. Debe ser 'online' o 'offline'.")
-        with sqlite3.connect(DB_NAME) as conn:
+        with _versioned_connection(DEVICES_VERSION_KEY) as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE devices SET status = ? WHERE id = ?", (status, device_db_id))
             if cursor.rowcount == 0:
@@ -126,13 +784,14 @@ def update_device_connection_status(device_db_id, status):
             conn.commit()
             return 1
     except Exception as e:
-        print(f"Error updating device connection status: {e}")
+        logger.error("Error updating device connection status: %s", e)
         return -3
 
+@metrics.timed(DB_TIME)
 def get_all_devices_status():
     devices = []
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT id, name, topic, status, device_status FROM devices")
             rows = cursor.fetchall()
@@ -145,53 +804,69 @@ def get_all_devices_status():
                     "device_status": row[4]
                 })
     except Exception as e:
-        print(f"Error fetching devices: {e}")
+        logger.error("Error fetching devices: %s", e)
     return devices
 
+@metrics.timed(DB_TIME)
+def get_all_devices():
+    """
+    Retorna todas las filas de la tabla devices como diccionarios con las
+    columnas completas. Lo usa DeviceRegistry para cargarse al iniciar.
+    """
+    with get_connection() as conn:
+        cursor = conn.cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT id, name, topic, ip, status, device_status, last_seen FROM devices ORDER BY rowid")
+        return [dict(row) for row in cursor.fetchall()]
+
 
+@metrics.timed(DB_TIME)
 def get_device_status_by_id(device_db_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM devices WHERE id = ?", (device_db_id,))
             device = cursor.fetchone()
             return device if device else None
     except Exception as e:
-        print(f"Error fetching device status: {e}")
+        logger.error("Error fetching device status: %s", e)
         return None 
 
+@metrics.timed(DB_TIME)
 def get_device_connection_status(device_db_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT status FROM devices WHERE id = ?", (device_db_id,))
             device = cursor.fetchone()
             return device[0] if device else None
     except Exception as e:
-        print(f"Error fetching device connection status: {e}")
+        logger.error("Error fetching device connection status: %s", e)
         return None
 
+@metrics.timed(DB_TIME)
 def get_device_power_status(device_db_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
+        with get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT device_status FROM devices WHERE id = ?", (device_db_id,))
             device = cursor.fetchone()
             return device[0] if device else None
     except Exception as e:
-        print(f"Error fetching device status: {e}")
+        logger.error("Error fetching device status: %s", e)
         return None
 
+@metrics.timed(DB_TIME)
 def get_device_status(device_db_id):
     try:
-        with sqlite3.connect(DB_NAME) as conn:
-            conn.row_factory = sqlite3.Row
+        with get_connection() as conn:
             cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
             cursor.execute("SELECT * FROM devices WHERE id = ?", (device_db_id,))
             device = cursor.fetchone()
             return dict(device) if device else None
     except Exception as e:
-        print(f"Error fetching device info: {e}")
+        logger.error("Error fetching device info: %s", e)
         return None
 
 if __name__ == '__main__':
@@ -0,0 +1,55 @@
+import queue
+import threading
+
+# Máximo de eventos pendientes por suscriptor antes de pedirle una resincronización
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+
+class EventHub:
+    """
+    Reparte los eventos de cambio de dispositivos a los suscriptores (p. ej.
+    cada navegador conectado a /devices/stream).
+
+    publish() nunca bloquea: si un suscriptor se queda atrás se vacía su cola y
+    se le envía un evento "resync" para que vuelva a pedir el estado completo.
+    """
+
+    def __init__(self, queue_size=SUBSCRIBER_QUEUE_SIZE):
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._queue_size = queue_size
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=self._queue_size)
+        with self._lock:
+            self._subscribers.add(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                self._resync(q)
+
+    @staticmethod
+    def _resync(q):
+        while True:
+            try:
+                q.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            q.put_nowait({'type': 'resync'})
+        except queue.Full:
+            pass
@@ -0,0 +1,299 @@
+import bisect
+import threading
+import time
+from collections import OrderedDict
+
+import database as dbm
+from heartbeat import group_from_topic
+
+# Campos cuyo cambio se notifica a los suscriptores (last_seen cambia con cada
+# anuncio y no genera evento por sí solo)
+EVENT_FIELDS = ('name', 'topic', 'ip', 'status', 'device_status')
+
+# Cantidad de bajas recordadas para las consultas ?since=
+MAX_TOMBSTONES = 10000
+
+
+class DeviceRegistry:
+    """
+    Copia en memoria de la tabla devices.
+
+    Se carga una vez al iniciar y se mantiene al día con escritura directa
+    (write-through): quien modifica la BD (ingest, alta, baja y comandos de
+    encendido) actualiza también el registro. Las lecturas de /devices y la
+    búsqueda de tópicos para publicar no tocan SQLite.
+
+    Si se pasa un EventHub, cada alta, baja o cambio relevante se publica como
+    evento ("upsert", "delete" o "resync" tras una recarga completa).
+
+    Cada cambio relevante incrementa una versión monotónica que nunca queda
+    detrás del reloj (ms), así sigue creciendo entre reinicios y es comparable
+    entre workers; los clientes con una versión anterior a la carga reciben la
+    lista completa.
+    """
+
+    def __init__(self, events=None):
+        self._lock = threading.RLock()
+        self._devices = {}
+        self._events = events
+        self._version = 0
+        # Versión mínima desde la que se pueden calcular deltas
+        self._floor = 0
+        # device_id -> versión del último cambio, ordenado por versión
+        self._changed = OrderedDict()
+        # device_id -> versión en que se eliminó
+        self._tombstones = OrderedDict()
+        # device_id -> instante (monotónico) de la última escritura local
+        self._modified = {}
+        # Ids ordenados para la paginación por cursor (keyset) de query()
+        self._sorted_ids = []
+
+    def load(self):
+        """Carga (o recarga) todos los dispositivos desde la BD."""
+        devices = dbm.get_all_devices()
+        with self._lock:
+            self._version = self._next_version()
+            self._floor = self._version
+            self._devices = {device['id']: device for device in devices}
+            self._sorted_ids = sorted(self._devices)
+            self._changed = OrderedDict((device['id'], self._version) for device in devices)
+            self._tombstones.clear()
+            self._emit({'type': 'resync'})
+        return len(devices)
+
+    def refresh(self):
+        """
+        Vuelve a leer la BD y aplica solo las diferencias, emitiendo los eventos
+        correspondientes. Se usa cuando otro proceso escribe la tabla.
+
+        Los dispositivos escritos localmente después de empezar la lectura se
+        dejan como están: la copia en memoria es más nueva que la leída.
+        """
+        started = time.monotonic()
+        devices = dbm.get_all_devices()
+        seen = set()
+        with self._lock:
+            for device in devices:
+                seen.add(device['id'])
+                if self._modified.get(device['id'], 0) <= started:
+                    self.upsert(device['id'], **device)
+            missing = [device_id for device_id in self._devices
+                       if device_id not in seen and self._modified.get(device_id, 0) <= started]
+            for device_id in missing:
+                self.remove(device_id)
+
+    def invalidate(self, device_id=None):
+        """
+        Descarta el contenido en memoria y lo vuelve a leer de la BD. Con
+        device_id solo se refresca ese dispositivo.
+        """
+        if device_id is None:
+            return self.load()
+        device = dbm.get_device_status(device_id)
+        if device is None:
+            self.remove(device_id)
+            return 0
+        self.upsert(device_id, **device)
+        return 1
+
+    # ----------------------------------------------------------
+    # Lecturas
+
+    def all(self):
+        with self._lock:
+            return [dict(device) for device in self._devices.values()]
+
+    def snapshot(self):
+        """Retorna (version, dispositivos) tomados de forma atómica."""
+        with self._lock:
+            return self._version, self.all()
+
+    def columns(self, fields):
+        """
+        Retorna (version, {campo: [valores]}) ordenados por id, tomados de forma
+        atómica. Solo se copian referencias a los valores, no un dict por
+        dispositivo.
+        """
+        with self._lock:
+            devices = [self._devices[device_id] for device_id in self._sorted_ids]
+            return self._version, {field: [device[field] for device in devices] for field in fields}
+
+    def get(self, device_id):
+        with self._lock:
+            device = self._devices.get(device_id)
+            return dict(device) if device else None
+
+    def topic_for(self, device_id):
+        with self._lock:
+            device = self._devices.get(device_id)
+            return device['topic'] if device else None
+
+    def topics_for(self, device_ids):
+        """Retorna {device_id: topic} para los ids conocidos, en una sola pasada."""
+        with self._lock:
+            return {device_id: self._devices[device_id]['topic']
+                    for device_id in device_ids if device_id in self._devices}
+
+    def devices_in_topic(self, topic):
+        """Retorna los ids de los dispositivos suscritos a un tópico."""
+        with self._lock:
+            return [device_id for device_id, device in self._devices.items() if device['topic'] == topic]
+
+    def status_counts(self):
+        """Retorna {status: cantidad} sin copiar los dispositivos."""
+        counts = {}
+        with self._lock:
+            for device in self._devices.values():
+                counts[device['status']] = counts.get(device['status'], 0) + 1
+        return counts
+
+    def desired_power_states(self):
+        """Retorna {device_id: ('on'|'off', topic)} de los dispositivos online."""
+        with self._lock:
+            return {device_id: ('on' if device['device_status'] == 1 else 'off', device['topic'])
+                    for device_id, device in self._devices.items() if device['status'] == 'online'}
+
+    def summary(self):
+        """
+        Retorna {'total', 'status': {status: n}, 'groups': {grupo: {status: n}}}
+        sin copiar los dispositivos.
+        """
+        status_counts = {}
+        groups = {}
+        with self._lock:
+            for device in self._devices.values():
+                status = device['status']
+                status_counts[status] = status_counts.get(status, 0) + 1
+                group = groups.setdefault(group_from_topic(device['topic']), {})
+                group[status] = group.get(status, 0) + 1
+            total = len(self._devices)
+        return {'total': total, 'status': status_counts, 'groups': groups}
+
+    def query(self, status=None, group=None, text=None, limit=100, after=None):
+        """
+        Página de dispositivos ordenados por id que cumplen los filtros, a
+        partir del id siguiente a `after` (paginación por cursor: el resultado
+        no se corre si entre páginas se agregan o eliminan dispositivos).
+
+        text busca sin distinguir mayúsculas en id, nombre e IP.
+        Retorna (dispositivos, último id si hay más resultados o None).
+        """
+        text = text.lower() if text else None
+        page = []
+        with self._lock:
+            start = bisect.bisect_right(self._sorted_ids, after) if after is not None else 0
+            for index in range(start, len(self._sorted_ids)):
+                device = self._devices[self._sorted_ids[index]]
+                if status is not None and device['status'] != status:
+                    continue
+                if group is not None and group_from_topic(device['topic']) != group:
+                    continue
+                if text and not (text in device['id'].lower() or text in (device['name'] or '').lower()
+                                 or text in (device['ip'] or '')):
+                    continue
+                if len(page) == limit:
+                    return page, page[-1]['id']
+                page.append(dict(device))
+        return page, None
+
+    def __len__(self):
+        with self._lock:
+            return len(self._devices)
+
+    @property
+    def version(self):
+        with self._lock:
+            return self._version
+
+    def changes_since(self, since, slack_ms=0):
+        """
+        Retorna (version, full, devices, deleted) con los dispositivos cambiados
+        y los ids eliminados después de `since`. Si `since` es anterior a lo que
+        se puede reconstruir (o posterior a la versión actual) se devuelve la
+        lista completa con full=True.
+
+        slack_ms reenvía también los cambios de los últimos milisegundos antes de
+        `since`; con varios workers cubre el retraso con que cada uno ve los
+        cambios de los demás (un cambio repetido es inofensivo para el cliente).
+
+        El costo es proporcional a la cantidad de cambios, no al tamaño de la flota.
+        """
+        with self._lock:
+            if since < self._floor or since > self._version:
+                return self._version, True, self.all(), []
+            since = max(since - slack_ms, 0)
+            devices = []
+            for device_id, version in reversed(self._changed.items()):
+                if version <= since:
+                    break
+                devices.append(dict(self._devices[device_id]))
+            deleted = []
+            for device_id, version in reversed(self._tombstones.items()):
+                if version <= since:
+                    break
+                deleted.append(device_id)
+            devices.reverse()
+            deleted.reverse()
+            return self._version, False, devices, deleted
+
+    # ----------------------------------------------------------
+    # Escrituras (la BD ya fue actualizada por quien llama)
+
+    def upsert(self, device_id, **fields):
+        with self._lock:
+            self._modified[device_id] = time.monotonic()
+            device = self._devices.get(device_id)
+            if device is None:
+                device = {'id': device_id, 'name': device_id, 'topic': None, 'ip': '',
+                          'status': 'offline', 'device_status': 0, 'last_seen': None}
+                self._devices[device_id] = device
+                bisect.insort(self._sorted_ids, device_id)
+                changes = list(EVENT_FIELDS)
+            else:
+                changes = [f for f in EVENT_FIELDS if f in fields and fields[f] != device[f]]
+            device.update(fields)
+            if changes:
+                self._bump(device_id)
+                self._tombstones.pop(device_id, None)
+                self._emit({'type': 'upsert', 'device': dict(device), 'changes': changes})
+
+    def remove(self, device_id):
+        with self._lock:
+            removed = self._devices.pop(device_id, None) is not None
+            if removed:
+                index = bisect.bisect_left(self._sorted_ids, device_id)
+                del self._sorted_ids[index]
+                self._modified[device_id] = time.monotonic()
+                self._changed.pop(device_id, None)
+                self._version = self._next_version()
+                self._tombstones[device_id] = self._version
+                self._tombstones.move_to_end(device_id)
+                if len(self._tombstones) > MAX_TOMBSTONES:
+                    oldest_id, oldest = self._tombstones.popitem(last=False)
+                    if oldest_id not in self._devices:
+                        self._modified.pop(oldest_id, None)
+                    # Ya no se puede saber qué se eliminó antes de `oldest`
+                    self._floor = max(self._floor, oldest)
+                self._emit({'type': 'delete', 'id': device_id})
+            return removed
+
+    def _next_version(self):
+        return max(self._version + 1, int(time.time() * 1000))
+
+    def _bump(self, device_id):
+        self._version = self._next_version()
+        self._changed[device_id] = self._version
+        self._changed.move_to_end(device_id)
+
+    def _emit(self, event):
+        # Se llama con el lock tomado para que los eventos salgan en orden
+        if self._events is not None:
+            self._events.publish(event)
+
+    def apply_announcements(self, announcements, result):
+        """Callback on_flush de IngestQueue: refleja el lote ya escrito en la BD."""
+        written = set(result['updated']) | set(result['inserted'])
+        for a in announcements:
+            if a.device_id in written:
+                self.upsert(a.device_id, name=a.name, topic=a.topic, ip=a.ip,
+                            status='online', last_seen=int(a.received_at))
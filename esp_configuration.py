@@ -1,12 +1,66 @@
-import sys
+"""
+Configuración de ESP nuevos (modo AP) con trabajos en segundo plano.
+
+POST /configure crea un trabajo y lo encola; un número fijo de hilos
+(PROVISION_WORKERS) los atiende. Cada hilo reutiliza su propia
+requests.Session con timeouts y reintentos. Todos los ESP en modo AP
+responden en la misma dirección (ESP_IP), así que los trabajos de una misma
+dirección se ejecutan de a uno, también entre workers (lease en app_state):
+dos trabajos en paralelo configurarían el mismo ESP y el segundo pisaría al
+primero. El estado de cada trabajo se guarda en la tabla provisioning_jobs
+para consultarlo con GET /configure/<job_id> desde cualquier worker.
+
+Estados: queued -> connecting -> sending -> succeeded | failed
+"""
+import contextlib
+import logging
 import os
-import time
+import queue
 import subprocess
-import requests
 import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import database as dbm
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # Dirección IP del ESP en modo AP
-ESP_IP = "http://192.168.4.1"
+ESP_IP = os.getenv('ESP_IP', "http://192.168.4.1")
+
+# Más de un hilo solo sirve si los trabajos usan direcciones distintas
+PROVISION_WORKERS = int(os.getenv('PROVISION_WORKERS', 1))
+PROVISION_QUEUE_SIZE = int(os.getenv('PROVISION_QUEUE_SIZE', 50))
+# Timeouts (s) de conexión y lectura de cada request al ESP
+ESP_CONNECT_TIMEOUT = float(os.getenv('ESP_CONNECT_TIMEOUT', 3))
+ESP_READ_TIMEOUT = float(os.getenv('ESP_READ_TIMEOUT', 10))
+# Reintentos de cada request (errores de conexión y respuestas 5xx)
+ESP_RETRIES = int(os.getenv('ESP_RETRIES', 3))
+# Tiempo máximo (s) esperando que el ESP responda antes de enviar la configuración
+ESP_WAIT_TIMEOUT = float(os.getenv('ESP_WAIT_TIMEOUT', 20))
+# Vigencia (s) del lease de una dirección; cubre la espera, los reintentos y el POST
+ESP_LEASE_TTL = ESP_WAIT_TIMEOUT + (ESP_RETRIES + 1) * (ESP_CONNECT_TIMEOUT + ESP_READ_TIMEOUT) + 30
+# Días que se conservan los trabajos terminados
+PROVISION_JOB_RETENTION_DAYS = int(os.getenv('PROVISION_JOB_RETENTION_DAYS', 7))
+
+QUEUED = 'queued'
+CONNECTING = 'connecting'
+SENDING = 'sending'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+ACTIVE_STATES = (QUEUED, CONNECTING, SENDING)
+
+JOBS = metrics.counter('iot_provisioning_jobs_total', 'Trabajos de configuración de ESP por resultado', ['result'])
+
+
+class ProvisioningQueueFull(Exception):
+    """Hay PROVISION_QUEUE_SIZE trabajos esperando; se debe reintentar más tarde."""
+
 
 def get_current_ssid():
     try:
@@ -17,48 +71,164 @@ def get_current_ssid():
                 ssid = line.split(":", 1)[1].strip()
                 return ssid
     except Exception as e:
-        print(f"\nError al obtener el SSID actual: {str(e)}\n")
+        logger.error("Error al obtener el SSID actual: %s", e)
     return None
 
-def wait_for_esp_connection(timeout=20):
-    print("\nVerificando conexión con el ESP...\n")
-    for _ in range(timeout):
+
+def new_session(retries=ESP_RETRIES):
+    """Session con reintentos (backoff exponencial) también para POST: /setup es idempotente."""
+    retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=0.5,
+                  status_forcelist=(500, 502, 503, 504), allowed_methods=None, raise_on_status=False)
+    session = requests.Session()
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def wait_for_esp_connection(session, esp_ip=ESP_IP, timeout=ESP_WAIT_TIMEOUT):
+    """
+    Consulta el ESP hasta que responda o pase `timeout` segundos. Cualquier
+    respuesta HTTP cuenta: el firmware no tiene por qué atender "/".
+    """
+    logger.info("Verificando conexión con el ESP %s", esp_ip)
+    deadline = time.monotonic() + timeout
+    while True:
         try:
-            response = requests.get(ESP_IP, timeout=2)
-            if response.status_code == 200:
-                print("\nConexión establecida con el ESP.\n")
-                return True
-        except requests.ConnectionError:
-            print("Esperando conexión con el ESP...")
-            time.sleep(1)
-    print("\nNo se pudo conectar con el ESP. Verifica la red.\n")
+            response = session.get(esp_ip, timeout=(ESP_CONNECT_TIMEOUT, ESP_READ_TIMEOUT))
+            logger.info("Conexión establecida con el ESP %s (HTTP %s)", esp_ip, response.status_code)
+            return True
+        except requests.RequestException as e:
+            logger.debug("Esperando conexión con el ESP %s: %s", esp_ip, e)
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(1)
+    logger.warning("El ESP %s no respondió en %.0f s", esp_ip, timeout)
     return False
 
-def send_wifi_to_esp(ssid, password, grupo, name):
+
+def send_wifi_to_esp(session, ssid, password, grupo, name, esp_ip=ESP_IP):
     """
     Envía los datos de la red Wi-Fi al ESP a través de un POST a la ruta /setup.
-    Se envían los parámetros: ssid, password, grupo y name.
+    Se envían los parámetros: ssid, password, grupo y nombre.
+    Retorna (ok, mensaje).
     """
+    logger.info("Enviando configuración Wi-Fi al ESP %s: ssid=%s grupo=%s nombre=%s", esp_ip, ssid, grupo, name)
     try:
-        print(f"\nEnviando configuración Wi-Fi al ESP: {ssid}, {password}, {grupo}, {name}\n")
-        response = requests.post(f"{ESP_IP}/setup", data={'ssid': ssid, 'password': password, 'grupo': grupo, 'nombre': name}) # Include 'nombre'
-        if response.status_code == 200:
-            print("\nConfiguración enviada con éxito al ESP.\n")
-        else:
-            print(f"\nError al enviar configuración al ESP: {response.status_code}\n")
-    except Exception as e:
-        print(f"\nError al intentar enviar configuración al ESP: {str(e)}\n")
+        response = session.post(f"{esp_ip}/setup",
+                                data={'ssid': ssid, 'password': password, 'grupo': grupo, 'nombre': name},
+                                timeout=(ESP_CONNECT_TIMEOUT, ESP_READ_TIMEOUT))
+    except requests.RequestException as e:
+        return False, f"Error al intentar enviar configuración al ESP: {e}"
+    if response.status_code == 200:
+        return True, "Configuración enviada con éxito al ESP."
+    return False, f"Error al enviar configuración al ESP: HTTP {response.status_code}"
 
-def process_configuration(original_ssid, original_password, grupo, name):
-    """
-    Envía la configuración al ESP sin esperar por la red o la conexión.
-    """
-    send_wifi_to_esp(original_ssid, original_password, grupo, name) # Pass the name
 
-def configure_esp(ssid, password, grupo, name):
+class Provisioner:
     """
-    Función pública para iniciar la configuración del ESP.
-    Se lanza en un hilo para no bloquear la respuesta del endpoint.
+    Cola acotada de trabajos de configuración atendida por `workers` hilos.
+    submit() no bloquea: si la cola está llena lanza ProvisioningQueueFull.
+    Las credenciales solo viven en memoria mientras el trabajo espera.
     """
-    threading.Thread(target=process_configuration, args=(ssid, password, grupo, name)).start() # Pass the name
-    return "Configuración iniciada, espere por favor..."
\ No newline at end of file
+
+    def __init__(self, workers=PROVISION_WORKERS, maxsize=PROVISION_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._workers = workers
+        self._threads = []
+        self._local = threading.local()
+        self._target_locks = {}
+        self._target_locks_lock = threading.Lock()
+
+    def start(self):
+        if not self._threads:
+            self._cleanup()
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._run, name=f'provisioning-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        """Los hilos terminan después del trabajo en curso; lo que siga en cola se pierde."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def submit(self, ssid, password, grupo, name, esp_ip=ESP_IP):
+        """Crea el trabajo en la BD, lo encola y retorna su id."""
+        job_id = uuid.uuid4().hex
+        dbm.create_provisioning_job(job_id, name, grupo, esp_ip, QUEUED)
+        try:
+            self._queue.put_nowait((job_id, ssid, password, grupo, name, esp_ip))
+        except queue.Full:
+            dbm.update_provisioning_job(job_id, FAILED, "Cola de configuración llena")
+            JOBS.inc('rejected')
+            raise ProvisioningQueueFull(f"Hay {self._queue.qsize()} configuraciones en espera")
+        return job_id
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(), 'workers': len(self._threads)}
+
+    def _sessions(self):
+        # Por hilo: una sin reintentos para sondear (el bucle ya reintenta)
+        # y otra con reintentos para enviar la configuración
+        sessions = getattr(self._local, 'sessions', None)
+        if sessions is None:
+            sessions = self._local.sessions = (new_session(retries=0), new_session())
+        return sessions
+
+    def _cleanup(self):
+        # Trabajos que quedaron a medias porque su proceso se detuvo
+        stale = dbm.fail_stale_provisioning_jobs(ACTIVE_STATES, time.time() - 3600, "Interrumpido (el servidor se reinició)")
+        removed = dbm.delete_provisioning_jobs_before(time.time() - PROVISION_JOB_RETENTION_DAYS * 86400)
+        if stale or removed:
+            logger.info("Trabajos de configuración: %d interrumpidos, %d eliminados por antigüedad", stale, removed)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._process(*item)
+            except Exception as e:
+                logger.exception("Error en el trabajo de configuración %s: %s", item[0], e)
+                dbm.update_provisioning_job(item[0], FAILED, f"Error interno: {e}")
+                JOBS.inc(FAILED)
+
+    @contextlib.contextmanager
+    def _exclusive(self, job_id, esp_ip):
+        """Un trabajo a la vez por dirección: lock entre hilos y lease entre workers."""
+        with self._target_locks_lock:
+            lock = self._target_locks.setdefault(esp_ip, threading.Lock())
+        with lock:
+            lease = f"esp:{esp_ip}"
+            while not dbm.try_acquire_lease(lease, job_id, ESP_LEASE_TTL):
+                time.sleep(0.5)
+            try:
+                yield
+            finally:
+                dbm.release_lease(lease, job_id)
+
+    def _process(self, job_id, ssid, password, grupo, name, esp_ip):
+        with self._exclusive(job_id, esp_ip):
+            self._configure(job_id, ssid, password, grupo, name, esp_ip)
+
+    def _configure(self, job_id, ssid, password, grupo, name, esp_ip):
+        probe_session, session = self._sessions()
+        dbm.update_provisioning_job(job_id, CONNECTING, "Esperando conexión con el ESP")
+        if wait_for_esp_connection(probe_session, esp_ip):
+            dbm.update_provisioning_job(job_id, SENDING, "Enviando configuración al ESP")
+        else:
+            # El sondeo solo sirve para esperar a que el ESP levante su AP: sin
+            # respuesta se envía igual, como antes (la sesión reintenta el POST)
+            dbm.update_provisioning_job(job_id, SENDING,
+                                        "El ESP no respondió al sondeo; enviando configuración de todos modos")
+        ok, message = send_wifi_to_esp(session, ssid, password, grupo, name, esp_ip)
+        state = SUCCEEDED if ok else FAILED
+        dbm.update_provisioning_job(job_id, state, message)
+        JOBS.inc(state)
+        logger.log(logging.INFO if ok else logging.WARNING, "Trabajo de configuración %s (%s): %s", job_id, name, message)
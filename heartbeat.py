@@ -0,0 +1,166 @@
+import heapq
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Segundos sin anuncios antes de marcar un dispositivo como offline
+HEARTBEAT_TIMEOUT = int(os.getenv('HEARTBEAT_TIMEOUT', 20))
+# Timeouts por grupo, por ejemplo "parque:60,avenida:30"
+HEARTBEAT_GROUP_TIMEOUTS = os.getenv('HEARTBEAT_GROUP_TIMEOUTS', '')
+
+
+def parse_group_timeouts(spec):
+    """Convierte "grupo:segundos,grupo2:segundos" en un dict {grupo: segundos}."""
+    timeouts = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        group, _, seconds = item.rpartition(':')
+        if not group:
+            raise ValueError(f"Timeout de grupo inválido: '{item}' (se espera grupo:segundos)")
+        timeouts[group.strip()] = int(seconds)
+    return timeouts
+
+
+def group_from_topic(topic):
+    """Extrae el grupo de un tópico "streelet/{group}"."""
+    if not topic:
+        return None
+    return topic.split('/', 1)[1] if '/' in topic else topic
+
+
+class HeartbeatMonitor:
+    """
+    Detecta dispositivos que dejaron de anunciarse sin recorrer la tabla.
+
+    Cada dispositivo online tiene un vencimiento (último anuncio + timeout de su
+    grupo) en un heap ordenado por vencimiento. Cuando el vencimiento se
+    atrasa, touch() solo lo actualiza en un dict y, cuando la entrada del heap
+    llega a la cima, se reprograma; si se adelanta (otro grupo, un anuncio
+    más viejo) se agrega una entrada nueva. _scheduled guarda el vencimiento
+    de la entrada vigente de cada dispositivo y las demás se descartan al
+    salir del heap. Así cada revisión cuesta del orden de los dispositivos que
+    vencen, no de todos los que están online.
+
+    on_expired(device_ids, cutoff) recibe los ids vencidos en un solo lote;
+    cutoff es el last_seen máximo que todavía cuenta como vencido.
+    """
+
+    def __init__(self, default_timeout=HEARTBEAT_TIMEOUT, group_timeouts=None, on_expired=None):
+        self._default_timeout = default_timeout
+        self._group_timeouts = dict(group_timeouts or {})
+        self._on_expired = on_expired
+        self._cond = threading.Condition()
+        self._heap = []
+        self._deadlines = {}
+        self._scheduled = {}
+        self._thread = None
+        self._running = False
+        self._stats = {'expired': 0, 'sweeps': 0, 'last_sweep_ms': 0.0, 'errors': 0}
+
+    def timeout_for(self, group):
+        return self._group_timeouts.get(group, self._default_timeout)
+
+    def touch(self, device_id, group=None, seen_at=None):
+        """Registra un anuncio del dispositivo y mueve su vencimiento."""
+        if seen_at is None:
+            seen_at = time.time()
+        deadline = seen_at + self.timeout_for(group)
+        with self._cond:
+            self._deadlines[device_id] = deadline
+            scheduled = self._scheduled.get(device_id)
+            if scheduled is None or deadline < scheduled:
+                self._schedule(device_id, deadline)
+                if self._heap[0][1] == device_id:
+                    self._cond.notify()
+
+    def forget(self, device_id):
+        """Deja de vigilar un dispositivo (p. ej. al eliminarlo)."""
+        with self._cond:
+            self._deadlines.pop(device_id, None)
+            self._scheduled.pop(device_id, None)
+            if len(self._heap) > 2 * len(self._scheduled) + 64:
+                # Demasiadas entradas descartadas: se rearma el heap con las vigentes
+                self._heap = [(deadline, device_id) for device_id, deadline in self._scheduled.items()]
+                heapq.heapify(self._heap)
+
+    def _schedule(self, device_id, deadline):
+        # Se llama con el lock tomado
+        self._scheduled[device_id] = deadline
+        heapq.heappush(self._heap, (deadline, device_id))
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name='heartbeat-monitor', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        if self._thread is not None:
+            with self._cond:
+                self._running = False
+                self._cond.notify()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['tracked'] = len(self._deadlines)
+        return stats
+
+    def _pop_expired(self, now):
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            scheduled, device_id = heapq.heappop(self._heap)
+            if self._scheduled.get(device_id) != scheduled:
+                # Entrada reemplazada por un vencimiento anterior o de un
+                # dispositivo olvidado
+                continue
+            del self._scheduled[device_id]
+            deadline = self._deadlines.get(device_id)
+            if deadline is None:
+                continue
+            if deadline > now:
+                # Se volvió a anunciar: se reprograma con su vencimiento real
+                self._schedule(device_id, deadline)
+            else:
+                del self._deadlines[device_id]
+                expired.append(device_id)
+        return expired
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    timeout = self._heap[0][0] - now if self._heap else None
+                    self._cond.wait(timeout)
+                if not self._running:
+                    return
+                start = time.perf_counter()
+                now = time.time()
+                expired = self._pop_expired(now)
+
+            if expired and self._on_expired is not None:
+                # Un anuncio más reciente que el timeout mínimo significa que el
+                # dispositivo revivió mientras se procesaba el lote
+                cutoff = int(now) - min([self._default_timeout, *self._group_timeouts.values()])
+                try:
+                    self._on_expired(expired, cutoff)
+                except Exception as e:
+                    logger.exception("[HEARTBEAT] Error al marcar dispositivos offline: %s", e)
+                    with self._cond:
+                        self._stats['errors'] += 1
+
+            with self._cond:
+                self._stats['sweeps'] += 1
+                self._stats['expired'] += len(expired)
+                self._stats['last_sweep_ms'] = (time.perf_counter() - start) * 1000.0
@@ -0,0 +1,501 @@
+import calendar
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+import database as dbm
+
+logger = logging.getLogger(__name__)
+
+# Base separada para el historial, así la tabla devices no crece ni se frena
+HISTORY_DB_NAME = os.getenv('HISTORY_DB_NAME', 'history.db')
+HISTORY_FLUSH_MS = int(os.getenv('HISTORY_FLUSH_MS', 1000))
+HISTORY_QUEUE_SIZE = int(os.getenv('HISTORY_QUEUE_SIZE', 10000))
+# Eventos que se conservan para reintentar mientras la escritura falla (los más viejos se descartan)
+HISTORY_MAX_PENDING_EVENTS = int(os.getenv('HISTORY_MAX_PENDING_EVENTS', 100000))
+# Cada cuántos segundos se acumula el tiempo online de los que siguen online
+HISTORY_CHECKPOINT_S = int(os.getenv('HISTORY_CHECKPOINT_S', 300))
+# Retención (días) de los eventos crudos y de cada nivel de rollup
+HISTORY_RAW_DAYS = int(os.getenv('HISTORY_RAW_DAYS', 90))
+HISTORY_HOURLY_DAYS = int(os.getenv('HISTORY_HOURLY_DAYS', 90))
+HISTORY_DAILY_DAYS = int(os.getenv('HISTORY_DAILY_DAYS', 730))
+
+HOUR = 3600
+DAY = 86400
+RESOLUTIONS = {'hour': HOUR, 'day': DAY}
+
+OFFLINE = 0
+ONLINE = 1
+
+# Tablas particionadas por tiempo (UTC): prefijo -> formato del sufijo
+PARTITIONS = {'events': '%Y%m', 'uptime_hourly': '%Y%m', 'uptime_daily': '%Y'}
+ROLLUP_TABLES = {HOUR: 'uptime_hourly', DAY: 'uptime_daily'}
+
+
+def partition_name(prefix, ts):
+    return f"{prefix}_{time.strftime(PARTITIONS[prefix], time.gmtime(ts))}"
+
+
+def partition_range(name):
+    """Retorna (inicio, fin) en epoch de la partición "prefijo_AAAAMM" o "prefijo_AAAA"."""
+    suffix = name.rsplit('_', 1)[1]
+    year = int(suffix[:4])
+    if len(suffix) == 6:
+        month = int(suffix[4:])
+        start = calendar.timegm((year, month, 1, 0, 0, 0))
+        end = calendar.timegm((year + month // 12, month % 12 + 1, 1, 0, 0, 0))
+    else:
+        start = calendar.timegm((year, 1, 1, 0, 0, 0))
+        end = calendar.timegm((year + 1, 1, 1, 0, 0, 0))
+    return start, end
+
+
+class HistoryStore:
+    """
+    Historial de estado de los dispositivos en HISTORY_DB_NAME.
+
+    - device_keys asigna un entero a cada device_id; el resto de las tablas
+      solo guarda ese entero.
+    - events_AAAAMM: transiciones online/offline y cambios de IP (solo append).
+    - uptime_hourly_AAAAMM / uptime_daily_AAAA: segundos online y caídas por
+      dispositivo y hora/día. Las consultas leen de aquí, no de los eventos.
+    - device_state: último estado conocido, para continuar tras un reinicio.
+
+    La retención borra particiones completas con DROP TABLE en lugar de
+    DELETE fila por fila.
+    """
+
+    def __init__(self, db_name=HISTORY_DB_NAME):
+        self.db_name = db_name
+        self._local = threading.local()
+        self._partitions = set()
+        self._partitions_lock = threading.Lock()
+
+    def connection(self):
+        """Conexión propia de cada hilo (lecturas de Flask y el hilo escritor)."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_name, timeout=dbm.DB_BUSY_TIMEOUT,
+                                   check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            self._local.conn = conn
+        return conn
+
+    def init(self):
+        conn = self.connection()
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS device_keys (
+                    device_key INTEGER PRIMARY KEY,
+                    device_id TEXT NOT NULL UNIQUE
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS device_state (
+                    device_key INTEGER PRIMARY KEY,
+                    status INTEGER NOT NULL,
+                    ip TEXT,
+                    accounted_until INTEGER NOT NULL
+                )
+            ''')
+        self._partitions = set(self._existing_partitions(conn))
+        return self.db_name
+
+    # ----------------------------------------------------------
+    # Particiones
+
+    @staticmethod
+    def _existing_partitions(conn, prefix=None):
+        names = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        prefixes = [prefix] if prefix else list(PARTITIONS)
+        return [name for name in names
+                if any(name.startswith(p + '_') and name[len(p) + 1:].isdigit() for p in prefixes)]
+
+    def ensure_partition(self, conn, prefix, ts, created):
+        """
+        Crea la partición de `ts` si no está en la caché y agrega su nombre a
+        `created`. Quien abrió la transacción la suma a la caché recién
+        después del commit: si hay rollback la tabla no existe.
+        """
+        name = partition_name(prefix, ts)
+        with self._partitions_lock:
+            if name in self._partitions:
+                return name
+        if prefix == 'events':
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {name} (
+                    device_key INTEGER NOT NULL,
+                    ts INTEGER NOT NULL,
+                    status INTEGER NOT NULL,
+                    ip TEXT
+                )
+            ''')
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {name}_device_ts ON {name} (device_key, ts)")
+        else:
+            conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {name} (
+                    device_key INTEGER NOT NULL,
+                    bucket INTEGER NOT NULL,
+                    online_seconds INTEGER NOT NULL DEFAULT 0,
+                    outages INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (device_key, bucket)
+                ) WITHOUT ROWID
+            ''')
+        created.add(name)
+        return name
+
+    def partitions_between(self, conn, prefix, start, end):
+        """Particiones existentes de `prefix` que se solapan con [start, end)."""
+        names = []
+        for name in self._existing_partitions(conn, prefix):
+            p_start, p_end = partition_range(name)
+            if p_start < end and p_end > start:
+                names.append(name)
+        return sorted(names)
+
+    def apply_retention(self, now=None):
+        """Borra las particiones cuyo período terminó antes de la retención. Retorna sus nombres."""
+        now = time.time() if now is None else now
+        keep_days = {'events': HISTORY_RAW_DAYS, 'uptime_hourly': HISTORY_HOURLY_DAYS,
+                     'uptime_daily': HISTORY_DAILY_DAYS}
+        conn = self.connection()
+        dropped = []
+        with conn:
+            for name in self._existing_partitions(conn):
+                prefix = name.rsplit('_', 1)[0]
+                if partition_range(name)[1] <= now - keep_days[prefix] * DAY:
+                    conn.execute(f"DROP TABLE IF EXISTS {name}")
+                    dropped.append(name)
+        with self._partitions_lock:
+            self._partitions.difference_update(dropped)
+        return dropped
+
+    # ----------------------------------------------------------
+    # Escritura (solo desde HistoryRecorder)
+
+    def load_state(self):
+        """Retorna ({device_id: device_key}, {device_key: (status, ip, accounted_until)})."""
+        conn = self.connection()
+        keys = dict(conn.execute("SELECT device_id, device_key FROM device_keys"))
+        states = {row[0]: row[1:] for row in
+                  conn.execute("SELECT device_key, status, ip, accounted_until FROM device_state")}
+        return keys, states
+
+    def write_batch(self, new_keys, events, rollups, states):
+        """
+        Escribe en una sola transacción:
+          new_keys: [(device_key, device_id)]
+          events: [(device_key, ts, status, ip)]
+          rollups: {(resolution, device_key, bucket): [online_seconds, outages]}
+          states: [(device_key, status, ip, accounted_until)]
+        Los rollups se suman a lo que ya había en cada bucket.
+        """
+        conn = self.connection()
+        created = set()
+        with conn:
+            if new_keys:
+                conn.executemany("INSERT OR IGNORE INTO device_keys (device_key, device_id) VALUES (?, ?)", new_keys)
+
+            by_table = {}
+            for event in events:
+                by_table.setdefault(self.ensure_partition(conn, 'events', event[1], created), []).append(event)
+            for table, rows in by_table.items():
+                conn.executemany(f"INSERT INTO {table} (device_key, ts, status, ip) VALUES (?, ?, ?, ?)", rows)
+
+            by_table = {}
+            for (resolution, device_key, bucket), (online_seconds, outages) in rollups.items():
+                table = self.ensure_partition(conn, ROLLUP_TABLES[resolution], bucket, created)
+                by_table.setdefault(table, []).append((device_key, bucket, online_seconds, outages))
+            for table, rows in by_table.items():
+                conn.executemany(
+                    f"""INSERT INTO {table} (device_key, bucket, online_seconds, outages) VALUES (?, ?, ?, ?)
+                        ON CONFLICT(device_key, bucket) DO UPDATE SET
+                            online_seconds = online_seconds + excluded.online_seconds,
+                            outages = outages + excluded.outages""",
+                    rows)
+
+            if states:
+                conn.executemany(
+                    """INSERT INTO device_state (device_key, status, ip, accounted_until) VALUES (?, ?, ?, ?)
+                       ON CONFLICT(device_key) DO UPDATE SET status = excluded.status, ip = excluded.ip,
+                                                             accounted_until = excluded.accounted_until""",
+                    states)
+        with self._partitions_lock:
+            self._partitions.update(created)
+
+    # ----------------------------------------------------------
+    # Consultas
+
+    def device_key(self, device_id):
+        row = self.connection().execute("SELECT device_key FROM device_keys WHERE device_id = ?",
+                                        (device_id,)).fetchone()
+        return row[0] if row else None
+
+    def uptime(self, device_key, start, end, resolution):
+        """Retorna {bucket: (online_seconds, outages)} del dispositivo en [start, end)."""
+        conn = self.connection()
+        tables = self.partitions_between(conn, ROLLUP_TABLES[resolution], start, end)
+        if not tables:
+            return {}
+        sql = " UNION ALL ".join(
+            f"SELECT bucket, online_seconds, outages FROM {t} WHERE device_key = ? AND bucket >= ? AND bucket < ?"
+            for t in tables)
+        rows = conn.execute(sql, [device_key, start, end] * len(tables))
+        return {bucket: (online_seconds, outages) for bucket, online_seconds, outages in rows}
+
+    def availability(self, start, end, resolution):
+        """Retorna {device_id: (online_seconds, outages)} sumando los buckets de [start, end)."""
+        conn = self.connection()
+        tables = self.partitions_between(conn, ROLLUP_TABLES[resolution], start, end)
+        if not tables:
+            return {}
+        union = " UNION ALL ".join(
+            f"SELECT device_key, online_seconds, outages FROM {t} WHERE bucket >= ? AND bucket < ?"
+            for t in tables)
+        rows = conn.execute(
+            f"""SELECT k.device_id, SUM(r.online_seconds), SUM(r.outages)
+                FROM ({union}) r JOIN device_keys k ON k.device_key = r.device_key
+                GROUP BY r.device_key""",
+            [start, end] * len(tables))
+        return {device_id: (online_seconds, outages) for device_id, online_seconds, outages in rows}
+
+    def events(self, device_key, start, end, limit=1000):
+        """Eventos crudos del dispositivo en [start, end), del más antiguo al más reciente."""
+        conn = self.connection()
+        tables = self.partitions_between(conn, 'events', start, end)
+        if not tables:
+            return []
+        union = " UNION ALL ".join(
+            f"SELECT ts, status, ip FROM {t} WHERE device_key = ? AND ts >= ? AND ts < ?" for t in tables)
+        rows = conn.execute(f"SELECT ts, status, ip FROM ({union}) ORDER BY ts LIMIT ?",
+                            [*([device_key, start, end] * len(tables)), limit])
+        return [{'ts': ts, 'status': 'online' if status == ONLINE else 'offline', 'ip': ip}
+                for ts, status, ip in rows]
+
+
+class _DeviceState:
+    __slots__ = ('key', 'status', 'ip', 'accounted_until', 'last_seen')
+
+    def __init__(self, key, status=None, ip=None, accounted_until=0, last_seen=None):
+        self.key = key
+        self.status = status
+        self.ip = ip
+        self.accounted_until = accounted_until
+        self.last_seen = last_seen
+
+
+class HistoryRecorder:
+    """
+    Registra en HistoryStore las transiciones que ven el ingest y el monitor
+    de heartbeats, sin tocar la tabla devices.
+
+    Los callbacks solo encolan observaciones; un hilo de fondo las compara con
+    el último estado de cada dispositivo (en memoria), agrega solo los cambios
+    y acumula los segundos online en buckets por hora y por día. Cada
+    `flush_ms` escribe todo en una sola transacción. Un anuncio que no cambia
+    nada no genera escrituras: el tiempo online de los dispositivos que siguen
+    online se acumula cada HISTORY_CHECKPOINT_S segundos hasta su último
+    anuncio, así que los rollups pueden ir hasta ese tiempo por detrás.
+    """
+
+    def __init__(self, store, flush_ms=HISTORY_FLUSH_MS, maxsize=HISTORY_QUEUE_SIZE,
+                 checkpoint_s=HISTORY_CHECKPOINT_S):
+        self._store = store
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._flush_interval = flush_ms / 1000.0
+        self._checkpoint_s = checkpoint_s
+        self._thread = None
+        self._devices = {}
+        self._next_key = 1
+        self._stats_lock = threading.Lock()
+        self._stats = {'observations': 0, 'dropped': 0, 'events': 0, 'batches': 0,
+                       'flush_errors': 0, 'last_flush_ms': 0.0, 'partitions_dropped': 0}
+        self._reset_batch()
+
+    def start(self):
+        if self._thread is None:
+            self._load()
+            self._thread = threading.Thread(target=self._run, name='history-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Detiene el hilo escritor después de escribir lo pendiente."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def record_announcements(self, announcements, result):
+        """Callback del ingest: los anuncios escritos en la BD pasan a online."""
+        written = set(result['updated']) | set(result['inserted'])
+        self._put([('online', a.device_id, int(a.received_at), a.ip)
+                   for a in announcements if a.device_id in written])
+
+    def record_offline(self, device_ids, cutoff):
+        """Callback del monitor de heartbeats: dispositivos vencidos con last_seen <= cutoff."""
+        self._put([('offline', device_id, cutoff, None) for device_id in device_ids])
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['tracked'] = len(self._devices)
+        return stats
+
+    def _put(self, observations):
+        if not observations:
+            return
+        try:
+            self._queue.put_nowait(observations)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['dropped'] += len(observations)
+            logger.warning("[HISTORY] Cola llena, %d observaciones descartadas", len(observations))
+            return
+        with self._stats_lock:
+            self._stats['observations'] += len(observations)
+
+    def _load(self):
+        keys, states = self._store.load_state()
+        self._devices = {}
+        for device_id, key in keys.items():
+            status, ip, accounted_until = states.get(key, (None, None, 0))
+            self._devices[device_id] = _DeviceState(key, status, ip, accounted_until)
+        self._next_key = max(keys.values(), default=0) + 1
+
+    def _reset_batch(self):
+        self._new_keys = []
+        self._events = []
+        self._rollups = {}
+        self._dirty = set()
+
+    # ----------------------------------------------------------
+    # Máquina de estados (solo en el hilo escritor)
+
+    def _state_for(self, device_id):
+        state = self._devices.get(device_id)
+        if state is None:
+            state = _DeviceState(self._next_key)
+            self._next_key += 1
+            self._devices[device_id] = state
+            self._new_keys.append((state.key, device_id))
+        return state
+
+    def _add_rollup(self, key, ts, online_seconds, outages):
+        for resolution in (HOUR, DAY):
+            bucket = ts - ts % resolution
+            totals = self._rollups.setdefault((resolution, key, bucket), [0, 0])
+            totals[0] += online_seconds
+            totals[1] += outages
+
+    def _account(self, state, until):
+        """Suma a los buckets el tiempo online entre accounted_until y until."""
+        if state.status == ONLINE and until > state.accounted_until:
+            for resolution in (HOUR, DAY):
+                t = state.accounted_until
+                while t < until:
+                    bucket = t - t % resolution
+                    step = min(bucket + resolution, until) - t
+                    self._rollups.setdefault((resolution, state.key, bucket), [0, 0])[0] += step
+                    t += step
+        state.accounted_until = max(state.accounted_until, until)
+        self._dirty.add(state)
+
+    def _observe(self, kind, device_id, ts, ip):
+        if kind == 'online':
+            state = self._state_for(device_id)
+            if state.status != ONLINE:
+                self._account(state, ts)
+                state.status = ONLINE
+                state.ip = ip
+                self._events.append((state.key, ts, ONLINE, ip))
+            elif ip != state.ip:
+                state.ip = ip
+                self._events.append((state.key, ts, ONLINE, ip))
+                self._dirty.add(state)
+            state.last_seen = max(state.last_seen or 0, ts)
+        else:
+            state = self._devices.get(device_id)
+            if state is None or state.status != ONLINE:
+                return
+            if state.last_seen is not None and state.last_seen > ts:
+                # Volvió a anunciarse después del corte
+                return
+            # Se cayó después de su último anuncio, no cuando venció el timeout
+            ts = max(state.last_seen or ts, state.accounted_until)
+            self._account(state, ts)
+            state.status = OFFLINE
+            self._events.append((state.key, ts, OFFLINE, None))
+            self._add_rollup(state.key, ts, 0, 1)
+
+    def _checkpoint(self):
+        for state in self._devices.values():
+            if state.status == ONLINE and state.last_seen and state.last_seen > state.accounted_until:
+                self._account(state, state.last_seen)
+
+    def _flush(self):
+        if not (self._new_keys or self._events or self._rollups or self._dirty):
+            return
+        start = time.perf_counter()
+        try:
+            self._store.write_batch(
+                self._new_keys, self._events, self._rollups,
+                [(s.key, s.status, s.ip, s.accounted_until) for s in self._dirty if s.status is not None])
+        except Exception as e:
+            # El lote se conserva y se reintenta en el próximo flush (las claves
+            # nuevas ya están asignadas en self._devices y no se vuelven a pedir)
+            logger.exception("[HISTORY] Error al escribir el historial: %s", e)
+            overflow = len(self._events) - HISTORY_MAX_PENDING_EVENTS
+            if overflow > 0:
+                del self._events[:overflow]
+            with self._stats_lock:
+                self._stats['flush_errors'] += 1
+                if overflow > 0:
+                    self._stats['dropped'] += overflow
+            return
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['events'] += len(self._events)
+            self._stats['last_flush_ms'] = (time.perf_counter() - start) * 1000.0
+        self._reset_batch()
+
+    def _run(self):
+        next_flush = time.monotonic() + self._flush_interval
+        next_checkpoint = time.monotonic() + self._checkpoint_s
+        next_retention = time.monotonic()
+        running = True
+        while running:
+            try:
+                item = self._queue.get(timeout=max(0.0, next_flush - time.monotonic()))
+            except queue.Empty:
+                item = False
+            if item is None:
+                running = False
+            elif item is not False:
+                for observation in item:
+                    self._observe(*observation)
+
+            now = time.monotonic()
+            if now >= next_checkpoint or not running:
+                self._checkpoint()
+                next_checkpoint = now + self._checkpoint_s
+            if now >= next_flush or not running:
+                self._flush()
+                next_flush = now + self._flush_interval
+            if now >= next_retention and running:
+                try:
+                    dropped = self._store.apply_retention()
+                except Exception as e:
+                    logger.exception("[HISTORY] Error al aplicar la retención: %s", e)
+                else:
+                    if dropped:
+                        logger.info("[HISTORY] Particiones eliminadas por retención: %s", ', '.join(dropped))
+                        with self._stats_lock:
+                            self._stats['partitions_dropped'] += len(dropped)
+                next_retention = now + HOUR
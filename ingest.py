@@ -0,0 +1,290 @@
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+
+import database as dbm
+import metrics
+from message_router import MessageRouter
+
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo de lote y ventana de tiempo (ms) antes de escribir en la BD
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 200))
+INGEST_FLUSH_MS = int(os.getenv('INGEST_FLUSH_MS', 250))
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', 10000))
+
+# Clave de app_state con la cantidad de páginas de alta abiertas (ventana para
+# registrar dispositivos nuevos); se comparte entre procesos y workers
+ADD_DEVICE_SESSIONS_KEY = 'add_device_sessions'
+
+MESSAGES_PARSED = metrics.counter('iot_mqtt_messages_parsed_total', 'Anuncios "dc_" válidos encolados')
+MESSAGES_REJECTED = metrics.counter('iot_mqtt_messages_rejected_total', 'Mensajes MQTT descartados', ['reason'])
+ACKS_PARSED = metrics.counter('iot_mqtt_acks_parsed_total', 'Confirmaciones "ack_" válidas de comandos')
+FLUSH_TIME = metrics.histogram('iot_ingest_flush_seconds', 'Tiempo de escritura de cada lote de anuncios')
+
+# Anuncio "dc_" ya parseado y listo para escribirse en la BD
+Announcement = namedtuple('Announcement', ['device_id', 'ip', 'group', 'name', 'topic', 'received_at'])
+
+
+def add_device_window_open():
+    return int(dbm.get_state(ADD_DEVICE_SESSIONS_KEY, 0)) > 0
+
+
+def parse_announcement(message):
+    """
+    Parsea un mensaje con formato "dc_{device_id}_1_{ip}_{group}_{name}".
+
+    Retorna un Announcement o None si el mensaje no tiene las 6 partes
+    esperadas o algún campo viene vacío.
+    """
+    parts = message.split("_")
+    # Se esperan 6 partes: "dc", device_id, "1", ip, group, name
+    if len(parts) != 6 or parts[0] != "dc":
+        return None
+    device_id = parts[1].strip()
+    ip = parts[3].strip()
+    group = parts[4].strip()
+    name = parts[5].strip()
+    if not (device_id and ip and group and name):
+        return None
+    return Announcement(device_id, ip, group, name, f"streelet/{group}", time.time())
+
+
+# Estados que confirma el firmware con "ack_{device_id}_{estado}"
+ACK_STATES = ('on', 'off', 'reset')
+
+
+def parse_ack(message):
+    """
+    Parsea una confirmación "ack_{device_id}_{estado}". Retorna
+    (device_id, estado) o None si no tiene 3 partes o el estado no es on, off
+    ni reset.
+    """
+    parts = message.split("_")
+    if len(parts) != 3 or parts[0] != "ack":
+        return None
+    device_id = parts[1].strip()
+    state = parts[2].strip().lower()
+    if not device_id or state not in ACK_STATES:
+        return None
+    return device_id, state
+
+
+# Prefijos de los comandos que publica el servidor; con la suscripción a
+# "streelet/#" también se reciben (los de cualquier worker)
+COMMAND_PREFIXES = ('on', 'off', 'reset')
+
+
+def parse_command(message):
+    """
+    Parsea un comando publicado: "on_{device_id}", "off_{device_id}" o
+    "reset". Retorna (device_id, acción), con device_id None para "reset", o
+    None si el formato no corresponde.
+    """
+    if message == 'reset':
+        return None, 'reset'
+    action, _, device_id = message.partition('_')
+    device_id = device_id.strip()
+    if action not in ('on', 'off') or not device_id or '_' in device_id:
+        return None
+    return device_id, action
+
+
+def handle_announcement(ingest_queue, topic, message):
+    """Encola un anuncio "dc_" válido en ingest_queue."""
+    announcement = parse_announcement(message)
+    if announcement is None:
+        logger.warning("Formato incorrecto en mensaje 'dc_'. Se esperaban 6 partes: dc, device_id, 1, ip, group, name. Mensaje: %s", message)
+        MESSAGES_REJECTED.inc('malformed')
+        return False
+
+    if not ingest_queue.put(announcement):
+        logger.warning("Cola de ingest llena, anuncio de %s descartado", announcement.device_id)
+        MESSAGES_REJECTED.inc('queue_full')
+        return False
+    MESSAGES_PARSED.inc()
+    return True
+
+
+def handle_ack(on_ack, topic, message):
+    """Pasa una confirmación "ack_" válida a on_ack(device_id, estado)."""
+    ack = parse_ack(message)
+    if ack is None:
+        logger.warning("Formato incorrecto en mensaje 'ack_'. Se esperaba ack_{device_id}_{on|off|reset}. Mensaje: %s", message)
+        MESSAGES_REJECTED.inc('malformed')
+        return False
+    ACKS_PARSED.inc()
+    if on_ack is not None:
+        on_ack(*ack)
+    return True
+
+
+def handle_command(on_command, topic, message):
+    """Pasa un comando publicado (por este u otro proceso) a on_command(topic, device_id, acción)."""
+    command = parse_command(message)
+    if command is None:
+        return handle_unknown(topic, message)
+    if on_command is not None:
+        on_command(topic, *command)
+    return True
+
+
+def handle_unknown(topic, message):
+    logger.info("Formato de mensaje no reconocido en %s: %s", topic, message)
+    MESSAGES_REJECTED.inc('unknown')
+    return False
+
+
+def build_router(ingest_queue, on_ack=None, on_command=None):
+    """
+    Router de los mensajes MQTT del ingest. Lo usan el callback de app.py y
+    ingest_service.py; los anuncios "dc_" se encolan en ingest_queue, las
+    confirmaciones "ack_" se pasan a on_ack(device_id, estado) y los comandos
+    publicados a on_command(topic, device_id, acción).
+    """
+    router = MessageRouter()
+    router.route('dc', lambda topic, message: handle_announcement(ingest_queue, topic, message), name='announcement')
+    router.route('ack', lambda topic, message: handle_ack(on_ack, topic, message), name='ack')
+    for prefix in COMMAND_PREFIXES:
+        router.route(prefix, lambda topic, message: handle_command(on_command, topic, message), name='command_echo')
+    router.fallback(handle_unknown)
+    return router
+
+
+class IngestQueue:
+    """
+    Cola de escritura diferida para los anuncios MQTT.
+
+    El callback de paho solo encola; un hilo de fondo agrupa los anuncios por
+    device_id (se conserva el más reciente) y los escribe en una sola
+    transacción cada `batch_size` mensajes o cada `flush_ms` milisegundos.
+    """
+
+    def __init__(self, allow_new=None, batch_size=INGEST_BATCH_SIZE,
+                 flush_ms=INGEST_FLUSH_MS, maxsize=INGEST_QUEUE_SIZE, on_flush=None):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._allow_new = allow_new or (lambda: False)
+        self._batch_size = batch_size
+        self._flush_interval = flush_ms / 1000.0
+        self._on_flush = on_flush
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'received': 0,
+            'dropped': 0,
+            'coalesced': 0,
+            'batches': 0,
+            'rows_updated': 0,
+            'rows_inserted': 0,
+            'rows_skipped': 0,
+            'rows_rejected': 0,
+            'flush_errors': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        """Detiene el hilo escritor después de vaciar lo pendiente."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout)
+            self._thread = None
+
+    def put(self, announcement):
+        """
+        Encola un anuncio sin bloquear. Retorna False si la cola está llena
+        y el anuncio se descartó.
+        """
+        try:
+            self._queue.put_nowait(announcement)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['dropped'] += 1
+            return False
+        with self._stats_lock:
+            self._stats['received'] += 1
+        return True
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['avg_flush_ms'] = stats['total_flush_ms'] / stats['batches'] if stats['batches'] else 0.0
+        return stats
+
+    def _run(self):
+        pending = {}
+        count = 0
+        deadline = None
+        running = True
+        while running:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = False
+
+            if item is None:
+                running = False
+            elif item is not False:
+                if item.device_id in pending:
+                    with self._stats_lock:
+                        self._stats['coalesced'] += 1
+                pending[item.device_id] = item
+                count += 1
+                if deadline is None:
+                    deadline = time.monotonic() + self._flush_interval
+
+            if pending and (not running or count >= self._batch_size or time.monotonic() >= deadline):
+                self._flush(list(pending.values()))
+                pending = {}
+                count = 0
+                deadline = None
+
+    def _flush(self, announcements):
+        start = time.perf_counter()
+        try:
+            result = dbm.upsert_devices(
+                [(a.device_id, a.name, a.topic, a.ip, int(a.received_at)) for a in announcements],
+                allow_insert=self._allow_new(),
+            )
+        except Exception as e:
+            logger.error("Error al escribir lote de anuncios (%d): %s", len(announcements), e)
+            with self._stats_lock:
+                self._stats['flush_errors'] += 1
+            return
+        elapsed_ms = (time.perf_counter() - start) * 1000.0
+        FLUSH_TIME.observe(elapsed_ms / 1000.0)
+
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['rows_updated'] += len(result['updated'])
+            self._stats['rows_inserted'] += len(result['inserted'])
+            self._stats['rows_skipped'] += len(result['skipped'])
+            self._stats['rows_rejected'] += len(result['rejected'])
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            self._stats['total_flush_ms'] += elapsed_ms
+
+        if result['inserted']:
+            logger.info("Nuevos dispositivos registrados: %s", ', '.join(result['inserted']))
+        if result['skipped']:
+            logger.info("Nuevos dispositivos no agregados (no hay página de alta abierta): %s", ', '.join(result['skipped']))
+        if result['rejected']:
+            logger.warning("Anuncios rechazados por la BD (nombre duplicado): %s", ', '.join(result['rejected']))
+
+        if self._on_flush is not None:
+            try:
+                self._on_flush(announcements, result)
+            except Exception as e:
+                logger.exception("Error en on_flush del ingest: %s", e)
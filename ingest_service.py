@@ -0,0 +1,182 @@
+"""
+Servicio de ingest MQTT independiente de Flask.
+
+Se suscribe al broker con asyncio, procesa los anuncios "dc_" con la misma
+lógica que app.mqtt_on_message (ingest.build_router + IngestQueue),
+detecta los heartbeats vencidos y, como es el proceso que recibe los "ack_",
+corre el CommandTracker: los comandos que publica la app web le llegan por
+la suscripción y se reintentan o reconcilian desde aquí; su estado se copia
+en app_state para la app web. La app web se entera de los cambios a
+través de la BD, así que debe ejecutarse con INGEST_MODE=external:
+
+    python ingest_service.py
+    INGEST_MODE=external python app.py
+"""
+import argparse
+import asyncio
+import logging
+import random
+import signal
+
+import paho.mqtt.client as mqtt
+
+import broker_actions as bk
+import database as dbm
+from command_tracker import CommandTracker
+import heartbeat
+import history
+import ingest
+import log_config
+from mqtt_asyncio import AsyncioHelper, use_selector_event_loop
+
+logger = logging.getLogger(__name__)
+
+
+class IngestService:
+    def __init__(self, allow_new=False, batch_size=ingest.INGEST_BATCH_SIZE, flush_ms=ingest.INGEST_FLUSH_MS):
+        self.heartbeat_monitor = heartbeat.HeartbeatMonitor(
+            group_timeouts=heartbeat.parse_group_timeouts(heartbeat.HEARTBEAT_GROUP_TIMEOUTS),
+            on_expired=self._mark_expired)
+        self.ingest_queue = ingest.IngestQueue(allow_new=lambda: allow_new or ingest.add_device_window_open(),
+                                               batch_size=batch_size,
+                                               flush_ms=flush_ms, on_flush=self._on_flush)
+        self.command_tracker = CommandTracker(None, dbm.get_desired_power_states, publish=self._publish,
+                                              share=True)
+        self.router = ingest.build_router(self.ingest_queue, on_ack=self.command_tracker.record_ack,
+                                          on_command=self.command_tracker.record_command)
+        self.history_store = history.HistoryStore()
+        self.history_recorder = history.HistoryRecorder(self.history_store)
+        self.client = None
+        self._loop = None
+        self._disconnected = None
+        self._stopping = None
+
+    def _on_flush(self, announcements, result):
+        self.history_recorder.record_announcements(announcements, result)
+        written = set(result['updated']) | set(result['inserted'])
+        for a in announcements:
+            if a.device_id in written:
+                self.heartbeat_monitor.touch(a.device_id, a.group, a.received_at)
+
+    def _mark_expired(self, device_ids, cutoff):
+        # Solo los que siguen sin anunciarse después de cutoff (el UPDATE lo
+        # vuelve a comprobar): uno que revivió mientras tanto sigue online
+        went_offline = dbm.mark_devices_offline(device_ids, cutoff)
+        self.history_recorder.record_offline(went_offline, cutoff)
+        self.command_tracker.forget_reported(went_offline)
+        logger.info("[HEARTBEAT] %d dispositivos marcados como offline (timeout)", len(went_offline))
+
+    def _publish(self, messages):
+        # Lo llama el hilo del tracker: paho y AsyncioHelper se usan solo desde el loop
+        self._loop.call_soon_threadsafe(bk.publish_many, self.client, messages)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info("[INGEST] Connected to the broker %s on port %s", bk.MQTT_BROKER, bk.MQTT_PORT)
+            client.subscribe(bk.MQTT_SUBSCRIPTION)
+            # Reintentos del tracker publicados mientras no había conexión
+            bk.replay_buffered(client)
+        else:
+            logger.error("[INGEST] Connection failed with error code %s", rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        logger.warning("[INGEST] Disconnected (rc=%s)", rc)
+        self._disconnected.set()
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            self.router.dispatch(msg.topic, msg.payload)
+        except Exception as e:
+            logger.exception("Error en ingest_service: %s", e)
+
+    async def _connection_loop(self, loop):
+        delay = bk.MQTT_RECONNECT_MIN
+        while not self._stopping.is_set():
+            self._disconnected.clear()
+            try:
+                # La resolución DNS y el connect TCP bloquean: van en un
+                # executor para no frenar el ingest ni los demás callbacks
+                self.client.connect_async(bk.MQTT_BROKER, bk.MQTT_PORT)
+                await loop.run_in_executor(None, self.client.reconnect)
+            except Exception as e:
+                wait = delay / 2 + random.uniform(0, delay / 2)
+                logger.warning("[INGEST] Connection error: %s. Retrying in %.1fs", e, wait)
+                delay = min(delay * 2, bk.MQTT_RECONNECT_MAX)
+                await asyncio.sleep(wait)
+                continue
+            delay = bk.MQTT_RECONNECT_MIN
+            stop = loop.create_task(self._stopping.wait())
+            lost = loop.create_task(self._disconnected.wait())
+            await asyncio.wait([stop, lost], return_when=asyncio.FIRST_COMPLETED)
+            stop.cancel()
+            lost.cancel()
+        self.client.disconnect()
+
+    async def _report_stats(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            stats = self.ingest_queue.stats()
+            logger.info("[INGEST] Contadores", extra={
+                'received': stats['received'], 'queue_depth': stats['queue_depth'], 'batches': stats['batches'],
+                'avg_flush_ms': round(stats['avg_flush_ms'], 1), 'heartbeat': self.heartbeat_monitor.stats(),
+                'router': self.router.stats()['handlers'], 'acks': self.command_tracker.stats()})
+
+    async def run(self, stats_interval=60):
+        loop = self._loop = asyncio.get_running_loop()
+        self._disconnected = asyncio.Event()
+        self._stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        dbm.init_db()
+        self.history_store.init()
+        for device in dbm.get_all_devices():
+            if device['status'] == 'online':
+                self.heartbeat_monitor.touch(device['id'], heartbeat.group_from_topic(device['topic']),
+                                             device['last_seen'] or 0)
+        self.history_recorder.start()
+        self.heartbeat_monitor.start()
+        self.ingest_queue.start()
+        self.router.start()
+
+        self.client = mqtt.Client()
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        AsyncioHelper(loop, self.client)
+        self.command_tracker.start()
+
+        reporter = loop.create_task(self._report_stats(stats_interval)) if stats_interval else None
+        try:
+            await self._connection_loop(loop)
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+            self.router.stop()
+            self.command_tracker.stop()
+            self.ingest_queue.stop()
+            self.heartbeat_monitor.stop()
+            self.history_recorder.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servicio de ingest MQTT para IOT Devices Web Manager")
+    parser.add_argument('--accept-new', action='store_true',
+                        help="registrar siempre los dispositivos nuevos (por defecto solo mientras haya una página de alta abierta)")
+    parser.add_argument('--batch-size', type=int, default=ingest.INGEST_BATCH_SIZE)
+    parser.add_argument('--flush-ms', type=int, default=ingest.INGEST_FLUSH_MS)
+    parser.add_argument('--stats-interval', type=int, default=60,
+                        help="segundos entre reportes de contadores (0 para desactivar)")
+    args = parser.parse_args()
+
+    log_config.setup_logging()
+    use_selector_event_loop()
+    service = IngestService(allow_new=args.accept_new, batch_size=args.batch_size, flush_ms=args.flush_ms)
+    asyncio.run(service.run(stats_interval=args.stats_interval))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+Importación y exportación masiva del inventario de dispositivos.
+
+POST /devices/import recibe NDJSON (un objeto por línea) o CSV con
+encabezado y lo procesa a medida que llega: cada fila se valida y se acumula
+en bloques de INVENTORY_CHUNK que se escriben en una transacción cada uno
+(dbm.import_devices). Las filas con error se informan con su número de línea
+y no detienen la importación. GET /devices/export recorre la tabla por
+bloques y genera NDJSON o CSV sin cargar el inventario completo en memoria.
+
+Campos: id (o device_id), name (por defecto el id), topic (o group, que se
+convierte en "streelet/{group}") e ip (opcional). El resto de las columnas
+(p. ej. status en un archivo exportado) se ignora.
+"""
+import csv
+import io
+import ipaddress
+import json
+import logging
+import os
+import zlib
+
+import database as dbm
+from serialization import DEVICE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Filas por transacción en la importación y por consulta en la exportación
+INVENTORY_CHUNK = int(os.getenv('INVENTORY_CHUNK', 1000))
+# Errores por fila que se detallan en la respuesta (el resto solo se cuenta)
+IMPORT_MAX_ERRORS = int(os.getenv('IMPORT_MAX_ERRORS', 1000))
+MAX_FIELD_LENGTH = 128
+
+NDJSON = 'ndjson'
+CSV = 'csv'
+CONTENT_TYPES = {NDJSON: 'application/x-ndjson', CSV: 'text/csv'}
+_FORMATS_BY_TYPE = {'application/x-ndjson': NDJSON, 'application/jsonl': NDJSON, 'application/json': NDJSON,
+                    'text/csv': CSV}
+
+
+def detect_format(mimetype, requested=None):
+    """Formato pedido con ?format= o, si no, según el Content-Type."""
+    if requested:
+        if requested not in CONTENT_TYPES:
+            raise ValueError(f"format debe ser uno de: {', '.join(CONTENT_TYPES)}")
+        return requested
+    return _FORMATS_BY_TYPE.get(mimetype, NDJSON)
+
+
+def _text(value, field):
+    value = '' if value is None else str(value).strip()
+    if len(value) > MAX_FIELD_LENGTH:
+        raise ValueError(f"{field} supera {MAX_FIELD_LENGTH} caracteres")
+    return value
+
+
+def validate(record):
+    """
+    Convierte un registro (dict) en (device_id, name, topic, ip). Lanza
+    ValueError con el motivo si no es válido.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("Se esperaba un objeto")
+    device_id = _text(record.get('id') or record.get('device_id'), 'id')
+    if not device_id:
+        raise ValueError("Falta id")
+    # Los mensajes MQTT separan sus partes con "_" ("on_{device_id}")
+    if '_' in device_id or any(c.isspace() for c in device_id):
+        raise ValueError("id no puede contener '_' ni espacios")
+    name = _text(record.get('name'), 'name') or device_id
+    topic = _text(record.get('topic'), 'topic')
+    group = _text(record.get('group'), 'group')
+    if not topic and group:
+        topic = f"streelet/{group}"
+    if not topic:
+        raise ValueError("Falta topic o group")
+    if '+' in topic or '#' in topic:
+        raise ValueError("topic no puede contener comodines MQTT")
+    ip = _text(record.get('ip'), 'ip')
+    if ip:
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            raise ValueError(f"ip inválida: {ip}") from None
+    return device_id, name, topic, ip
+
+
+def iter_records(stream, fmt):
+    """Genera (línea, registro) leyendo el stream binario de a poco."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='' if fmt == CSV else None)
+    if fmt == CSV:
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_number, line in enumerate(text, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError as e:
+            yield line_number, ValueError(f"JSON inválido: {e}")
+
+
+def import_devices(stream, fmt, update=False, on_chunk=None):
+    """
+    Importa el inventario del stream. on_chunk(rows) recibe las tuplas
+    (device_id, name, topic, ip) insertadas o actualizadas de cada bloque ya
+    confirmado en la BD.
+
+    Retorna un resumen con los totales, los primeros IMPORT_MAX_ERRORS errores
+    [{'line', 'id', 'error'}] y 'aborted' con el motivo si el archivo no se
+    pudo leer hasta el final (los bloques anteriores quedan importados).
+    """
+    summary = {'rows': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'failed': 0, 'errors': [], 'aborted': None}
+
+    def add_error(line, device_id, error):
+        summary['failed'] += 1
+        if len(summary['errors']) < IMPORT_MAX_ERRORS:
+            summary['errors'].append({'line': line, 'id': device_id, 'error': error})
+
+    def flush(chunk):
+        rows = [row for _, row in chunk]
+        result = dbm.import_devices(rows, update=update)
+        lines = {row[0]: line for line, row in chunk}
+        for key in ('inserted', 'updated', 'skipped'):
+            summary[key] += len(result[key])
+        for device_id, error in result['rejected']:
+            add_error(lines.get(device_id), device_id, error)
+        applied = set(result['inserted']) | set(result['updated'])
+        if on_chunk is not None and applied:
+            on_chunk([row for row in rows if row[0] in applied])
+
+    chunk = []
+    try:
+        for line, record in iter_records(stream, fmt):
+            summary['rows'] += 1
+            if isinstance(record, Exception):
+                add_error(line, None, str(record))
+                continue
+            try:
+                row = validate(record)
+            except ValueError as e:
+                add_error(line, record.get('id') if isinstance(record, dict) else None, str(e))
+                continue
+            chunk.append((line, row))
+            if len(chunk) >= INVENTORY_CHUNK:
+                flush(chunk)
+                chunk = []
+    except (UnicodeDecodeError, csv.Error, OSError, EOFError, zlib.error) as e:
+        summary['aborted'] = f"No se pudo leer el archivo: {e}"
+        logger.warning("Importación de inventario interrumpida en la fila %d: %s", summary['rows'], e)
+    if chunk:
+        flush(chunk)
+    # Los rechazos de la BD se conocen al escribir cada bloque
+    summary['errors'].sort(key=lambda error: error['line'] or 0)
+    logger.info("Inventario importado: %d filas, %d nuevos, %d actualizados, %d omitidos, %d con error",
+                summary['rows'], summary['inserted'], summary['updated'], summary['skipped'], summary['failed'])
+    return summary
+
+
+def export_chunks(fmt, chunk_size=INVENTORY_CHUNK):
+    """Genera el inventario completo en NDJSON o CSV, un bloque de filas por fragmento."""
+    if fmt == CSV:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(DEVICE_FIELDS)
+        for rows in dbm.iter_devices(chunk_size):
+            writer.writerows(rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+    dumps = json.JSONEncoder(separators=(',', ':')).encode
+    for rows in dbm.iter_devices(chunk_size):
+        yield ''.join(dumps(dict(zip(DEVICE_FIELDS, row))) + '\n' for row in rows)
@@ -0,0 +1,82 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import database as dbm
+
+logger = logging.getLogger(__name__)
+
+# Segundos de validez del lease; se renueva cada tercio de ese tiempo
+LEASE_TTL = float(os.getenv('SUBSCRIBER_LEASE_TTL', 15))
+
+
+class LeaderLease:
+    """
+    Elige un único proceso entre varios workers usando un lease en app_state.
+
+    Cada worker intenta tomar o renovar el lease periódicamente; el que lo
+    tiene ejecuta on_acquired() y, si lo pierde (o no pudo renovarlo antes de
+    que venciera), on_lost(). Si el proceso muere, el lease vence y otro
+    worker lo toma en la siguiente ronda.
+    """
+
+    def __init__(self, name, on_acquired, on_lost, ttl=LEASE_TTL):
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._on_acquired = on_acquired
+        self._on_lost = on_lost
+        self._ttl = ttl
+        self._held = False
+        self._last_renewal = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._held
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name=f'lease-{self.name}', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._held:
+            self._set_held(False)
+            try:
+                dbm.release_lease(self.name, self.owner)
+            except Exception as e:
+                logger.error("[LEASE] Error al liberar el lease %s: %s", self.name, e)
+
+    def _set_held(self, held):
+        if held == self._held:
+            return
+        self._held = held
+        logger.info("[LEASE] %s %s el lease %s", self.owner, 'tomó' if held else 'perdió', self.name)
+        try:
+            (self._on_acquired if held else self._on_lost)()
+        except Exception as e:
+            logger.exception("[LEASE] Error en el callback del lease %s: %s", self.name, e)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                held = dbm.try_acquire_lease(self.name, self.owner, self._ttl)
+                if held:
+                    self._last_renewal = time.monotonic()
+                self._set_held(held)
+            except Exception as e:
+                # Un error puntual (BD ocupada) no cede el lease hasta que venza
+                logger.warning("[LEASE] Error al renovar el lease %s: %s", self.name, e)
+                if self._held and time.monotonic() - self._last_renewal > self._ttl:
+                    self._set_held(False)
+            self._stop.wait(self._ttl / 3)
@@ -0,0 +1,205 @@
+"""
+Configuración de logging para la app y el servicio de ingest.
+
+Los módulos usan logging.getLogger(__name__) y no escriben en la consola
+desde el hilo que loguea: el handler raíz es un QueueHandler que solo encola
+el registro, y un QueueListener en su propio hilo lo escribe en la consola y
+lo guarda en un buffer circular (ver /debug/logs).
+
+Variables de entorno:
+  LOG_LEVEL        nivel global (INFO por defecto)
+  LOG_LEVELS       niveles por módulo, p. ej. "ingest=DEBUG,database=WARNING"
+  LOG_FORMAT       "text" o "json" (una línea JSON por registro)
+  LOG_RATE_LIMIT   máximo de mensajes iguales por ventana (0 = sin límite)
+  LOG_RATE_WINDOW  ventana en segundos del límite anterior
+  LOG_BUFFER_SIZE  registros que guarda el buffer circular
+"""
+import atexit
+import collections
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', 10))
+LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', 10))
+LOG_BUFFER_SIZE = int(os.getenv('LOG_BUFFER_SIZE', 2000))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+
+# Atributos propios de LogRecord; el resto son campos pasados con extra=
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'suppressed'}
+
+_listener = None
+ring_buffer = None
+
+
+def record_fields(record):
+    """Campos estructurados (extra=) de un registro."""
+    return {k: v for k, v in vars(record).items() if k not in _RECORD_ATTRS}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Deja pasar como máximo `limit` registros con el mismo logger y plantilla
+    de mensaje por ventana de `window` segundos. El primero que pasa en la
+    ventana siguiente lleva en `suppressed` cuántos se descartaron.
+    """
+
+    def __init__(self, limit=LOG_RATE_LIMIT, window=LOG_RATE_WINDOW):
+        super().__init__()
+        self._limit = limit
+        self._window = window
+        self._lock = threading.Lock()
+        self._counters = {}
+        self.suppressed_total = 0
+
+    def filter(self, record):
+        if self._limit <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counters.get(key)
+            if entry is None or now - entry[0] >= self._window:
+                suppressed = entry[2] if entry else 0
+                self._counters[key] = [now, 1, 0]
+                if len(self._counters) > 10000:
+                    self._counters = {k: v for k, v in self._counters.items() if now - v[0] < self._window}
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if entry[1] < self._limit:
+                entry[1] += 1
+                return True
+            entry[2] += 1
+            self.suppressed_total += 1
+            return False
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (y cuenta) en lugar de bloquear si la cola está llena."""
+
+    dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DroppingQueueHandler.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            line += ' ' + ' '.join(f"{k}={v}" for k, v in fields.items())
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            line += f" (+{suppressed} iguales suprimidos)"
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname,
+                 'logger': record.name, 'msg': record.getMessage(), **record_fields(record)}
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RingBufferHandler(logging.Handler):
+    """Guarda los últimos `capacity` registros como dicts para /debug/logs."""
+
+    def __init__(self, capacity=LOG_BUFFER_SIZE):
+        super().__init__()
+        self._records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        entry = {'ts': round(record.created, 3), 'level': record.levelname, 'levelno': record.levelno,
+                 'logger': record.name, 'msg': record.getMessage(), **record_fields(record)}
+        if getattr(record, 'suppressed', 0):
+            entry['suppressed'] = record.suppressed
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        self._records.append(entry)
+
+    def records(self, level=None, logger=None, since=None, limit=200):
+        """Los más recientes primero, filtrados por nivel mínimo, prefijo de logger y ts."""
+        levelno = logging.getLevelName(level.upper()) if level else 0
+        if not isinstance(levelno, int):
+            raise ValueError(f"Nivel de log inválido: {level}")
+        result = []
+        for entry in reversed(list(self._records)):
+            if since is not None and entry['ts'] <= since:
+                break
+            if entry['levelno'] < levelno or (logger and not entry['logger'].startswith(logger)):
+                continue
+            result.append({k: v for k, v in entry.items() if k != 'levelno'})
+            if len(result) >= limit:
+                break
+        return result
+
+
+def parse_module_levels(spec):
+    """Convierte "modulo=NIVEL,otro=NIVEL" en un dict {modulo: NIVEL}."""
+    levels = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, level = item.partition('=')
+        if not level:
+            raise ValueError(f"Nivel de módulo inválido: '{item}' (se espera modulo=NIVEL)")
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def setup_logging(level=LOG_LEVEL, module_levels=LOG_LEVELS, fmt=LOG_FORMAT):
+    """
+    Instala el QueueHandler en el logger raíz y arranca el hilo que escribe en
+    la consola. Se puede llamar más de una vez; solo la primera tiene efecto.
+    """
+    global _listener, ring_buffer
+    if _listener is not None:
+        return ring_buffer
+
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    ring_buffer = RingBufferHandler()
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level.upper())
+    for name, module_level in parse_module_levels(module_levels).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    _listener = logging.handlers.QueueListener(log_queue, console, ring_buffer, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return ring_buffer
+
+
+def shutdown_logging():
+    """Escribe lo que quede en la cola y detiene el hilo del listener."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
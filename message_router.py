@@ -0,0 +1,176 @@
+"""
+Enrutamiento de los mensajes MQTT recibidos a sus handlers.
+
+Cada handler se registra para un prefijo de mensaje (la parte antes del
+primer "_": "dc", "ack", ...) y, opcionalmente, un filtro de tópico MQTT con
+comodines ("streelet/+/telemetry"). La tabla se congela al arrancar y la
+resolución (tópico, prefijo) -> handler se guarda en un dict, así rutear un
+mensaje cuesta una búsqueda en vez de una cadena de comparaciones.
+
+Los handlers marcados con pooled=True se ejecutan en un pool de hilos con una
+cola acotada para no frenar el hilo de red de paho; el resto corre en el
+callback. Si la cola del pool está llena el mensaje se descarta y se cuenta.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+ROUTER_WORKERS = int(os.getenv('ROUTER_WORKERS', 2))
+ROUTER_QUEUE_SIZE = int(os.getenv('ROUTER_QUEUE_SIZE', 10000))
+# Combinaciones (tópico, prefijo) resueltas que se recuerdan
+ROUTER_CACHE_SIZE = int(os.getenv('ROUTER_CACHE_SIZE', 10000))
+
+HANDLED = 'handled'
+REJECTED = 'rejected'
+ERROR = 'error'
+DROPPED = 'dropped'
+
+MESSAGES_RECEIVED = metrics.counter('iot_mqtt_messages_received_total', 'Mensajes MQTT recibidos')
+ROUTED = metrics.counter('iot_mqtt_routed_total', 'Mensajes MQTT por handler y resultado', ['handler', 'result'])
+HANDLER_TIME = metrics.histogram('iot_mqtt_handler_seconds', 'Tiempo de ejecución de cada handler', ['handler'])
+
+
+class _Route:
+    __slots__ = ('name', 'prefix', 'topic_filter', 'handler', 'pooled', 'counts', 'total_ms')
+
+    def __init__(self, name, prefix, topic_filter, handler, pooled):
+        self.name = name
+        self.prefix = prefix
+        self.topic_filter = topic_filter
+        self.handler = handler
+        self.pooled = pooled
+        self.counts = dict.fromkeys((HANDLED, REJECTED, ERROR, DROPPED), 0)
+        self.total_ms = 0.0
+
+    def matches(self, topic):
+        return self.topic_filter is None or mqtt.topic_matches_sub(self.topic_filter, topic)
+
+
+class MessageRouter:
+    """
+    Tabla de handlers handler(topic, message) -> bool, donde message es el
+    payload decodificado y sin espacios; retornar False cuenta el mensaje como
+    rechazado. Entre las rutas de un prefijo gana la primera registrada cuyo
+    filtro coincide con el tópico; los mensajes sin ruta van al fallback.
+    """
+
+    def __init__(self, workers=ROUTER_WORKERS, queue_size=ROUTER_QUEUE_SIZE):
+        self._routes = []
+        self._by_prefix = {}
+        self._fallback = None
+        self._cache = {}
+        self._frozen = False
+        self._workers = workers
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def route(self, prefix, handler, name=None, topic_filter=None, pooled=False):
+        """Registra handler para los mensajes "{prefix}_..." (o exactamente "{prefix}")."""
+        if self._frozen:
+            raise RuntimeError("No se pueden agregar rutas con el router en marcha")
+        route = _Route(name or prefix, prefix, topic_filter, handler, pooled)
+        self._routes.append(route)
+        self._by_prefix.setdefault(prefix, []).append(route)
+        return self
+
+    def fallback(self, handler, name='unmatched'):
+        """Handler de los mensajes que no coinciden con ninguna ruta."""
+        if self._frozen:
+            raise RuntimeError("No se pueden agregar rutas con el router en marcha")
+        self._fallback = _Route(name, None, None, handler, False)
+        return self
+
+    def start(self):
+        """Congela la tabla y arranca el pool si alguna ruta lo usa."""
+        self._frozen = True
+        if not self._threads and any(route.pooled for route in self._routes):
+            for i in range(self._workers):
+                thread = threading.Thread(target=self._run, name=f'mqtt-router-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        return self
+
+    def stop(self, timeout=5):
+        """Termina el pool después de atender lo que ya estaba en cola."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def dispatch(self, topic, payload):
+        """Callback de paho: decodifica el payload y lo entrega a su handler."""
+        MESSAGES_RECEIVED.inc()
+        message = payload.decode('utf-8', 'replace').strip()
+        key = (topic, message.partition('_')[0])
+        route = self._cache.get(key)
+        if route is None:
+            route = self._resolve(key)
+        if route is None:
+            logger.debug("Mensaje sin handler en %s: %s", topic, message)
+            return
+        if route.pooled and self._threads:
+            try:
+                self._queue.put_nowait((route, topic, message))
+            except queue.Full:
+                self._count(route, DROPPED)
+                logger.warning("Cola del router llena, mensaje para '%s' descartado", route.name)
+            return
+        self._call(route, topic, message)
+
+    def stats(self):
+        handlers = {}
+        with self._lock:
+            # Las rutas con el mismo nombre (p. ej. varios prefijos) se suman
+            for route in self._routes + ([self._fallback] if self._fallback else []):
+                entry = handlers.setdefault(route.name, {**dict.fromkeys(route.counts, 0), 'total_ms': 0.0})
+                for result, count in route.counts.items():
+                    entry[result] += count
+                entry['total_ms'] += route.total_ms
+        for entry in handlers.values():
+            calls = entry[HANDLED] + entry[REJECTED] + entry[ERROR]
+            entry['avg_ms'] = entry.pop('total_ms') / calls if calls else 0.0
+        return {'handlers': handlers, 'queue_depth': self._queue.qsize(),
+                'workers': len(self._threads), 'cached_routes': len(self._cache)}
+
+    def _resolve(self, key):
+        topic, prefix = key
+        route = next((r for r in self._by_prefix.get(prefix, ()) if r.matches(topic)), self._fallback)
+        if len(self._cache) >= ROUTER_CACHE_SIZE:
+            self._cache.clear()
+        if route is not None:
+            self._cache[key] = route
+        return route
+
+    def _count(self, route, result, elapsed_ms=0.0):
+        with self._lock:
+            route.counts[result] += 1
+            route.total_ms += elapsed_ms
+        ROUTED.inc(route.name, result)
+
+    def _call(self, route, topic, message):
+        start = time.perf_counter()
+        try:
+            result = HANDLED if route.handler(topic, message) is not False else REJECTED
+        except Exception as e:
+            result = ERROR
+            logger.exception("Error en el handler MQTT '%s': %s", route.name, e)
+        elapsed = time.perf_counter() - start
+        HANDLER_TIME.observe(elapsed, route.name)
+        self._count(route, result, elapsed * 1000.0)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._call(*item)
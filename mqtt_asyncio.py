@@ -0,0 +1,76 @@
+import asyncio
+import socket
+import sys
+
+import paho.mqtt.client as mqtt
+
+
+def use_selector_event_loop():
+    """
+    add_reader/add_writer no existen en el ProactorEventLoop de Windows; se
+    fuerza el selector para poder integrar el socket de paho.
+    """
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+
+class AsyncioHelper:
+    """
+    Conecta el socket de un cliente paho al event loop de asyncio, en lugar de
+    usar loop_start() y un hilo de red. Las lecturas y escrituras las dispara
+    el loop cuando el socket está listo, y los callbacks de paho (on_message,
+    on_connect, ...) corren dentro del propio event loop.
+
+    reconnect() puede correr en un executor (la conexión TCP bloquea): los
+    callbacks de socket que paho llama desde ese hilo se pasan al loop.
+    """
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def _in_loop(self, callback, *args):
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        if current is self.loop:
+            callback(*args)
+        else:
+            self.loop.call_soon_threadsafe(callback, *args)
+
+    def on_socket_open(self, client, userdata, sock):
+        self._in_loop(self._socket_open, client, sock)
+
+    def on_socket_close(self, client, userdata, sock):
+        self._in_loop(self._socket_close, sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self._in_loop(self.loop.add_writer, sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop(self.loop.remove_writer, sock)
+
+    def _socket_open(self, client, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def _socket_close(self, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+            self.misc = None
+
+    async def misc_loop(self):
+        # Keepalive y reintentos de QoS que paho hace en loop_misc()
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
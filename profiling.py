@@ -0,0 +1,293 @@
+"""
+Perfilado opcional de las requests HTTP y del callback MQTT (PROFILING=1).
+
+Cada request o mensaje acumula el tiempo que pasó en SQLite (con una conexión
+del pool prestada), publicando en MQTT y serializando la respuesta; el resto
+se informa como "other". Los tiempos son exclusivos: si se serializa mientras
+se lee la BD (p. ej. /devices/export) cada parte cuenta solo lo suyo.
+
+Las ejecuciones que superan PROFILE_SLOW_MS se guardan en un buffer circular
+de PROFILE_STORE_SIZE entradas (ver /debug/profiles) con:
+
+- muestras de la pila tomadas cada PROFILE_SAMPLE_MS por un hilo muestreador
+  mientras la ejecución lleva más de PROFILE_SLOW_MS (solo se muestrea la
+  parte lenta, así el costo es nulo para las rápidas);
+- con PROFILE_CPROFILE_RATE > 0, la salida de cProfile de esa fracción de
+  las ejecuciones (cProfile cuesta mucho más que el muestreo).
+
+Con el perfilado desactivado span() solo consulta una variable del hilo.
+Los datos son por proceso: con varios workers cada uno guarda los suyos.
+"""
+import collections
+import contextlib
+import cProfile
+import functools
+import io
+import itertools
+import logging
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PROFILING = os.getenv('PROFILING', '0') == '1'
+PROFILE_SLOW_MS = float(os.getenv('PROFILE_SLOW_MS', 200))
+PROFILE_SAMPLE_MS = float(os.getenv('PROFILE_SAMPLE_MS', 10))
+PROFILE_STORE_SIZE = int(os.getenv('PROFILE_STORE_SIZE', 50))
+PROFILE_CPROFILE_RATE = float(os.getenv('PROFILE_CPROFILE_RATE', 0))
+# Pilas distintas que se guardan por ejecución y marcos por pila
+PROFILE_MAX_STACKS = 200
+PROFILE_STACK_DEPTH = 40
+
+CATEGORIES = ('sqlite', 'mqtt', 'serialization')
+
+_local = threading.local()
+_NULL_SPAN = contextlib.nullcontext()
+
+
+class _Active:
+    """Ejecución en curso (una request o un mensaje MQTT)."""
+    __slots__ = ('id', 'kind', 'name', 'thread_id', 'started_at', 'started', 'times', 'counts',
+                 'stack', 'samples', 'profiler')
+
+    def __init__(self, profile_id, kind, name):
+        self.id = profile_id
+        self.kind = kind
+        self.name = name
+        self.thread_id = threading.get_ident()
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.times = dict.fromkeys(CATEGORIES, 0.0)
+        self.counts = dict.fromkeys(CATEGORIES, 0)
+        # [categoría, inicio del tramo actual] de los spans abiertos
+        self.stack = []
+        self.samples = collections.Counter()
+        self.profiler = None
+
+
+class _Span:
+    __slots__ = ('active', 'category')
+
+    def __init__(self, active, category):
+        self.active = active
+        self.category = category
+
+    def __enter__(self):
+        now = time.perf_counter()
+        stack = self.active.stack
+        if stack:
+            # El span externo se pausa mientras corre este
+            outer = stack[-1]
+            self.active.times[outer[0]] += now - outer[1]
+        stack.append([self.category, now])
+        self.active.counts[self.category] += 1
+        return self
+
+    def __exit__(self, *exc):
+        now = time.perf_counter()
+        stack = self.active.stack
+        category, started = stack.pop()
+        self.active.times[category] += now - started
+        if stack:
+            stack[-1][1] = now
+        return False
+
+
+def span(category):
+    """Context manager que suma su duración a `category` de la ejecución en curso, si hay una."""
+    active = getattr(_local, 'active', None)
+    return _NULL_SPAN if active is None else _Span(active, category)
+
+
+def spanned(category):
+    """Decorador: como span(), para cada llamada de la función."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_stack(frame):
+    frames = []
+    while frame is not None and len(frames) < PROFILE_STACK_DEPTH:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(frames))
+
+
+class Profiler:
+    """
+    Registra las ejecuciones con begin()/end() (o el decorador wrap()) y
+    guarda las lentas. Un resumen por nombre (endpoint o callback) acumula
+    también las rápidas.
+    """
+
+    def __init__(self, enabled=PROFILING, slow_ms=PROFILE_SLOW_MS, sample_ms=PROFILE_SAMPLE_MS,
+                 store_size=PROFILE_STORE_SIZE, cprofile_rate=PROFILE_CPROFILE_RATE):
+        self.enabled = enabled
+        self.slow_ms = slow_ms
+        self._sample_s = sample_ms / 1000.0
+        self._cprofile_rate = cprofile_rate
+        self._lock = threading.Lock()
+        self._active = {}
+        self._profiles = collections.deque(maxlen=store_size)
+        self._summary = {}
+        self._ids = itertools.count(1)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.enabled and self._sample_s > 0 and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_loop, name='profile-sampler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(timeout)
+            self._thread = None
+
+    # ----------------------------------------------------------
+    # Registro de ejecuciones
+
+    def begin(self, kind, name):
+        """Empieza a medir en el hilo actual. Retorna la ejecución o None si está desactivado."""
+        if not self.enabled:
+            return None
+        active = _Active(next(self._ids), kind, name)
+        if self._cprofile_rate > 0 and random.random() < self._cprofile_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                active.profiler = profiler
+            except ValueError:
+                # Ya hay otro perfilador activo
+                pass
+        _local.active = active
+        with self._lock:
+            self._active[active.thread_id] = active
+        return active
+
+    def end(self, active, status=None):
+        """Termina la ejecución; si fue lenta la guarda en el buffer."""
+        if active is None:
+            return
+        duration_ms = (time.perf_counter() - active.started) * 1000.0
+        if getattr(_local, 'active', None) is active:
+            _local.active = None
+        if active.profiler is not None:
+            active.profiler.disable()
+        with self._lock:
+            if self._active.get(active.thread_id) is active:
+                del self._active[active.thread_id]
+            slow = duration_ms >= self.slow_ms
+            self._update_summary(active, duration_ms, slow)
+        if slow:
+            self._store(active, duration_ms, status)
+
+    def wrap(self, kind, name=None):
+        """Decorador que mide cada llamada de un callback (p. ej. on_message de paho)."""
+        def decorator(function):
+            label = name or function.__name__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                active = self.begin(kind, label)
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.end(active)
+            return wrapper
+        return decorator
+
+    def _update_summary(self, active, duration_ms, slow):
+        # Se llama con el lock tomado
+        entry = self._summary.get(active.name)
+        if entry is None:
+            entry = self._summary[active.name] = {'kind': active.kind, 'count': 0, 'slow': 0, 'total_ms': 0.0,
+                                                  'max_ms': 0.0, **{f'{c}_ms': 0.0 for c in CATEGORIES}}
+        entry['count'] += 1
+        entry['slow'] += int(slow)
+        entry['total_ms'] += duration_ms
+        entry['max_ms'] = max(entry['max_ms'], duration_ms)
+        for category, seconds in active.times.items():
+            entry[f'{category}_ms'] += seconds * 1000.0
+
+    def _store(self, active, duration_ms, status):
+        breakdown = {category: round(seconds * 1000.0, 3) for category, seconds in active.times.items()}
+        breakdown['other'] = round(max(duration_ms - sum(breakdown.values()), 0.0), 3)
+        with self._lock:
+            samples = active.samples.most_common(20)
+            sample_count = sum(active.samples.values())
+        profile = {'id': active.id, 'kind': active.kind, 'name': active.name, 'status': status,
+                   'started_at': round(active.started_at, 3), 'duration_ms': round(duration_ms, 3),
+                   'breakdown_ms': breakdown, 'calls': dict(active.counts),
+                   'samples': sample_count, 'stacks': [{'stack': stack, 'count': count} for stack, count in samples],
+                   'cprofile': None}
+        if active.profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(active.profiler, stream=out).sort_stats('cumulative').print_stats(30)
+            profile['cprofile'] = out.getvalue()
+        with self._lock:
+            self._profiles.append(profile)
+        logger.info("Ejecución lenta %s (%s): %.1f ms", active.name, active.kind, duration_ms,
+                    extra={'profile_id': active.id, 'breakdown_ms': breakdown})
+
+    # ----------------------------------------------------------
+    # Muestreo de pilas
+
+    def _sample_loop(self):
+        slow_s = self.slow_ms / 1000.0
+        while not self._stop.wait(self._sample_s):
+            now = time.perf_counter()
+            with self._lock:
+                running = [a for a in self._active.values() if now - a.started >= slow_s]
+            if not running:
+                continue
+            frames = sys._current_frames()
+            stacks = [(a, _format_stack(frames.get(a.thread_id))) for a in running]
+            with self._lock:
+                for active, stack in stacks:
+                    if stack and (stack in active.samples or len(active.samples) < PROFILE_MAX_STACKS):
+                        active.samples[stack] += 1
+
+    # ----------------------------------------------------------
+    # Lecturas
+
+    def profiles(self, name=None, limit=20):
+        """Las ejecuciones lentas más recientes primero."""
+        with self._lock:
+            profiles = list(self._profiles)
+        result = [p for p in reversed(profiles) if name is None or p['name'] == name]
+        return result[:limit]
+
+    def get(self, profile_id):
+        with self._lock:
+            return next((p for p in self._profiles if p['id'] == profile_id), None)
+
+    def summary(self):
+        """Promedios por nombre: duración y tiempo en cada categoría."""
+        with self._lock:
+            entries = {name: dict(entry) for name, entry in self._summary.items()}
+        for entry in entries.values():
+            count = entry['count']
+            entry['avg_ms'] = round(entry.pop('total_ms') / count, 3)
+            entry['max_ms'] = round(entry['max_ms'], 3)
+            for category in CATEGORIES:
+                entry[f'avg_{category}_ms'] = round(entry.pop(f'{category}_ms') / count, 3)
+        return entries
+
+    def clear(self):
+        with self._lock:
+            self._profiles.clear()
+            self._summary.clear()
@@ -0,0 +1,330 @@
+"""
+Trabajos programados de encendido/apagado (p. ej. encender al atardecer y
+apagar al amanecer).
+
+Cada trabajo apunta a un dispositivo o a un grupo y tiene un horario:
+  {"type": "daily", "at": "18:30", "days": [0, 1, 2, 3, 4]}   hora local (0 = lunes)
+  {"type": "sunset", "offset": -15}                           minutos respecto al sol
+  {"type": "sunrise", "offset": 10}
+  {"type": "once", "at": 1767225600}                          epoch, una sola vez
+
+Los trabajos se guardan en la tabla jobs con su próxima ejecución
+(next_run). El Scheduler mantiene en memoria un heap ordenado por next_run y
+un hilo que duerme hasta el primero: entre ejecuciones no se recorre la
+tabla ni se despierta cada segundo. Los que vencen juntos se entregan en un
+solo lote a on_due(jobs).
+
+Al arrancar se ejecutan los trabajos que se perdieron mientras el servidor
+estaba detenido (hasta SCHEDULER_CATCHUP_S atrás), solo el más reciente de
+cada destino.
+"""
+import datetime
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+
+import database as dbm
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ubicación para calcular amanecer y atardecer (grados, este y norte positivos)
+SCHEDULER_LATITUDE = os.getenv('SCHEDULER_LATITUDE')
+SCHEDULER_LONGITUDE = os.getenv('SCHEDULER_LONGITUDE')
+# Segundos hacia atrás en que se recuperan los trabajos perdidos al arrancar
+SCHEDULER_CATCHUP_S = int(os.getenv('SCHEDULER_CATCHUP_S', 12 * 3600))
+
+# Clave de app_state que cambia con cada alta/edición/baja de trabajos, para
+# que el worker que ejecuta el scheduler recargue los hechos en otro
+JOBS_VERSION_KEY = 'jobs_version'
+
+TARGET_TYPES = ('device', 'group')
+JOB_ACTIONS = ('on', 'off')
+SCHEDULE_TYPES = ('daily', 'sunrise', 'sunset', 'once')
+# Claves que acepta cada tipo de schedule (offset en minutos respecto del sol)
+SCHEDULE_KEYS = {'daily': ('type', 'at', 'days'), 'once': ('type', 'at'),
+                 'sunrise': ('type', 'offset', 'days'), 'sunset': ('type', 'offset', 'days')}
+
+JOBS_FIRED = metrics.counter('iot_scheduled_jobs_fired_total', 'Trabajos programados ejecutados', ['kind'])
+
+
+def _location():
+    if SCHEDULER_LATITUDE is None or SCHEDULER_LONGITUDE is None:
+        return None
+    return float(SCHEDULER_LATITUDE), float(SCHEDULER_LONGITUDE)
+
+
+def sun_times(day, latitude, longitude):
+    """
+    Amanecer y atardecer (epoch) del día `day` con la ecuación de salida del
+    sol (precisión de alrededor de un minuto). Retorna (None, None) si ese día
+    no hay amanecer o atardecer (latitudes polares).
+    """
+    # Día juliano del mediodía UTC de `day` contado desde J2000
+    n = day.toordinal() + 1721425.0 - 2451545.0 + 0.0008
+    mean_solar = n - longitude / 360.0
+    anomaly = math.radians((357.5291 + 0.98560028 * mean_solar) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.02 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = 2451545.0 + mean_solar + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+    phi = math.radians(latitude)
+    cos_hour_angle = ((math.sin(math.radians(-0.833)) - math.sin(phi) * math.sin(declination))
+                      / (math.cos(phi) * math.cos(declination)))
+    if not -1 <= cos_hour_angle <= 1:
+        return None, None
+    hour_angle = math.degrees(math.acos(cos_hour_angle))
+    to_epoch = lambda julian: (julian - 2440587.5) * 86400.0
+    return to_epoch(transit - hour_angle / 360.0), to_epoch(transit + hour_angle / 360.0)
+
+
+def compute_next_run(schedule, after, location=None):
+    """Próxima ejecución (epoch) posterior a `after`, o None si no hay más."""
+    kind = schedule['type']
+    if kind == 'once':
+        return schedule['at'] if schedule['at'] > after else None
+
+    days = schedule.get('days')
+    start = datetime.date.fromtimestamp(after)
+    if kind == 'daily':
+        hour, minute = (int(part) for part in schedule['at'].split(':'))
+        for offset in range(8):
+            day = start + datetime.timedelta(days=offset)
+            if days is not None and day.weekday() not in days:
+                continue
+            candidate = time.mktime((day.year, day.month, day.day, hour, minute, 0, 0, 0, -1))
+            if candidate > after:
+                return candidate
+        return None
+
+    location = location or _location()
+    if location is None:
+        return None
+    # Se empieza un día antes: en husos lejanos el sol del día UTC anterior
+    # puede caer todavía después de `after`
+    for offset in range(-1, 370):
+        day = start + datetime.timedelta(days=offset)
+        if days is not None and day.weekday() not in days:
+            continue
+        sunrise, sunset = sun_times(day, *location)
+        moment = sunrise if kind == 'sunrise' else sunset
+        if moment is None:
+            continue
+        candidate = moment + schedule.get('offset', 0) * 60
+        if candidate > after:
+            return candidate
+    return None
+
+
+def parse_job(data):
+    """
+    Valida el cuerpo de POST/PUT /jobs y retorna el trabajo normalizado
+    {name, target_type, target, action, schedule, enabled}. Lanza ValueError.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Se esperaba un objeto JSON')
+    target_type = data.get('target_type')
+    if target_type not in TARGET_TYPES:
+        raise ValueError('target_type debe ser device o group')
+    target = str(data.get('target') or '').strip()
+    if not target:
+        raise ValueError('Falta target (device_id o grupo)')
+    action = data.get('action')
+    if action not in JOB_ACTIONS:
+        raise ValueError('action debe ser on u off')
+
+    schedule = data.get('schedule')
+    if not isinstance(schedule, dict) or schedule.get('type') not in SCHEDULE_TYPES:
+        raise ValueError(f"schedule.type debe ser uno de: {', '.join(SCHEDULE_TYPES)}")
+    kind = schedule['type']
+    unknown = sorted(set(schedule) - set(SCHEDULE_KEYS[kind]))
+    if unknown:
+        raise ValueError(f"Claves desconocidas en schedule ({kind}): {', '.join(map(str, unknown))}. "
+                         f"Use: {', '.join(SCHEDULE_KEYS[kind])}")
+    normalized = {'type': kind}
+    if kind == 'daily':
+        at = str(schedule.get('at', ''))
+        try:
+            parsed = datetime.datetime.strptime(at, '%H:%M')
+        except ValueError:
+            raise ValueError('schedule.at debe tener el formato HH:MM')
+        normalized['at'] = parsed.strftime('%H:%M')
+    elif kind == 'once':
+        try:
+            normalized['at'] = float(schedule.get('at'))
+        except (TypeError, ValueError):
+            raise ValueError('schedule.at debe ser un epoch en segundos')
+    else:
+        if _location() is None:
+            raise ValueError('Defina SCHEDULER_LATITUDE y SCHEDULER_LONGITUDE para usar sunrise/sunset')
+        offset = schedule.get('offset', 0)
+        if not isinstance(offset, (int, float)) or abs(offset) > 720:
+            raise ValueError('schedule.offset debe ser un número de minutos entre -720 y 720')
+        normalized['offset'] = offset
+    if kind != 'once' and schedule.get('days') is not None:
+        days = schedule['days']
+        if not isinstance(days, list) or not days or not all(isinstance(d, int) and 0 <= d <= 6 for d in days):
+            raise ValueError('schedule.days debe ser una lista de días 0-6 (0 = lunes)')
+        normalized['days'] = sorted(set(days))
+
+    name = str(data.get('name') or f"{action} {target_type} {target}").strip()
+    return {'name': name, 'target_type': target_type, 'target': target, 'action': action,
+            'schedule': normalized, 'enabled': bool(data.get('enabled', True))}
+
+
+class Scheduler:
+    """
+    Ejecuta los trabajos de la tabla jobs a su hora.
+
+    Cada trabajo habilitado tiene una entrada (next_run, id) en un heap. Al
+    crear, editar o borrar trabajos se llama a reload(), que reconstruye el
+    heap desde la BD; una entrada que ya no coincide con el next_run de su
+    trabajo se descarta al llegar a la cima.
+    """
+
+    def __init__(self, on_due, catchup_s=SCHEDULER_CATCHUP_S):
+        self._on_due = on_due
+        self._catchup_s = catchup_s
+        self._cond = threading.Condition()
+        # Serializa reload() con cada lote del hilo (sacar, ejecutar, guardar)
+        self._fire_lock = threading.RLock()
+        self._jobs = {}
+        self._heap = []
+        self._thread = None
+        self._running = False
+        self._version = None
+        self._stats = {'fired': 0, 'caught_up': 0, 'batches': 0, 'errors': 0, 'last_batch_ms': 0.0}
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            with self._fire_lock:
+                missed = self.reload(catch_up=True)
+                if missed:
+                    self._fire(missed, kind='catch_up')
+            self._thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=5):
+        if self._thread is not None:
+            with self._cond:
+                self._running = False
+                self._cond.notify()
+            self._thread.join(timeout)
+            self._thread = None
+
+    def reload(self, catch_up=False):
+        """
+        Vuelve a leer todos los trabajos. Con catch_up retorna los que vencieron
+        sin ejecutarse (el más reciente por destino), les fija last_run y
+        reprograma el resto; sin catch_up (scheduler en marcha) los vencidos
+        quedan en el heap y el hilo los ejecuta enseguida.
+
+        Toma _fire_lock: no corre a la vez que el hilo saca, ejecuta y guarda
+        un lote, así no lee un next_run que el hilo está por reemplazar.
+        """
+        with self._fire_lock:
+            self._version = dbm.get_state(JOBS_VERSION_KEY)
+            jobs = dbm.get_jobs()
+            now = time.time()
+            overdue = [job for job in jobs if job['enabled'] and job['next_run'] is not None
+                       and job['next_run'] <= now] if catch_up else []
+            missed = {}
+            for job in overdue:
+                # Venció mientras ningún proceso ejecutaba el scheduler
+                if now - job['next_run'] <= self._catchup_s:
+                    key = (job['target_type'], job['target'])
+                    if key not in missed or missed[key]['next_run'] < job['next_run']:
+                        missed[key] = job
+            runs = []
+            for job in overdue:
+                if missed.get((job['target_type'], job['target'])) is job:
+                    job['last_run'] = job['next_run']
+                    missed[(job['target_type'], job['target'])] = dict(job)
+                job['next_run'] = compute_next_run(job['schedule'], now)
+                job['enabled'] = job['next_run'] is not None
+                runs.append((job['id'], job['last_run'], job['next_run'], job['enabled']))
+            if runs:
+                dbm.update_job_runs(runs)
+
+            with self._cond:
+                self._jobs = {job['id']: job for job in jobs}
+                self._heap = [(job['next_run'], job['id']) for job in jobs
+                              if job['enabled'] and job['next_run'] is not None]
+                heapq.heapify(self._heap)
+                self._cond.notify()
+            return sorted(missed.values(), key=lambda job: job['next_run'])
+
+    def refresh_if_changed(self):
+        """Recarga si otro worker modificó los trabajos (lee una sola fila de app_state)."""
+        if self._thread is not None and dbm.get_state(JOBS_VERSION_KEY) != self._version:
+            self.reload()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['jobs'] = len(self._jobs)
+            stats['scheduled'] = sum(1 for job in self._jobs.values() if job['enabled'] and job['next_run'])
+            upcoming = [entry for entry in self._heap
+                        if self._jobs.get(entry[1], {}).get('next_run') == entry[0]]
+            stats['next_run'] = min(upcoming)[0] if upcoming else None
+        stats['running'] = self._thread is not None
+        return stats
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            run_at, job_id = heapq.heappop(self._heap)
+            job = self._jobs.get(job_id)
+            if job is None or not job['enabled'] or job['next_run'] != run_at:
+                continue
+            due.append(dict(job))
+            job['last_run'] = run_at
+            job['next_run'] = compute_next_run(job['schedule'], max(now, run_at))
+            job['enabled'] = job['next_run'] is not None
+            if job['enabled']:
+                heapq.heappush(self._heap, (job['next_run'], job_id))
+        return due
+
+    def _fire(self, due, kind='scheduled'):
+        start = time.perf_counter()
+        try:
+            self._on_due(due)
+        except Exception as e:
+            logger.exception("[SCHEDULER] Error al ejecutar %d trabajos: %s", len(due), e)
+            with self._cond:
+                self._stats['errors'] += 1
+        JOBS_FIRED.inc(kind, value=len(due))
+        with self._cond:
+            self._stats['fired' if kind == 'scheduled' else 'caught_up'] += len(due)
+            self._stats['batches'] += 1
+            self._stats['last_batch_ms'] = (time.perf_counter() - start) * 1000.0
+        logger.info("[SCHEDULER] %d trabajos ejecutados (%s)", len(due), kind)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running:
+                    now = time.time()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    # Tope de una hora: un "once" a meses de distancia supera TIMEOUT_MAX
+                    self._cond.wait(min(self._heap[0][0] - now, 3600) if self._heap else None)
+                if not self._running:
+                    return
+            with self._fire_lock:
+                with self._cond:
+                    due = self._pop_due(time.time())
+                    runs = [(job['id'], job['last_run'], job['next_run'], job['enabled'])
+                            for job in (self._jobs[d['id']] for d in due)]
+                if not due:
+                    continue
+                self._fire(due)
+                try:
+                    dbm.update_job_runs(runs)
+                except Exception as e:
+                    logger.exception("[SCHEDULER] Error al guardar la próxima ejecución: %s", e)
@@ -0,0 +1,166 @@
+"""
+Serialización de la lista de dispositivos para respuestas grandes.
+
+El JSON se genera por bloques de SERIALIZE_CHUNK dispositivos y se envía como
+respuesta en streaming, así el cuerpo nunca se arma completo en memoria.
+Además de la forma clásica (una lista de objetos) hay dos formas compactas:
+
+- compact: lista de objetos sin el duplicado device_id.
+- columns: un objeto con una lista por campo ({"ids": [...], "status": [...]});
+  los nombres de los campos no se repiten por dispositivo.
+
+La respuesta se comprime con brotli (si el módulo está instalado) o gzip según
+el Accept-Encoding del cliente, salvo las que se estima que ocupan menos de
+COMPRESS_MIN_BYTES.
+"""
+import json
+import logging
+import os
+import zlib
+
+from flask import Response
+
+import metrics
+import profiling
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Dispositivos por bloque de JSON generado
+SERIALIZE_CHUNK = int(os.getenv('SERIALIZE_CHUNK', 1000))
+# Las respuestas más chicas que esto se envían sin comprimir
+COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.getenv('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 5))
+
+DEVICE_FIELDS = ('id', 'name', 'topic', 'ip', 'status', 'device_status', 'last_seen')
+# Nombre de la lista de cada campo en la forma columnar
+COLUMN_KEYS = {'id': 'ids'}
+# Tamaño estimado (bytes) de un dispositivo serializado, para decidir si comprimir
+ESTIMATED_DEVICE_BYTES = 120
+
+ROWS = 'rows'
+COMPACT = 'compact'
+COLUMNS = 'columns'
+SHAPES = (ROWS, COMPACT, COLUMNS)
+
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+RAW_BYTES = metrics.counter('iot_response_raw_bytes_total', 'Bytes de JSON generados antes de comprimir', ['encoding'])
+SENT_BYTES = metrics.counter('iot_response_sent_bytes_total', 'Bytes de JSON enviados', ['encoding'])
+
+_dumps = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def parse_fields(value):
+    """Convierte "id,status" en una tupla de campos válidos; None retorna todos."""
+    if not value:
+        return DEVICE_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in value.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in DEVICE_FIELDS]
+    if unknown or not fields:
+        raise ValueError(f"Campos inválidos: {', '.join(unknown) or value}. Use: {', '.join(DEVICE_FIELDS)}")
+    return fields
+
+
+def iter_rows(columns, fields, with_device_id=False, chunk=SERIALIZE_CHUNK):
+    """
+    Genera una lista JSON de objetos a partir de {campo: [valores]}. Solo los
+    objetos de un bloque existen a la vez. with_device_id agrega el duplicado
+    device_id de la respuesta clásica.
+    """
+    count = len(columns[fields[0]])
+    yield '['
+    for start in range(0, count, chunk):
+        rows = [dict(zip(fields, values))
+                for values in zip(*(columns[field][start:start + chunk] for field in fields))]
+        if with_device_id:
+            for row in rows:
+                row['device_id'] = row['id']
+        yield (',' if start else '') + _dumps(rows)[1:-1]
+    yield ']'
+
+
+def iter_columns(columns, fields, header, chunk=SERIALIZE_CHUNK):
+    """Genera {**header, "ids": [...], "<campo>": [...]} bloque por bloque."""
+    yield _dumps(header)[:-1]
+    for index, field in enumerate(fields):
+        separator = ',' if header or index else ''
+        yield f"{separator}{_dumps(COLUMN_KEYS.get(field, field))}:["
+        values = columns[field]
+        for start in range(0, len(values), chunk):
+            yield (',' if start else '') + _dumps(values[start:start + chunk])[1:-1]
+        yield ']'
+    yield '}'
+
+
+def choose_encoding(accept_encodings, size_hint):
+    """Retorna 'br', 'gzip' o None según lo que acepta el cliente y el tamaño estimado."""
+    if size_hint < COMPRESS_MIN_BYTES:
+        return None
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def _compressor(encoding):
+    """Retorna (process, finish) del compresor de `encoding`."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        return compressor.process, compressor.finish
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    return compressor.compress, compressor.flush
+
+
+def encode(chunks, encoding=None):
+    """Codifica los fragmentos en UTF-8 y, si encoding no es None, los comprime a medida que llegan."""
+    process, finish = _compressor(encoding) if encoding else (None, None)
+    label = encoding or 'identity'
+    raw = sent = 0
+    chunks = iter(chunks)
+    try:
+        while True:
+            # Con PROFILING=1 generar y comprimir cada fragmento cuenta como
+            # "serialization" (no el tiempo que el servidor tarda en enviarlo)
+            with profiling.span('serialization'):
+                chunk = next(chunks, None)
+                if chunk is None:
+                    data = finish() if finish is not None else b''
+                else:
+                    data = chunk.encode('utf-8')
+                    raw += len(data)
+                    if process is not None:
+                        data = process(data)
+            if data:
+                sent += len(data)
+                yield data
+            if chunk is None:
+                break
+    finally:
+        # También si el cliente se desconecta a mitad de la respuesta
+        RAW_BYTES.inc(label, value=raw)
+        SENT_BYTES.inc(label, value=sent)
+
+
+def _response(body, encoding, status=200, content_type='application/json'):
+    response = Response(body, status=status, content_type=content_type)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def stream_response(chunks, accept_encodings, size_hint, content_type='application/json'):
+    """Respuesta en streaming (Transfer-Encoding: chunked), comprimida si conviene."""
+    encoding = choose_encoding(accept_encodings, size_hint)
+    return _response(encode(chunks, encoding), encoding, content_type=content_type)
+
+
+def json_response(obj, accept_encodings, status=200):
+    """Como jsonify, pero compacta y comprimida si el cuerpo supera COMPRESS_MIN_BYTES."""
+    with profiling.span('serialization'):
+        text = _dumps(obj)
+    encoding = choose_encoding(accept_encodings, len(text))
+    return _response(b''.join(encode([text], encoding)), encoding, status)
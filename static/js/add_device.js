@@ -5,7 +5,8 @@ Vue.createApp({
         group: "",
         name: "",
         loading: false,
-        message: ""
+        message: "",
+        jobId: null
       };
     },
     methods: {
@@ -21,16 +22,13 @@ Vue.createApp({
             body: JSON.stringify({ grupo: this.group, name: this.name })
           });
           const data = await response.json();
+          this.message = data.message || "Error en la configuración.";
+          this.step = 2;
           if (response.ok) {
-            this.message = data.message || "Configuración enviada correctamente.";
-            this.step = 2;
-            // Redireccionar al dashboard después de un breve retraso para mostrar el mensaje y el loader
-            setTimeout(() => {
-              window.location.href = "/";
-            }, 8000); // Espera 8 segundos
+            // El ESP se configura en segundo plano; se consulta el trabajo hasta que termine
+            this.jobId = data.job_id;
+            this.pollJob(data.status_url);
           } else {
-            this.message = data.message || "Error en la configuración.";
-            this.step = 2;
             this.loading = false; // Detener el loader en caso de error
           }
         } catch (error) {
@@ -39,6 +37,33 @@ Vue.createApp({
           this.step = 2;
           this.loading = false; // Detener el loader en caso de error
         }
+      },
+      async pollJob(statusUrl) {
+        try {
+          const response = await fetch(statusUrl);
+          const job = await response.json();
+          if (!response.ok) {
+            this.message = job.message || "No se pudo consultar el estado de la configuración.";
+            this.loading = false;
+            return;
+          }
+          this.message = job.message || this.message;
+          if (!job.done) {
+            setTimeout(() => this.pollJob(statusUrl), 1000);
+            return;
+          }
+          this.loading = false;
+          if (job.state === "succeeded") {
+            // Redireccionar al dashboard después de un breve retraso para mostrar el mensaje
+            setTimeout(() => {
+              window.location.href = "/";
+            }, 3000);
+          }
+        } catch (error) {
+          // Al cambiar de red (AP del ESP -> WiFi) pueden fallar algunas consultas
+          console.error("Error al consultar la configuración:", error);
+          setTimeout(() => this.pollJob(statusUrl), 2000);
+        }
       }
     }
-  }).mount("#app");
\ No newline at end of file
+  }).mount("#app");
@@ -9,7 +9,9 @@ new Vue({
             { title: 'Device Categories', value: 0, subtitle: 'Categories in use', colorClass: 'bg-orange' },
             { title: 'Device Jobs', value: 0, subtitle: 'Scheduled Jobs', colorClass: 'bg-red' }
         ],
-        devices: []
+        devices: [],
+        deviceStream: null,
+        summaryTimer: null
     },
     methods: {
         // Métodos de UI
@@ -19,31 +21,89 @@ new Vue({
 
         // Métodos de Dispositivos
         fetchDevices() {
-            fetch('/devices')
+            // Forma columnar: solo los campos que usan las tarjetas
+            fetch('/devices?shape=columns&fields=id,name,status,last_seen')
                 .then(response => response.json())
                 .then(data => {
-                    this.devices = data.map(device => ({
-                        id: device.id,
-                        name: device.name || device_id,
-                        status: device.status,
-                        device_status: device.status === 'online' ? 1 : 0,
-                        last_seen: device.last_seen,
-                        iconUrl: 'https://cdn4.iconfinder.com/data/icons/minimal-set-four/32/minimal-86-512.png',
-                        gradientBg: getDeterministicGradient(device.status, device.id)
+                    this.devices = data.ids.map((id, i) => toDeviceCard({
+                        id: id,
+                        name: data.name[i],
+                        status: data.status[i],
+                        last_seen: data.last_seen[i]
                     }));
                     this.updateDeviceStats();
                 })
                 .catch(error => console.error('Error fetching devices:', error));
         },
+        // Recibe la lista inicial y luego solo los cambios por Server-Sent Events
+        connectDeviceStream() {
+            if (this.deviceStream) {
+                this.deviceStream.close();
+            }
+            const stream = new EventSource('/devices/stream');
+            stream.addEventListener('snapshot', event => {
+                this.devices = JSON.parse(event.data).map(toDeviceCard);
+                this.updateDeviceStats();
+            });
+            stream.addEventListener('upsert', event => {
+                const card = toDeviceCard(JSON.parse(event.data).device);
+                const index = this.devices.findIndex(d => d.id === card.id);
+                if (index === -1) {
+                    this.devices.push(card);
+                } else {
+                    this.devices.splice(index, 1, card);
+                }
+                this.updateDeviceStats();
+            });
+            stream.addEventListener('delete', event => {
+                const id = JSON.parse(event.data).id;
+                this.devices = this.devices.filter(d => d.id !== id);
+                this.updateDeviceStats();
+            });
+            stream.addEventListener('resync', () => {
+                // El servidor pide reconectar para enviar un snapshot nuevo
+                this.connectDeviceStream();
+            });
+            // Si la conexión se cae, EventSource reintenta solo y recibe otro snapshot.
+            // Si el servidor rechaza el stream (503 con workers sync) queda cerrado
+            // y se pasa a consultar la lista periódicamente.
+            stream.onerror = error => {
+                console.error('Error en el stream de dispositivos:', error);
+                if (stream.readyState === EventSource.CLOSED) {
+                    this.deviceStream = null;
+                    this.startPolling();
+                }
+            };
+            this.deviceStream = stream;
+        },
+        // Actualiza la lista cada 2 segundos (sin EventSource o sin stream disponible)
+        startPolling() {
+            this.fetchDevices();
+            setInterval(() => {
+                this.fetchDevices();
+            }, 2000);
+        },
         toggleDevicePower(device) {
             const action = device.device_status === 1 ? 'off' : 'on';
-
-            fetch(`/devices/${device.id}/power/${action}`, {
+            // Una clave por clic: los reintentos la repiten y el servidor no
+            // publica el comando dos veces si la primera request sí llegó
+            const idempotencyKey = `${device.id}-${action}-${Date.now()}-${Math.random().toString(36).slice(2)}`;
+            const send = attempt => fetch(`/devices/${device.id}/power/${action}`, {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    'Idempotency-Key': idempotencyKey
                 }
             })
+            .then(response => response.status >= 500 && attempt < 2 ? send(attempt + 1) : response,
+                  error => {
+                      if (attempt < 2) {
+                          return send(attempt + 1);
+                      }
+                      throw error;
+                  });
+
+            send(0)
             .then(response => {
                 if (!response.ok) {
                     throw new Error(`Error HTTP: ${response.status}`);
@@ -51,7 +111,10 @@ new Vue({
                 return response.json();
             })
             .then(data => {
-                if (data.message) {
+                if (data.dispatch === 'buffered') {
+                    // El broker no está disponible: el estado cambia cuando el comando salga
+                    console.warn(data.message);
+                } else if (data.message) {
                     device.device_status = device.device_status === 1 ? 0 : 1;
                     device.status = action === 'on' ? 'online' : 'offline';
                     console.log(`Dispositivo ${device.id} ahora está ${action}`);
@@ -66,8 +129,34 @@ new Vue({
         showDeviceInfo(device) {
             alert(`Mostrar información de ${device.name} (ID: ${device.id})`);
         },
+        // Las tarjetas se llenan con /devices/summary (conteos calculados en el servidor).
+        // Los cambios llegan en ráfagas, así que se consulta como máximo una vez por segundo.
         updateDeviceStats() {
-            this.stats[0].value = this.devices.length; // Actualizar el número total de dispositivos
+            if (this.summaryTimer) {
+                return;
+            }
+            this.summaryTimer = setTimeout(() => {
+                this.summaryTimer = null;
+                this.fetchSummary();
+                this.fetchJobsSummary();
+            }, 1000);
+        },
+        fetchSummary() {
+            fetch('/devices/summary')
+                .then(response => response.json())
+                .then(summary => {
+                    this.stats[0].value = summary.status.online || 0;
+                    this.stats[1].value = Object.values(summary.groups).filter(g => (g.online || 0) > 0).length;
+                })
+                .catch(error => console.error('Error fetching device summary:', error));
+        },
+        fetchJobsSummary() {
+            fetch('/jobs/summary')
+                .then(response => response.json())
+                .then(summary => {
+                    this.stats[3].value = summary.enabled;
+                })
+                .catch(error => console.error('Error fetching jobs summary:', error));
         },
         addDevice() {
             window.location.href = '/add_device';
@@ -94,7 +183,9 @@ new Vue({
                 .then(data => {
                     if (data.message) {
                         console.log(data.message);
-                        this.fetchDevices(); // Recargar la lista de dispositivos
+                        if (!this.deviceStream) {
+                            this.fetchDevices(); // Recargar la lista si no hay stream
+                        }
                     } else if (data.error) {
                         console.error('Error al eliminar el dispositivo:', data.error);
                         alert(data.error);
@@ -108,14 +199,29 @@ new Vue({
         }
     },
     mounted() {
-        this.fetchDevices();
-        // Actualizar la lista de dispositivos cada 2 segundos
-        setInterval(() => {
-            this.fetchDevices();
-        }, 2000);
+        this.fetchSummary();
+        this.fetchJobsSummary();
+        if (window.EventSource) {
+            this.connectDeviceStream();
+        } else {
+            this.startPolling();
+        }
     }
 });
 
+// Convierte un dispositivo de la API en la tarjeta que muestra el dashboard
+function toDeviceCard(device) {
+    return {
+        id: device.id,
+        name: device.name || device.id,
+        status: device.status,
+        device_status: device.status === 'online' ? 1 : 0,
+        last_seen: device.last_seen,
+        iconUrl: 'https://cdn4.iconfinder.com/data/icons/minimal-set-four/32/minimal-86-512.png',
+        gradientBg: getDeterministicGradient(device.status, device.id)
+    };
+}
+
 // Función auxiliar fuera de Vue para asignar gradientes (determinista)
 function getDeterministicGradient(status, id) {
     const gradientsOnline = [
@@ -0,0 +1,421 @@
+"""
+Benchmarks reproducibles del manager, todo local: un broker de prueba en el
+mismo proceso (testing/mqtt_stand_in.py) y una BD SQLite temporal.
+
+Mide:
+  ingest      mensajes/s de mqtt_on_message (solo el callback) y de punta a
+              punta hasta que el lote queda escrito, llamando al callback
+              directo y publicando por el broker.
+  devices     latencia de GET /devices (completo, 304 y ?since=) con 100, 1k y
+              10k dispositivos.
+  power       latencia de POST /devices/<id>/power/on hasta que el mensaje
+              llega a un suscriptor del broker, y de un comando de grupo.
+  heartbeats  tiempo de check_heartbeats() y de mark_devices_offline() con
+              todos los dispositivos vencidos.
+
+Los resultados se guardan en JSON; con --compare se comparan contra una
+corrida anterior:
+
+    python testing/benchmark_suite.py --output bench.json
+    python testing/benchmark_suite.py --compare bench.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paho.mqtt
+import paho.mqtt.client as mqtt
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mqtt_stand_in import MqttStandIn  # noqa: E402
+
+BENCH_TOPIC_PREFIX = 'streelet/bench'
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+@contextlib.contextmanager
+def quiet(level=logging.INFO):
+    """
+    Descarta los mensajes de logging del manager hasta `level` inclusive
+    mientras dura el bloque (los INFO por request o por lote ensucian la
+    salida y su formateo entraría en la medición).
+    """
+    previous = logging.root.manager.disable
+    logging.disable(max(level, previous))
+    try:
+        yield
+    finally:
+        logging.disable(previous)
+
+
+def summarize(samples_ms):
+    if not samples_ms:
+        return {'count': 0}
+    ordered = sorted(samples_ms)
+    pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+    return {'count': len(ordered), 'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'max_ms': round(ordered[-1], 3), 'mean_ms': round(sum(ordered) / len(ordered), 3)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+class Probe:
+    """Cliente suscrito a streelet/# que anota cuándo llega cada payload."""
+
+    def __init__(self, host, port):
+        self.client = mqtt.Client(client_id='bench-probe')
+        self._lock = threading.Lock()
+        self._waiting = {}
+        self.received = 0
+        self.client.on_message = self._on_message
+        connected = threading.Event()
+        self.client.on_connect = lambda c, u, f, rc: (c.subscribe('streelet/#'), connected.set())
+        self.client.connect(host, port)
+        self.client.loop_start()
+        connected.wait(5)
+        time.sleep(0.2)
+
+    def expect(self, payload):
+        event = threading.Event()
+        with self._lock:
+            self._waiting[payload] = [event, None]
+        return event
+
+    def arrival(self, payload):
+        with self._lock:
+            return self._waiting.pop(payload)[1]
+
+    def _on_message(self, client, userdata, msg):
+        now = time.perf_counter()
+        with self._lock:
+            self.received += 1
+            entry = self._waiting.get(msg.payload.decode('utf-8', 'replace'))
+            if entry is not None:
+                entry[1] = now
+                entry[0].set()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class BenchmarkSuite:
+    def __init__(self, args):
+        self.args = args
+        self.results = {}
+
+    def setup(self):
+        self.workdir = tempfile.mkdtemp(prefix='iot-bench-')
+        self.broker = MqttStandIn()
+        port = self.broker.start()
+        os.environ.update({
+            'MQTT_BROKER_HOST': '127.0.0.1',
+            'MQTT_PORT': str(port),
+            # Que el monitor de heartbeats no interfiera con las mediciones
+            'HEARTBEAT_TIMEOUT': '86400',
+            'DEPLOY_MODE': 'single',
+            'INGEST_MODE': 'embedded',
+        })
+        os.chdir(self.workdir)
+        log(f"[BENCH] BD temporal en {self.workdir}, broker de prueba en 127.0.0.1:{port}")
+        with quiet():
+            import app
+            app.set_wifi_credentials({'ssid': 'bench', 'password': 'bench'})
+        self.app = app
+        self.dbm = app.dbm
+        self.http = app.app.test_client()
+        self.probe = Probe('127.0.0.1', port)
+        # Esperar a que el cliente del manager esté conectado y suscrito
+        deadline = time.monotonic() + 10
+        while not app.bk.get_stats()['connected'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(0.3)
+
+    def teardown(self):
+        self.probe.stop()
+        with quiet():
+            self.app.ingest_queue.stop()
+            self.app.heartbeat_monitor.stop()
+            self.app.history_recorder.stop()
+            self.app.bk.stop_network_loop(self.app.client)
+        self.broker.stop()
+
+    # ----------------------------------------------------------
+    # Preparación de datos
+
+    def populate(self, count, last_seen=None):
+        """Deja exactamente `count` dispositivos en la tabla y recarga el registro."""
+        last_seen = int(time.time()) if last_seen is None else last_seen
+        with self.dbm.get_connection() as conn:
+            conn.execute("DELETE FROM devices")
+        rows = [(f"b{i:06x}", f"Bench{i}", f"{BENCH_TOPIC_PREFIX}{i % self.args.groups}",
+                 f"10.1.{(i >> 8) & 255}.{i & 255}", last_seen) for i in range(count)]
+        for i in range(0, len(rows), 1000):
+            self.dbm.upsert_devices(rows[i:i + 1000], allow_insert=True)
+        with quiet():
+            self.app.registry.invalidate()
+        return [row[0] for row in rows]
+
+    def wait_ingest_drained(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            s = self.app.ingest_queue.stats()
+            processed = (s['rows_updated'] + s['rows_inserted'] + s['rows_skipped'] + s['rows_rejected']
+                         + s['coalesced'])
+            if s['queue_depth'] == 0 and processed >= s['received']:
+                return True
+            time.sleep(0.005)
+        return False
+
+    # ----------------------------------------------------------
+    # Benchmarks
+
+    def bench_ingest(self):
+        messages, devices = self.args.ingest_messages, self.args.ingest_devices
+        self.populate(0)
+        self.dbm.set_state(self.app.ingest.ADD_DEVICE_SESSIONS_KEY, 1)
+        payloads = [f"dc_i{i % devices:05x}_1_10.2.{(i % devices) >> 8 & 255}.{i % devices & 255}"
+                    f"_bench{i % self.args.groups}_Ingest{i % devices}".encode() for i in range(messages)]
+
+        class Msg:
+            topic = 'streelet'
+
+            def __init__(self, payload):
+                self.payload = payload
+
+        results = {'messages': messages, 'devices': devices}
+        # 1) Callback directo: cuánto tarda mqtt_on_message en volver y cuánto
+        #    hasta que el último lote queda escrito
+        batches_before = self.app.ingest_queue.stats()['batches']
+        msgs = [Msg(p) for p in payloads]
+        with quiet():
+            start = time.perf_counter()
+            for msg in msgs:
+                self.app.mqtt_on_message(None, None, msg)
+            callback_s = time.perf_counter() - start
+            drained = self.wait_ingest_drained()
+            total_s = time.perf_counter() - start
+        stats = self.app.ingest_queue.stats()
+        results['callback'] = {
+            'callback_msgs_per_s': round(messages / callback_s),
+            'end_to_end_msgs_per_s': round(messages / total_s),
+            'end_to_end_s': round(total_s, 3),
+            'drained': drained,
+            'batches': stats['batches'] - batches_before,
+            'dropped': stats['dropped'],
+            'avg_flush_ms': round(stats['avg_flush_ms'], 3),
+            'max_flush_ms': round(stats['max_flush_ms'], 3),
+        }
+
+        # 2) Por el broker: publicar con paho y esperar a que todo quede escrito
+        received_before = self.app.ingest_queue.stats()['received']
+        publisher = mqtt.Client(client_id='bench-publisher')
+        publisher.connect('127.0.0.1', int(os.environ['MQTT_PORT']))
+        publisher.loop_start()
+        with quiet():
+            start = time.perf_counter()
+            for payload in payloads:
+                publisher.publish('streelet', payload)
+            deadline = time.monotonic() + 60
+            while (self.app.ingest_queue.stats()['received'] - received_before < messages
+                   and time.monotonic() < deadline):
+                time.sleep(0.005)
+            delivered_s = time.perf_counter() - start
+            drained = self.wait_ingest_drained()
+            total_s = time.perf_counter() - start
+        publisher.loop_stop()
+        publisher.disconnect()
+        received = self.app.ingest_queue.stats()['received'] - received_before
+        results['mqtt'] = {
+            'received': received,
+            'delivered_msgs_per_s': round(received / delivered_s),
+            'end_to_end_msgs_per_s': round(received / total_s),
+            'end_to_end_s': round(total_s, 3),
+            'drained': drained,
+        }
+        self.dbm.set_state(self.app.ingest.ADD_DEVICE_SESSIONS_KEY, 0)
+        self.results['ingest'] = results
+
+    def _time_requests(self, path, count, headers=None):
+        samples, size, status = [], 0, None
+        for _ in range(count):
+            start = time.perf_counter()
+            response = self.http.get(path, headers=headers or {})
+            body = response.get_data()
+            samples.append((time.perf_counter() - start) * 1000.0)
+            size, status = len(body), response.status_code
+        return {**summarize(samples), 'bytes': size, 'status': status}
+
+    def bench_devices(self):
+        results = {}
+        for size in self.args.sizes:
+            ids = self.populate(size)
+            count = max(10, self.args.requests * 1000 // max(size, 1000))
+            full = self._time_requests('/devices', count)
+            etag = self.http.get('/devices').headers['ETag']
+            not_modified = self._time_requests('/devices', count, headers={'If-None-Match': etag})
+            # Delta después de cambiar 1% de los dispositivos
+            version = self.app.registry.version
+            with quiet():
+                for device_id in ids[:max(1, size // 100)]:
+                    self.app.registry.upsert(device_id, device_status=1)
+            delta = self._time_requests(f'/devices?since={version}', count)
+            results[str(size)] = {'full': full, 'not_modified': not_modified, 'since_1pct': delta}
+            log(f"[BENCH] GET /devices con {size}: p50={full['p50_ms']}ms p95={full['p95_ms']}ms")
+        self.results['devices'] = results
+
+    def bench_power(self):
+        ids = self.populate(self.args.power_devices)
+        samples_http, samples_e2e, lost = [], [], 0
+        with quiet():
+            for i in range(self.args.commands):
+                device_id = ids[i % len(ids)]
+                action = 'on' if (i // len(ids)) % 2 == 0 else 'off'
+                arrived = self.probe.expect(f"{action}_{device_id}")
+                start = time.perf_counter()
+                response = self.http.post(f'/devices/{device_id}/power/{action}')
+                samples_http.append((time.perf_counter() - start) * 1000.0)
+                if response.status_code != 200 or not arrived.wait(5):
+                    lost += 1
+                    continue
+                samples_e2e.append((self.probe.arrival(f"{action}_{device_id}") - start) * 1000.0)
+
+            # Comando de grupo: desde el POST hasta que llega el último mensaje
+            group_ids = self.app.registry.devices_in_topic(f"{BENCH_TOPIC_PREFIX}0")
+            events = [(device_id, self.probe.expect(f"on_{device_id}")) for device_id in group_ids]
+            start = time.perf_counter()
+            response = self.http.post('/groups/bench0/power/on')
+            http_ms = (time.perf_counter() - start) * 1000.0
+            group_lost = sum(1 for _, event in events if not event.wait(10))
+            last_arrival = max((self.probe.arrival(f"on_{d}") or start) for d, _ in events)
+
+        self.results['power'] = {
+            'devices': len(ids),
+            'single': {'http': summarize(samples_http), 'publish_end_to_end': summarize(samples_e2e), 'lost': lost},
+            'group': {'devices': len(group_ids), 'status': response.status_code, 'http_ms': round(http_ms, 3),
+                      'all_delivered_ms': round((last_arrival - start) * 1000.0, 3), 'lost': group_lost},
+        }
+        log(f"[BENCH] power: p50 end-to-end={self.results['power']['single']['publish_end_to_end'].get('p50_ms')}ms")
+
+    def bench_heartbeats(self):
+        results = {}
+        for size in self.args.sizes:
+            sweep, batch = [], []
+            for _ in range(self.args.repeat):
+                self.populate(size, last_seen=int(time.time()) - 3600)
+                start = time.perf_counter()
+                with quiet():
+                    marked = self.dbm.check_heartbeats(timeout=60)
+                sweep.append((time.perf_counter() - start) * 1000.0)
+
+                ids = self.populate(size, last_seen=int(time.time()) - 3600)
+                start = time.perf_counter()
+                self.dbm.mark_devices_offline(ids, int(time.time()) - 60)
+                batch.append((time.perf_counter() - start) * 1000.0)
+            results[str(size)] = {'check_heartbeats': summarize(sweep), 'mark_devices_offline': summarize(batch),
+                                  'marked': marked}
+            log(f"[BENCH] check_heartbeats con {size}: p50={results[str(size)]['check_heartbeats']['p50_ms']}ms")
+        self.results['heartbeats'] = results
+
+    def run(self):
+        self.setup()
+        try:
+            for name in self.args.only or ['ingest', 'devices', 'power', 'heartbeats']:
+                log(f"[BENCH] {name}...")
+                getattr(self, f'bench_{name}')()
+        finally:
+            self.teardown()
+        return {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'paho_mqtt': paho.mqtt.__version__,
+                'platform': platform.platform(),
+                'args': {k: v for k, v in vars(self.args).items() if k not in ('output', 'compare')},
+            },
+            'results': self.results,
+        }
+
+
+def flatten(data, prefix=''):
+    flat = {}
+    for key, value in data.items():
+        path = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(previous, current, threshold):
+    """Imprime las métricas que cambiaron más de `threshold` (fracción) entre corridas."""
+    before, after = flatten(previous['results']), flatten(current['results'])
+    log(f"[BENCH] Comparando con {previous['meta'].get('commit')} ({previous['meta'].get('timestamp')})")
+    for key in sorted(before.keys() & after.keys()):
+        old, new = before[key], after[key]
+        if old and abs(new - old) / abs(old) >= threshold:
+            # En *_per_s más es mejor; en los tiempos (*_ms, *_s) menos es mejor
+            better = new > old if key.endswith('_per_s') else new < old
+            mark = 'mejor' if better else 'PEOR'
+            log(f"  {key}: {old} -> {new} ({(new - old) / old:+.0%}, {mark})")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks locales de IOT Devices Web Manager")
+    parser.add_argument('--only', nargs='+', choices=['ingest', 'devices', 'power', 'heartbeats'])
+    parser.add_argument('--sizes', type=lambda s: [int(x) for x in s.split(',')], default=[100, 1000, 10000])
+    parser.add_argument('--groups', type=int, default=20)
+    parser.add_argument('--ingest-messages', type=int, default=20000)
+    parser.add_argument('--ingest-devices', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=100,
+                        help="requests por tamaño (se reduce proporcionalmente por encima de 1000 dispositivos)")
+    parser.add_argument('--power-devices', type=int, default=1000)
+    parser.add_argument('--commands', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help="archivo JSON de salida (por defecto bench-<fecha>.json)")
+    parser.add_argument('--compare', help="JSON de una corrida anterior para comparar")
+    parser.add_argument('--threshold', type=float, default=0.1)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    output = os.path.abspath(args.output or f"bench-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    report = BenchmarkSuite(args).run()
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    log(f"[BENCH] Resultados guardados en {output}")
+    if previous is not None:
+        compare(previous, report, args.threshold)
+    print(json.dumps(report['results'], indent=2))
+
+
+if __name__ == '__main__':
+    main()
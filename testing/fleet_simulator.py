@@ -0,0 +1,430 @@
+"""
+Simulador de una flota de ESP contra un broker MQTT (y opcionalmente contra
+el manager) para medir cuántos dispositivos soporta una instancia.
+
+Cada dispositivo virtual:
+  - se anuncia con "dc_{id}_1_{ip}_{group}_{name}" en el tópico "streelet"
+    cada --interval segundos (con jitter),
+  - está suscrito a "streelet/{group}" y responde a "on_{id}" / "off_{id}"
+    confirmando con "ack_{id}_{on|off}" y volviendo a anunciarse, y a "reset"
+    con "ack_{id}_reset" y reiniciándose (se calla unos segundos y vuelve a
+    anunciarse). --ack-loss descarta una fracción de las confirmaciones para
+    ejercitar los reintentos del manager; --no-ack simula firmware sin ack.
+
+Escenarios:
+  steady        solo anuncios periódicos.
+  reboot-storm  a los --storm-at segundos se cae una fracción de la flota y
+                vuelve toda junta (corte de luz de un barrio).
+  connect-storm todos se conectan y anuncian a la vez al arrancar.
+
+Con --manager-url además se envían comandos por la API HTTP (--command-rate)
+y se escucha /devices/stream para medir cuánto tarda el manager en ver
+online a los dispositivos que vuelven de un reinicio. Los dispositivos
+nuevos solo se registran si hay una página de alta abierta (--register la
+abre) o si el ingest corre con --accept-new.
+
+Ejemplo:
+    python testing/fleet_simulator.py --devices 2000 --groups 20 --duration 120 \\
+        --scenario reboot-storm --manager-url http://localhost:5000 --register --json report.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+import requests
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mqtt_asyncio import AsyncioHelper, use_selector_event_loop  # noqa: E402
+
+load_dotenv()
+
+MQTT_BROKER_HOST = os.getenv("MQTT_BROKER_HOST", "localhost")
+MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
+ANNOUNCE_TOPIC = "streelet"
+
+
+class LatencyStats:
+    """Acumula latencias en ms y calcula percentiles al final."""
+
+    def __init__(self):
+        self.samples = []
+
+    def add(self, ms):
+        self.samples.append(ms)
+
+    def summary(self):
+        if not self.samples:
+            return {'count': 0}
+        ordered = sorted(self.samples)
+        pick = lambda q: round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+        return {'count': len(ordered), 'min': round(ordered[0], 2), 'p50': pick(0.50),
+                'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 2),
+                'avg': round(sum(ordered) / len(ordered), 2)}
+
+
+class VirtualDevice:
+    __slots__ = ('device_id', 'group', 'name', 'ip', 'power', 'client', 'task',
+                 'announced_at', 'command_sent', 'reboot_at')
+
+    def __init__(self, index, group, prefix):
+        self.device_id = f"{prefix}{index:05x}"
+        self.group = group
+        self.name = f"Sim{prefix.upper()}{index}"
+        self.ip = f"10.{(index >> 16) & 255}.{(index >> 8) & 255}.{index & 255}"
+        self.power = 0
+        self.client = None
+        self.task = None
+        self.announced_at = None   # monotonic del último anuncio publicado
+        self.command_sent = None   # (acción, monotonic) del último comando HTTP
+        self.reboot_at = None      # monotonic en que volvió de un reinicio
+
+    @property
+    def topic(self):
+        return f"streelet/{self.group}"
+
+    def announcement(self):
+        return f"dc_{self.device_id}_1_{self.ip}_{self.group}_{self.name}"
+
+    def ack(self, state):
+        return f"ack_{self.device_id}_{state}"
+
+
+class FleetSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.loop = None
+        groups = [f"{args.group_prefix}{g}" for g in range(args.groups)]
+        self.devices = [VirtualDevice(i, groups[i % len(groups)], args.id_prefix) for i in range(args.devices)]
+        self.by_id = {d.device_id: d for d in self.devices}
+        self.clients = []
+        self.stopping = False
+        self.counters = {'announcements_sent': 0, 'announcements_delivered': 0, 'commands_sent': 0,
+                         'commands_received': 0, 'command_http_errors': 0, 'resets_received': 0,
+                         'acks_sent': 0, 'acks_dropped': 0,
+                         'reboots': 0, 'recovered_online': 0, 'disconnects': 0}
+        self.delivery = LatencyStats()          # publicación -> recepción en el observador
+        self.command_http = LatencyStats()      # duración del POST al manager
+        self.command_delivery = LatencyStats()  # inicio del POST -> llega al dispositivo
+        self.command_round_trip = LatencyStats()  # inicio del POST -> respuesta del dispositivo
+        self.recovery = LatencyStats()          # vuelve del reinicio -> el manager lo ve online
+        self.session = requests.Session()
+
+    # ----------------------------------------------------------
+    # Clientes MQTT
+
+    def _new_client(self, client_id, on_message):
+        client = mqtt.Client(client_id=client_id)
+        client.on_message = on_message
+        client.on_disconnect = lambda c, u, rc: self._count('disconnects') if rc != 0 else None
+        AsyncioHelper(self.loop, client)
+        return client
+
+    async def _connect(self, client, topics):
+        connected = asyncio.Event()
+
+        def on_connect(c, userdata, flags, rc):
+            if rc == 0:
+                for topic in topics:
+                    c.subscribe(topic)
+                connected.set()
+            else:
+                print(f"[SIM] Conexión rechazada por el broker (rc={rc})")
+
+        client.on_connect = on_connect
+        client.connect(MQTT_BROKER_HOST, MQTT_PORT, keepalive=60)
+        await asyncio.wait_for(connected.wait(), timeout=30)
+
+    async def connect_all(self):
+        """
+        Agrupa --devices-per-client dispositivos por conexión MQTT. Con 1 cada
+        ESP virtual tiene su propia conexión, como en la calle.
+        """
+        per_client = max(1, self.args.devices_per_client)
+        for start in range(0, len(self.devices), per_client):
+            devices = self.devices[start:start + per_client]
+            client = self._new_client(f"sim-{self.args.id_prefix}-{start // per_client}",
+                                      self._on_device_message)
+            for device in devices:
+                device.client = client
+            await self._connect(client, sorted({d.topic for d in devices}))
+            self.clients.append(client)
+
+        self.observer = self._new_client(f"sim-{self.args.id_prefix}-observer", self._on_observed)
+        await self._connect(self.observer, [ANNOUNCE_TOPIC])
+        self.clients.append(self.observer)
+        print(f"[SIM] {len(self.devices)} dispositivos en {len(self.clients) - 1} conexiones MQTT")
+
+    def _count(self, key, n=1):
+        self.counters[key] += n
+
+    # ----------------------------------------------------------
+    # Comportamiento de los dispositivos
+
+    def announce(self, device):
+        device.announced_at = time.monotonic()
+        device.client.publish(ANNOUNCE_TOPIC, device.announcement())
+        self._count('announcements_sent')
+
+    def send_ack(self, device, state):
+        if self.args.no_ack:
+            return
+        if random.random() < self.args.ack_loss:
+            self._count('acks_dropped')
+            return
+        device.client.publish(ANNOUNCE_TOPIC, device.ack(state))
+        self._count('acks_sent')
+
+    async def _device_loop(self, device, delay):
+        await asyncio.sleep(delay)
+        if device.reboot_at is not None:
+            device.reboot_at = time.monotonic()
+        while not self.stopping:
+            self.announce(device)
+            jitter = self.args.interval * self.args.jitter
+            await asyncio.sleep(self.args.interval + random.uniform(-jitter, jitter))
+
+    def schedule(self, device, delay, reboot=False):
+        """(Re)arranca el ciclo de anuncios del dispositivo después de `delay` segundos."""
+        if device.task is not None:
+            device.task.cancel()
+        if reboot:
+            device.reboot_at = -1.0
+            self._count('reboots')
+        device.task = self.loop.create_task(self._device_loop(device, delay))
+
+    def _on_device_message(self, client, userdata, msg):
+        payload = msg.payload.decode('utf-8', 'replace').strip()
+        now = time.monotonic()
+        group = msg.topic.split('/', 1)[-1]
+        if payload == 'reset':
+            for device in self.devices:
+                if device.client is client and device.group == group:
+                    self._count('resets_received')
+                    self.send_ack(device, 'reset')
+                    self.schedule(device, self.args.reset_reboot_s, reboot=True)
+            return
+        action, _, device_id = payload.partition('_')
+        device = self.by_id.get(device_id)
+        if action not in ('on', 'off') or device is None or device.client is not client:
+            return
+        self._count('commands_received')
+        device.power = 1 if action == 'on' else 0
+        if device.command_sent and device.command_sent[0] == action:
+            self.command_delivery.add((now - device.command_sent[1]) * 1000.0)
+        # El firmware confirma el comando y vuelve a anunciarse
+        self.send_ack(device, action)
+        self.announce(device)
+
+    def _on_observed(self, client, userdata, msg):
+        payload = msg.payload.decode('utf-8', 'replace')
+        parts = payload.split('_')
+        if len(parts) != 6 or parts[0] != 'dc':
+            return
+        device = self.by_id.get(parts[1])
+        if device is None or device.announced_at is None:
+            return
+        now = time.monotonic()
+        self._count('announcements_delivered')
+        self.delivery.add((now - device.announced_at) * 1000.0)
+        command = device.command_sent
+        if command is not None and device.power == (1 if command[0] == 'on' else 0):
+            self.command_round_trip.add((now - command[1]) * 1000.0)
+            device.command_sent = None
+
+    # ----------------------------------------------------------
+    # Escenarios
+
+    async def reboot_storm(self):
+        await asyncio.sleep(self.args.storm_at)
+        victims = random.sample(self.devices, int(len(self.devices) * self.args.storm_fraction))
+        print(f"[SIM] Tormenta: se caen {len(victims)} dispositivos durante {self.args.storm_down}s")
+        for device in victims:
+            device.task.cancel()
+            device.task = None
+        await asyncio.sleep(self.args.storm_down)
+        print(f"[SIM] Tormenta: vuelven {len(victims)} dispositivos en {self.args.storm_spread}s")
+        for device in victims:
+            self.schedule(device, random.uniform(0, self.args.storm_spread), reboot=True)
+
+    async def command_load(self):
+        """Envía --command-rate comandos por segundo al manager sobre dispositivos al azar."""
+        interval = 1.0 / self.args.command_rate
+        url = self.args.manager_url.rstrip('/')
+        while not self.stopping:
+            device = random.choice(self.devices)
+            action = 'off' if device.power else 'on'
+            device.command_sent = (action, time.monotonic())
+            self.loop.create_task(self._send_command(url, device, action))
+            await asyncio.sleep(interval)
+
+    async def _send_command(self, url, device, action):
+        started = time.monotonic()
+        self._count('commands_sent')
+        try:
+            response = await asyncio.to_thread(
+                self.session.post, f"{url}/devices/{device.device_id}/power/{action}",
+                timeout=10, allow_redirects=False)
+            if response.status_code != 200:
+                self._count('command_http_errors')
+        except requests.RequestException:
+            self._count('command_http_errors')
+        self.command_http.add((time.monotonic() - started) * 1000.0)
+
+    def watch_manager(self):
+        """Hilo que lee /devices/stream y mide la recuperación tras un reinicio."""
+        url = self.args.manager_url.rstrip('/') + '/devices/stream'
+        while not self.stopping:
+            try:
+                with self.session.get(url, stream=True, timeout=(5, 30), allow_redirects=False) as response:
+                    if response.status_code != 200:
+                        print(f"[SIM] /devices/stream respondió {response.status_code} (¿falta configurar el WiFi?)")
+                        return
+                    event = None
+                    for line in response.iter_lines(decode_unicode=True):
+                        if self.stopping:
+                            return
+                        if line.startswith('event: '):
+                            event = line[7:]
+                        elif line.startswith('data: ') and event == 'upsert':
+                            self.loop.call_soon_threadsafe(self._on_manager_upsert, json.loads(line[6:]),
+                                                           time.monotonic())
+            except requests.RequestException:
+                time.sleep(1)
+
+    def _on_manager_upsert(self, event, seen_at):
+        device = self.by_id.get(event['device']['id'])
+        if device is None or event['device']['status'] != 'online' or 'status' not in event['changes']:
+            return
+        if device.reboot_at is not None and device.reboot_at > 0:
+            self._count('recovered_online')
+            self.recovery.add((seen_at - device.reboot_at) * 1000.0)
+            device.reboot_at = None
+
+    # ----------------------------------------------------------
+
+    async def report_progress(self):
+        last = dict(self.counters)
+        while not self.stopping:
+            await asyncio.sleep(self.args.report_interval)
+            sent = self.counters['announcements_sent'] - last['announcements_sent']
+            delivered = self.counters['announcements_delivered'] - last['announcements_delivered']
+            last = dict(self.counters)
+            print(f"[SIM] anuncios/s enviados={sent / self.args.report_interval:.0f} "
+                  f"recibidos={delivered / self.args.report_interval:.0f} "
+                  f"comandos={self.counters['commands_received']}/{self.counters['commands_sent']} "
+                  f"p95_entrega_ms={self.delivery.summary().get('p95')}")
+
+    def manager_stats(self):
+        url = self.args.manager_url.rstrip('/')
+        stats = {}
+        for path in ('/ingest/stats', '/broker/stats'):
+            try:
+                response = self.session.get(url + path, timeout=5, allow_redirects=False)
+                if response.status_code == 200:
+                    stats[path] = response.json()
+            except requests.RequestException as e:
+                stats[path] = {'error': str(e)}
+        return stats
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        await self.connect_all()
+
+        if self.args.manager_url and self.args.register:
+            # Abrir la página de alta habilita el registro de dispositivos nuevos
+            await asyncio.to_thread(self.session.get, self.args.manager_url.rstrip('/') + '/add_device', timeout=10)
+
+        spread = 0 if self.args.scenario == 'connect-storm' else self.args.startup_spread
+        for device in self.devices:
+            self.schedule(device, random.uniform(0, spread))
+
+        tasks = [self.loop.create_task(self.report_progress())]
+        if self.args.scenario == 'reboot-storm':
+            tasks.append(self.loop.create_task(self.reboot_storm()))
+        if self.args.manager_url:
+            threading.Thread(target=self.watch_manager, name='sim-manager-stream', daemon=True).start()
+            if self.args.command_rate > 0:
+                tasks.append(self.loop.create_task(self.command_load()))
+
+        started = time.monotonic()
+        try:
+            await asyncio.sleep(self.args.duration)
+        finally:
+            self.stopping = True
+            for task in tasks:
+                task.cancel()
+            for device in self.devices:
+                if device.task is not None:
+                    device.task.cancel()
+            # Deja llegar los últimos mensajes en vuelo
+            await asyncio.sleep(1)
+            for client in self.clients:
+                client.disconnect()
+
+        report = {
+            'config': {k: v for k, v in vars(self.args).items() if k != 'json'},
+            'elapsed_s': round(time.monotonic() - started, 1),
+            'counters': dict(self.counters),
+            'announcement_delivery_ms': self.delivery.summary(),
+            'command_http_ms': self.command_http.summary(),
+            'command_delivery_ms': self.command_delivery.summary(),
+            'command_round_trip_ms': self.command_round_trip.summary(),
+            'recovery_online_ms': self.recovery.summary(),
+        }
+        if self.args.manager_url:
+            report['manager'] = await asyncio.to_thread(self.manager_stats)
+        return report
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Simulador de flota de ESP para IOT Devices Web Manager")
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--groups', type=int, default=10)
+    parser.add_argument('--devices-per-client', type=int, default=50,
+                        help="dispositivos por conexión MQTT (1 = una conexión por ESP)")
+    parser.add_argument('--id-prefix', default='s', help="prefijo de los device_id simulados (sin '_')")
+    parser.add_argument('--group-prefix', default='simg')
+    parser.add_argument('--interval', type=float, default=10, help="segundos entre anuncios de cada dispositivo")
+    parser.add_argument('--jitter', type=float, default=0.1, help="fracción de jitter sobre --interval")
+    parser.add_argument('--startup-spread', type=float, default=10,
+                        help="segundos en que se reparten los primeros anuncios")
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--scenario', choices=['steady', 'reboot-storm', 'connect-storm'], default='steady')
+    parser.add_argument('--storm-at', type=float, default=20)
+    parser.add_argument('--storm-fraction', type=float, default=1.0)
+    parser.add_argument('--storm-down', type=float, default=30,
+                        help="segundos sin anunciarse (mayor que HEARTBEAT_TIMEOUT para que pasen a offline)")
+    parser.add_argument('--storm-spread', type=float, default=2, help="segundos en que vuelven todos")
+    parser.add_argument('--reset-reboot-s', type=float, default=3)
+    parser.add_argument('--no-ack', action='store_true', help="no confirmar comandos (firmware antiguo)")
+    parser.add_argument('--ack-loss', type=float, default=0, help="fracción de confirmaciones que se pierden")
+    parser.add_argument('--manager-url', help="p. ej. http://localhost:5000")
+    parser.add_argument('--register', action='store_true', help="abrir /add_device para que se registren")
+    parser.add_argument('--command-rate', type=float, default=0, help="comandos HTTP por segundo")
+    parser.add_argument('--report-interval', type=float, default=5)
+    parser.add_argument('--json', help="archivo donde guardar el reporte final")
+    args = parser.parse_args()
+    if '_' in args.id_prefix or '_' in args.group_prefix:
+        parser.error("los prefijos no pueden contener '_' (separador del anuncio)")
+    return args
+
+
+def main():
+    args = parse_args()
+    use_selector_event_loop()
+    report = asyncio.run(FleetSimulator(args).run())
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
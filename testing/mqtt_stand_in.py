@@ -0,0 +1,181 @@
+"""
+Broker MQTT 3.1.1 mínimo en memoria para pruebas y benchmarks locales.
+
+Solo implementa lo que usan el manager, el simulador y paho: CONNECT,
+PUBLISH (QoS 0/1/2 de entrada, se reenvía siempre con QoS 0), SUBSCRIBE y
+UNSUBSCRIBE con comodines + y #, PINGREQ y DISCONNECT. No hay sesiones
+persistentes, retained ni autenticación. No reemplaza a mosquitto en la
+calle; sirve para que las mediciones no dependan de un broker externo.
+
+    python testing/mqtt_stand_in.py --port 1883
+"""
+import argparse
+import asyncio
+import struct
+import threading
+
+
+def topic_matches(topic_filter, topic):
+    filter_parts = topic_filter.split('/')
+    topic_parts = topic.split('/')
+    for i, part in enumerate(filter_parts):
+        if part == '#':
+            return True
+        if i >= len(topic_parts) or (part != '+' and part != topic_parts[i]):
+            return False
+    return len(filter_parts) == len(topic_parts)
+
+
+def _encode_length(length):
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(encoded)
+
+
+def _encode_string(value):
+    data = value.encode('utf-8')
+    return struct.pack('!H', len(data)) + data
+
+
+class MqttStandIn:
+    """
+    Broker en un hilo propio con su event loop. start() retorna el puerto
+    (con port=0 se elige uno libre); stop() cierra todas las conexiones.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.published = 0
+        self._subscriptions = {}   # writer -> set de filtros
+        self._loop = None
+        self._server = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='mqtt-stand-in', daemon=True)
+        self._thread.start()
+        self._ready.wait(10)
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(5)
+
+    async def _shutdown(self):
+        self._server.close()
+        for writer in list(self._subscriptions):
+            writer.close()
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._server = self._loop.run_until_complete(
+            asyncio.start_server(self._handle, self.host, self.port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            self._loop.run_forever()
+        finally:
+            self._loop.close()
+
+    async def serve_forever(self):
+        """Para correrlo como proceso independiente en el event loop actual."""
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            if not byte & 0x80:
+                break
+            multiplier *= 128
+        body = await reader.readexactly(length) if length else b''
+        return header[0], body
+
+    def _forward(self, topic, payload):
+        packet = None
+        for writer, filters in self._subscriptions.items():
+            if any(topic_matches(f, topic) for f in filters):
+                if packet is None:
+                    body = _encode_string(topic) + payload
+                    packet = b'\x30' + _encode_length(len(body)) + body
+                writer.write(packet)
+
+    async def _handle(self, reader, writer):
+        self._subscriptions[writer] = set()
+        try:
+            while True:
+                first, body = await self._read_packet(reader)
+                packet_type = first >> 4
+                if packet_type == 1:      # CONNECT
+                    writer.write(b'\x20\x02\x00\x00')
+                elif packet_type == 3:    # PUBLISH
+                    qos = (first >> 1) & 3
+                    topic_len = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + topic_len].decode('utf-8')
+                    offset = 2 + topic_len
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+                    self.published += 1
+                    self._forward(topic, body[offset:])
+                elif packet_type == 6:    # PUBREL
+                    writer.write(b'\x70\x02' + body[:2])
+                elif packet_type == 8:    # SUBSCRIBE
+                    packet_id, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        filter_len = struct.unpack('!H', body[offset:offset + 2])[0]
+                        self._subscriptions[writer].add(body[offset + 2:offset + 2 + filter_len].decode('utf-8'))
+                        offset += 2 + filter_len + 1
+                        granted.append(0)
+                    writer.write(b'\x90' + _encode_length(2 + len(granted)) + packet_id + bytes(granted))
+                elif packet_type == 10:   # UNSUBSCRIBE
+                    packet_id, offset = body[:2], 2
+                    while offset < len(body):
+                        filter_len = struct.unpack('!H', body[offset:offset + 2])[0]
+                        self._subscriptions[writer].discard(body[offset + 2:offset + 2 + filter_len].decode('utf-8'))
+                        offset += 2 + filter_len
+                    writer.write(b'\xb0\x02' + packet_id)
+                elif packet_type == 12:   # PINGREQ
+                    writer.write(b'\xd0\x00')
+                elif packet_type == 14:   # DISCONNECT
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._subscriptions.pop(writer, None)
+            writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker MQTT mínimo para pruebas locales")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    broker = MqttStandIn(args.host, args.port)
+    print(f"Broker de prueba escuchando en {args.host}:{args.port}")
+    try:
+        asyncio.run(broker.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,22 @@
+"""
+Configuración común de las pruebas: los módulos de la app están en la raíz
+del repositorio y cada prueba que toca SQLite usa una base temporal.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database as dbm  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """devices.db temporal con el esquema creado; el pool se vacía antes y después."""
+    dbm.close_connections()
+    monkeypatch.setattr(dbm, 'DB_NAME', str(tmp_path / 'devices.db'))
+    dbm.init_db()
+    yield dbm
+    dbm.close_connections()
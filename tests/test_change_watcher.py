@@ -0,0 +1,31 @@
+import sqlite3
+import time
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_own_commits_do_not_trigger_a_reload(db):
+    calls = []
+    watcher = db.ChangeWatcher(lambda: calls.append(1), interval=0.02, key=db.DEVICES_VERSION_KEY).start()
+    try:
+        time.sleep(0.05)
+        db.add_device('a', 'a', 'streelet/norte')
+        db.update_devices_power_status(['a'], 1)
+        db.set_state('otra_clave', '1')
+        time.sleep(0.1)
+        assert calls == []
+
+        # Otro proceso escribe devices e incrementa la versión
+        conn = sqlite3.connect(db.DB_NAME)
+        with conn:
+            conn.execute("UPDATE app_state SET value = CAST(value AS INTEGER) + 1 WHERE key = ?",
+                         (db.DEVICES_VERSION_KEY,))
+        conn.close()
+        assert wait_for(lambda: calls == [1])
+    finally:
+        watcher.stop()
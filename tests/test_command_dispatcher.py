@@ -0,0 +1,158 @@
+import threading
+import time
+import types
+
+import paho.mqtt.client as mqtt
+import pytest
+
+import broker_actions as bk
+import command_dispatcher as cmd
+
+
+class FakeClient:
+    def __init__(self, connected=True, rc=mqtt.MQTT_ERR_SUCCESS):
+        self.connected = connected
+        self.rc = rc
+        self.published = []
+        self._lock = threading.Lock()
+
+    def is_connected(self):
+        return self.connected
+
+    def publish(self, topic, message):
+        with self._lock:
+            self.published.append((topic, message))
+        return types.SimpleNamespace(rc=self.rc)
+
+
+@pytest.fixture
+def sent():
+    calls = []
+    yield calls
+    bk.command_buffer.drain()
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_commands_inside_the_window_are_coalesced(sent):
+    client = FakeClient()
+    dispatcher = cmd.CommandDispatcher(client, window_ms=100, on_sent=lambda ids, action: sent.append((ids, action)))
+    dispatcher.start()
+    try:
+        assert dispatcher.submit('a', 'streelet/norte', 'on') == cmd.SENT
+        assert dispatcher.submit('a', 'streelet/norte', 'off') == cmd.SCHEDULED
+        assert dispatcher.submit('a', 'streelet/norte', 'on') == cmd.COALESCED
+        assert dispatcher.submit('a', 'streelet/norte', 'off') == cmd.COALESCED
+        assert wait_for(lambda: len(client.published) == 2)
+    finally:
+        dispatcher.stop()
+
+    assert client.published == [('streelet/norte', 'on_a'), ('streelet/norte', 'off_a')]
+    assert sent == [(['a'], 'on'), (['a'], 'off')]
+    stats = dispatcher.stats()
+    assert stats['received'] == 4
+    assert stats['published'] == 2
+    assert stats['coalesced'] == 2
+
+
+def test_command_back_to_the_sent_state_is_dropped(sent):
+    client = FakeClient()
+    dispatcher = cmd.CommandDispatcher(client, window_ms=50, on_sent=lambda ids, action: sent.append((ids, action)))
+    dispatcher.start()
+    try:
+        dispatcher.submit('a', 'streelet/norte', 'on')
+        dispatcher.submit('a', 'streelet/norte', 'off')
+        dispatcher.submit('a', 'streelet/norte', 'on')
+        assert wait_for(lambda: dispatcher.stats()['open_windows'] == 0)
+    finally:
+        dispatcher.stop()
+
+    assert client.published == [('streelet/norte', 'on_a')]
+    assert dispatcher.stats()['unchanged'] == 1
+
+
+def test_windows_are_per_device(sent):
+    client = FakeClient()
+    dispatcher = cmd.CommandDispatcher(client, window_ms=1000)
+    assert dispatcher.submit('a', 'streelet/norte', 'on') == cmd.SENT
+    assert dispatcher.submit('b', 'streelet/norte', 'on') == cmd.SENT
+    assert dispatcher.submit('a', 'streelet/norte', 'reset') == cmd.SENT
+    assert len(client.published) == 3
+
+
+def test_stop_flushes_pending_commands(sent):
+    client = FakeClient()
+    dispatcher = cmd.CommandDispatcher(client, window_ms=60000).start()
+    dispatcher.submit('a', 'streelet/norte', 'on')
+    dispatcher.submit('a', 'streelet/norte', 'off')
+    dispatcher.stop()
+    assert client.published == [('streelet/norte', 'on_a'), ('streelet/norte', 'off_a')]
+
+
+def test_buffered_command_is_not_reported_as_sent(sent):
+    client = FakeClient(connected=False)
+    dispatcher = cmd.CommandDispatcher(client, window_ms=0, on_sent=lambda ids, action: sent.append((ids, action)))
+
+    assert dispatcher.submit('a', 'streelet/norte', 'on') == cmd.BUFFERED
+    assert sent == []
+    assert client.published == []
+    assert len(bk.command_buffer) == 1
+    assert dispatcher.stats()['buffered'] == 1
+
+
+def test_send_many_notifies_only_published_devices(sent):
+    client = FakeClient(connected=False)
+    dispatcher = cmd.CommandDispatcher(client, on_sent=lambda ids, action: sent.append((ids, action)))
+
+    results = dispatcher.send_many([('a', 'streelet/norte'), ('b', 'streelet/norte')], 'off')
+    assert [result['error'] for result in results] == ['buffered', 'buffered']
+    assert sent == []
+
+    client.connected = True
+    results = dispatcher.send_many([('a', 'streelet/norte'), ('b', 'streelet/norte')], 'on')
+    assert all(result['sent'] for result in results)
+    assert sent == [(['a', 'b'], 'on')]
+
+
+def test_rejected_publish_raises(sent):
+    client = FakeClient(rc=mqtt.MQTT_ERR_QUEUE_SIZE)
+    dispatcher = cmd.CommandDispatcher(client, window_ms=0, on_sent=lambda ids, action: sent.append((ids, action)))
+    with pytest.raises(RuntimeError):
+        dispatcher.submit('a', 'streelet/norte', 'on')
+    assert sent == []
+    assert dispatcher.stats()['errors'] == 1
+
+
+def test_failed_publish_does_not_mark_the_window_as_sent(sent):
+    client = FakeClient(rc=mqtt.MQTT_ERR_QUEUE_SIZE)
+    dispatcher = cmd.CommandDispatcher(client, window_ms=50).start()
+    try:
+        with pytest.raises(RuntimeError):
+            dispatcher.submit('a', 'streelet/norte', 'on')
+        client.rc = mqtt.MQTT_ERR_SUCCESS
+        # El reintento cae en la ventana abierta y sale al cerrarla
+        assert dispatcher.submit('a', 'streelet/norte', 'on') == cmd.SCHEDULED
+        assert wait_for(lambda: dispatcher.stats()['published'] == 1)
+    finally:
+        dispatcher.stop()
+
+    assert dispatcher.stats()['unchanged'] == 0
+
+
+def test_send_many_forgets_the_windows_it_could_not_publish(sent):
+    client = FakeClient(connected=False)
+    dispatcher = cmd.CommandDispatcher(client, window_ms=50).start()
+    try:
+        dispatcher.send_many([('a', 'streelet/norte')], 'off')
+        client.connected = True
+        assert dispatcher.submit('a', 'streelet/norte', 'off') == cmd.SCHEDULED
+        assert wait_for(lambda: dispatcher.stats()['published'] == 1)
+    finally:
+        dispatcher.stop()
+
+    assert client.published == [('streelet/norte', 'off_a')]
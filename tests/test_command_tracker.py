@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+import ingest
+from command_tracker import CommandTracker
+
+TOPIC = 'streelet/norte'
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+@pytest.fixture
+def published():
+    return []
+
+
+@pytest.fixture
+def tracker(db, published):
+    tracker = CommandTracker(None, dict, ack_timeout=0.1, max_retries=1, reconcile_s=0,
+                             publish=published.extend)
+    yield tracker
+    tracker.stop()
+
+
+def test_published_commands_are_tracked_until_acknowledged(tracker):
+    tracker.start()
+    # Comandos de cualquier worker, recibidos de vuelta por la suscripción
+    tracker.record_command(TOPIC, 'a', 'on')
+    tracker.record_command(TOPIC, 'b', 'on')
+    assert wait_for(lambda: tracker.stats()['sent'] == 2)
+    assert [p['device_id'] for p in tracker.pending()] == ['a', 'b']
+
+    tracker.record_ack('a', 'on')
+    tracker.record_ack('b', 'off')
+    assert wait_for(lambda: tracker.stats()['acked'] == 1)
+
+    assert tracker.power_state('a') == {'reported': 'on', 'pending': None, 'attempts': 0}
+    assert tracker.power_state('b')['reported'] == 'off'
+    assert tracker.power_state('b')['pending'] == 'on'
+    assert tracker.stats()['unsolicited_acks'] == 1
+
+
+def test_unacknowledged_commands_are_retried_then_dropped(tracker, published):
+    tracker.start()
+    tracker.record_command(TOPIC, 'a', 'off')
+    assert wait_for(lambda: tracker.stats()['retries'] == 1)
+    # El reintento vuelve por la suscripción y no reinicia los intentos
+    tracker.record_command(TOPIC, 'a', 'off')
+    assert wait_for(lambda: tracker.stats()['failed'] == 1)
+
+    assert published == [(TOPIC, 'off_a')]
+    assert tracker.stats()['sent'] == 1
+    assert tracker.pending() == []
+
+
+def test_reset_is_tracked_for_the_online_devices_of_the_topic(db, published):
+    desired = {'a': ('on', TOPIC), 'b': ('off', TOPIC), 'c': ('on', 'streelet/sur')}
+    tracker = CommandTracker(None, lambda: desired, ack_timeout=60, reconcile_s=0, publish=published.extend).start()
+    try:
+        tracker.record_command(TOPIC, None, 'reset')
+        assert wait_for(lambda: tracker.stats()['sent'] == 2)
+        assert sorted(p['device_id'] for p in tracker.pending()) == ['a', 'b']
+    finally:
+        tracker.stop()
+
+
+def test_reconciliation_resends_the_desired_state(db, published):
+    tracker = CommandTracker(None, lambda: {'a': ('off', TOPIC), 'b': ('on', TOPIC)},
+                             ack_timeout=60, reconcile_s=0.05, publish=published.extend).start()
+    try:
+        tracker.record_ack('a', 'on')
+        tracker.record_ack('b', 'on')
+        assert wait_for(lambda: tracker.stats()['reconciled'] == 1)
+    finally:
+        tracker.stop()
+
+    assert published == [(TOPIC, 'off_a')]
+
+
+def test_offline_devices_forget_their_state(tracker):
+    tracker.start()
+    tracker.record_command(TOPIC, 'a', 'on')
+    tracker.record_ack('b', 'on')
+    assert wait_for(lambda: tracker.stats()['reported'] == 1 and tracker.stats()['pending'] == 1)
+    tracker.forget_reported(['a', 'b'])
+    assert tracker.stats()['pending'] == 0
+    assert tracker.power_state('b')['reported'] is None
+
+
+def test_other_processes_read_the_shared_copy(db, published):
+    owner = CommandTracker(None, dict, ack_timeout=60, reconcile_s=0, publish=published.extend,
+                           share=True, share_s=0.01).start()
+    reader = CommandTracker(None, dict, share_s=0)
+    try:
+        owner.record_command(TOPIC, 'a', 'on')
+        owner.record_command(TOPIC, 'b', 'off')
+        owner.record_ack('b', 'off')
+        assert wait_for(lambda: reader.stats()['acked'] == 1)
+    finally:
+        owner.stop()
+
+    assert reader.stats()['running'] is False
+    assert [p['device_id'] for p in reader.pending()] == ['a']
+    assert reader.power_state('a') == {'reported': None, 'pending': 'on', 'attempts': 1}
+    assert reader.power_state('b') == {'reported': 'off', 'pending': None, 'attempts': 0}
+
+
+def test_router_passes_published_commands_to_the_tracker():
+    commands = []
+    router = ingest.build_router(None, on_command=lambda *command: commands.append(command))
+    router.start()
+    try:
+        for payload in (b'on_a', b'off_b', b'reset', b'on_'):
+            router.dispatch(TOPIC, payload)
+    finally:
+        router.stop()
+
+    assert commands == [(TOPIC, 'a', 'on'), (TOPIC, 'b', 'off'), (TOPIC, None, 'reset')]
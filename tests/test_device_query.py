@@ -0,0 +1,18 @@
+from device_registry import DeviceRegistry
+
+
+def add(registry, device_id, **fields):
+    registry.upsert(device_id, name=device_id, topic='streelet/norte', **fields)
+
+
+def test_query_pages_by_cursor():
+    registry = DeviceRegistry()
+    for device_id in ('c', 'a', 'e', 'b', 'd'):
+        add(registry, device_id, status='online' if device_id in 'ace' else 'offline')
+
+    page, cursor = registry.query(limit=2)
+    assert [device['id'] for device in page] == ['a', 'b']
+    assert cursor == 'b'
+    page, cursor = registry.query(status='online', limit=2, after=cursor)
+    assert [device['id'] for device in page] == ['c', 'e']
+    assert cursor is None
@@ -0,0 +1,81 @@
+import device_registry
+from device_registry import DeviceRegistry
+
+
+def add(registry, device_id, **fields):
+    registry.upsert(device_id, name=device_id, topic='streelet/norte', **fields)
+
+
+def test_changes_since_returns_only_later_changes():
+    registry = DeviceRegistry()
+    add(registry, 'a')
+    add(registry, 'b')
+    since = registry.version
+    registry.upsert('a', status='online')
+
+    version, full, devices, deleted = registry.changes_since(since)
+    assert not full
+    assert version > since
+    assert [device['id'] for device in devices] == ['a']
+    assert deleted == []
+
+
+def test_last_seen_alone_does_not_bump_the_version():
+    registry = DeviceRegistry()
+    add(registry, 'a')
+    since = registry.version
+    registry.upsert('a', last_seen=123)
+
+    assert registry.version == since
+    assert registry.changes_since(since)[2] == []
+    assert registry.get('a')['last_seen'] == 123
+
+
+def test_removed_devices_are_reported_as_tombstones():
+    registry = DeviceRegistry()
+    add(registry, 'a')
+    add(registry, 'b')
+    since = registry.version
+    assert registry.remove('a')
+    assert not registry.remove('a')
+
+    _, full, devices, deleted = registry.changes_since(since)
+    assert not full
+    assert devices == []
+    assert deleted == ['a']
+
+
+def test_readding_a_device_clears_its_tombstone():
+    registry = DeviceRegistry()
+    add(registry, 'a')
+    since = registry.version
+    registry.remove('a')
+    add(registry, 'a')
+
+    _, _, devices, deleted = registry.changes_since(since)
+    assert [device['id'] for device in devices] == ['a']
+    assert deleted == []
+
+
+def test_forgotten_tombstones_force_a_full_list(monkeypatch):
+    monkeypatch.setattr(device_registry, 'MAX_TOMBSTONES', 2)
+    registry = DeviceRegistry()
+    for device_id in 'abcd':
+        add(registry, device_id)
+    since = registry.version
+    for device_id in 'abc':
+        registry.remove(device_id)
+
+    # La baja de "a" ya no se recuerda: desde `since` no se puede armar un delta
+    version, full, devices, deleted = registry.changes_since(since)
+    assert full
+    assert [device['id'] for device in devices] == ['d']
+    assert deleted == []
+    # Desde la versión actual sí
+    assert registry.changes_since(version)[1] is False
+
+
+def test_future_version_returns_full_list():
+    registry = DeviceRegistry()
+    add(registry, 'a')
+    assert registry.changes_since(registry.version + 1)[1] is True
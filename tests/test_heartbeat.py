@@ -0,0 +1,30 @@
+import heartbeat
+
+
+def test_earlier_deadline_is_scheduled():
+    monitor = heartbeat.HeartbeatMonitor(default_timeout=100, group_timeouts={'rapido': 10})
+    monitor.touch('a', seen_at=1000)
+    # Pasa a un grupo con timeout menor: vence en 1010, no en 1100
+    monitor.touch('a', group='rapido', seen_at=1000)
+    assert monitor._pop_expired(1010) == ['a']
+    # La entrada de 1100 quedó descartada
+    assert monitor._pop_expired(1100) == []
+
+
+def test_later_announcement_reschedules():
+    monitor = heartbeat.HeartbeatMonitor(default_timeout=10)
+    monitor.touch('a', seen_at=1000)
+    monitor.touch('a', seen_at=1005)
+    assert monitor._pop_expired(1010) == []
+    assert monitor._pop_expired(1015) == ['a']
+
+
+def test_forgotten_device_does_not_expire_after_being_touched_again():
+    monitor = heartbeat.HeartbeatMonitor(default_timeout=10)
+    monitor.touch('a', seen_at=1000)
+    monitor.forget('a')
+    monitor.touch('a', seen_at=1050)
+    assert monitor._pop_expired(1010) == []
+    assert monitor._pop_expired(1060) == ['a']
+    assert monitor.stats()['tracked'] == 0
+    assert monitor._heap == []
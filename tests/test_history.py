@@ -0,0 +1,93 @@
+import sqlite3
+import time
+
+import pytest
+
+import history
+import ingest
+
+# Un lunes a las 10:00 UTC, lejos de cualquier cambio de mes
+T0 = 1767607200
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = history.HistoryStore(str(tmp_path / 'history.db'))
+    store.init()
+    return store
+
+
+def announce(recorder, device_id, ts, ip='10.0.0.1'):
+    recorder.record_announcements([ingest.Announcement(device_id, ip, 'norte', device_id, 'streelet/norte', ts)],
+                                  {'updated': [device_id], 'inserted': []})
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_outage_is_recorded_with_uptime_rollups(store):
+    recorder = history.HistoryRecorder(store, flush_ms=10).start()
+    announce(recorder, 'a', T0)
+    announce(recorder, 'a', T0 + 1800)
+    recorder.record_offline(['a'], T0 + 1900)
+    recorder.stop()
+
+    key = store.device_key('a')
+    events = store.events(key, T0, T0 + history.DAY)
+    assert [(e['ts'], e['status']) for e in events] == [(T0, 'online'), (T0 + 1800, 'offline')]
+    assert store.uptime(key, T0, T0 + history.HOUR, history.HOUR) == {T0: (1800, 1)}
+
+
+def test_failed_flush_is_retried_with_its_device_keys(store, monkeypatch):
+    write_batch = store.write_batch
+    calls = []
+
+    def fail_once(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            # Falla después de crear la partición, dentro de la transacción
+            conn = store.connection()
+            with conn:
+                store.ensure_partition(conn, 'events', T0, set())
+                raise sqlite3.OperationalError('database is locked')
+        return write_batch(*args)
+
+    monkeypatch.setattr(store, 'write_batch', fail_once)
+    recorder = history.HistoryRecorder(store, flush_ms=10).start()
+    announce(recorder, 'a', T0)
+    assert wait_for(lambda: recorder.stats()['batches'] == 1)
+    recorder.stop()
+
+    stats = recorder.stats()
+    assert stats['flush_errors'] == 1
+    assert len(calls) == 2
+    # El segundo intento lleva la clave nueva del primero
+    assert calls[1][0] == [(1, 'a')]
+    assert store.device_key('a') == 1
+    assert store.events(1, T0, T0 + history.DAY) == [{'ts': T0, 'status': 'online', 'ip': '10.0.0.1'}]
+
+
+def test_partition_is_not_cached_after_rollback(store):
+    conn = store.connection()
+    with pytest.raises(sqlite3.OperationalError):
+        created = set()
+        with conn:
+            store.ensure_partition(conn, 'events', T0, created)
+            raise sqlite3.OperationalError('database is locked')
+    assert created == {history.partition_name('events', T0)}
+
+    # La tabla no existe, así que write_batch debe volver a crearla
+    store.write_batch([(1, 'a')], [(1, T0, history.ONLINE, '10.0.0.1')], {}, [])
+    assert store.events(1, T0, T0 + 1) == [{'ts': T0, 'status': 'online', 'ip': '10.0.0.1'}]
+
+
+def test_retention_drops_whole_partitions(store):
+    old = T0 - 400 * history.DAY
+    store.write_batch([(1, 'a')], [(1, old, history.ONLINE, None), (1, T0, history.ONLINE, None)], {}, [])
+    dropped = store.apply_retention(now=T0)
+    assert dropped == [history.partition_name('events', old)]
+    assert store.events(1, old, T0 + 1) == [{'ts': T0, 'status': 'online', 'ip': None}]
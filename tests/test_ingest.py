@@ -0,0 +1,73 @@
+import ingest
+
+
+def announcement(device_id, ip, group='norte', received_at=1000):
+    return ingest.Announcement(device_id, ip, group, f"lampara-{device_id}", f"streelet/{group}", received_at)
+
+
+def test_parse_announcement():
+    parsed = ingest.parse_announcement("dc_959f5e_1_192.168.1.20_norte_esquina")
+    assert parsed.device_id == '959f5e'
+    assert parsed.ip == '192.168.1.20'
+    assert parsed.topic == 'streelet/norte'
+    assert parsed.name == 'esquina'
+    assert ingest.parse_announcement("dc_959f5e_1_192.168.1.20_norte") is None
+    assert ingest.parse_announcement("dc_959f5e_1__norte_esquina") is None
+
+
+def test_queue_keeps_latest_announcement_per_device(db):
+    db.add_device('a', 'a', 'streelet/norte')
+    db.add_device('b', 'b', 'streelet/norte')
+    flushed = []
+    queue = ingest.IngestQueue(batch_size=100, flush_ms=60000,
+                               on_flush=lambda announcements, result: flushed.append((announcements, result)))
+    queue.start()
+    for i in range(3):
+        assert queue.put(announcement('a', f"10.0.0.{i}", received_at=1000 + i))
+    queue.put(announcement('b', '10.0.0.9'))
+    queue.stop()
+
+    assert len(flushed) == 1
+    announcements, result = flushed[0]
+    assert {a.device_id: a.ip for a in announcements} == {'a': '10.0.0.2', 'b': '10.0.0.9'}
+    assert sorted(result['updated']) == ['a', 'b']
+    stats = queue.stats()
+    assert stats['received'] == 4
+    assert stats['coalesced'] == 2
+    assert stats['batches'] == 1
+    assert db.get_device_status('a')['ip'] == '10.0.0.2'
+
+
+def test_queue_flushes_when_batch_is_full(db):
+    flushed = []
+    queue = ingest.IngestQueue(allow_new=lambda: True, batch_size=2, flush_ms=60000,
+                               on_flush=lambda announcements, result: flushed.append(result))
+    queue.start()
+    queue.put(announcement('a', '10.0.0.1'))
+    queue.put(announcement('b', '10.0.0.2'))
+    queue.put(announcement('c', '10.0.0.3'))
+    queue.stop()
+
+    assert [sorted(result['inserted']) for result in flushed] == [['a', 'b'], ['c']]
+
+
+def test_unknown_devices_are_skipped_outside_the_add_window(db):
+    flushed = []
+    queue = ingest.IngestQueue(allow_new=lambda: False, on_flush=lambda a, result: flushed.append(result))
+    queue.start()
+    queue.put(announcement('nuevo', '10.0.0.1'))
+    queue.stop()
+
+    assert flushed[0]['skipped'] == ['nuevo']
+    assert db.get_device_status('nuevo') is None
+
+
+def test_mark_devices_offline_skips_devices_seen_after_the_cutoff(db):
+    db.add_device('a', 'a', 'streelet/norte')
+    db.add_device('b', 'b', 'streelet/norte')
+    db.upsert_devices([('a', 'a', 'streelet/norte', '10.0.0.1', 1000),
+                       ('b', 'b', 'streelet/norte', '10.0.0.2', 1100)])
+
+    assert db.mark_devices_offline(['a', 'b'], 1050) == ['a']
+    assert db.get_device_status('a')['status'] == 'offline'
+    assert db.get_device_status('b')['status'] == 'online'
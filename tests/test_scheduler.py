@@ -0,0 +1,113 @@
+import time
+
+import pytest
+
+import scheduler
+
+# Buenos Aires
+LOCATION = (-34.6, -58.4)
+
+
+def job(schedule, **fields):
+    return {'target_type': 'group', 'target': 'norte', 'action': 'on', 'schedule': schedule, **fields}
+
+
+def local(year, month, day, hour=0, minute=0):
+    return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+
+def test_parse_job_normalizes_daily_schedule():
+    parsed = scheduler.parse_job(job({'type': 'daily', 'at': '7:05', 'days': [4, 0, 0]}))
+    assert parsed['schedule'] == {'type': 'daily', 'at': '07:05', 'days': [0, 4]}
+    assert parsed['name'] == 'on group norte'
+    assert parsed['enabled'] is True
+
+
+@pytest.mark.parametrize('data, message', [
+    (job({'type': 'daily', 'at': '25:00'}), 'HH:MM'),
+    (job({'type': 'daily', 'at': '18:00', 'days': [7]}), 'days'),
+    (job({'type': 'weekly'}), 'schedule.type'),
+    (job({'type': 'once', 'at': 'mañana'}), 'epoch'),
+    (job({'type': 'once', 'at': 1, 'days': [0]}), 'Claves desconocidas'),
+    ({**job({'type': 'once', 'at': 1}), 'action': 'toggle'}, 'action'),
+    ({**job({'type': 'once', 'at': 1}), 'target_type': 'room'}, 'target_type'),
+])
+def test_parse_job_rejects_invalid_jobs(data, message):
+    with pytest.raises(ValueError, match=message):
+        scheduler.parse_job(data)
+
+
+def test_sun_schedules_need_a_location_and_known_keys(monkeypatch):
+    monkeypatch.setattr(scheduler, 'SCHEDULER_LATITUDE', None)
+    with pytest.raises(ValueError, match='SCHEDULER_LATITUDE'):
+        scheduler.parse_job(job({'type': 'sunset'}))
+
+    monkeypatch.setattr(scheduler, 'SCHEDULER_LATITUDE', str(LOCATION[0]))
+    monkeypatch.setattr(scheduler, 'SCHEDULER_LONGITUDE', str(LOCATION[1]))
+    with pytest.raises(ValueError, match='offset_minutes'):
+        scheduler.parse_job(job({'type': 'sunset', 'offset_minutes': -15}))
+    with pytest.raises(ValueError, match='offset'):
+        scheduler.parse_job(job({'type': 'sunset', 'offset': 900}))
+    assert scheduler.parse_job(job({'type': 'sunset', 'offset': -15}))['schedule'] == {'type': 'sunset', 'offset': -15}
+
+
+def test_daily_next_run():
+    # 2026-01-05 es lunes
+    monday = local(2026, 1, 5, 10)
+    assert scheduler.compute_next_run({'type': 'daily', 'at': '18:30'}, monday) == local(2026, 1, 5, 18, 30)
+    assert scheduler.compute_next_run({'type': 'daily', 'at': '08:00'}, monday) == local(2026, 1, 6, 8)
+    assert scheduler.compute_next_run({'type': 'daily', 'at': '08:00', 'days': [0]}, monday) == local(2026, 1, 12, 8)
+
+
+def test_once_next_run():
+    assert scheduler.compute_next_run({'type': 'once', 'at': 2000.0}, 1000.0) == 2000.0
+    assert scheduler.compute_next_run({'type': 'once', 'at': 2000.0}, 2000.0) is None
+
+
+def test_sunset_next_run_applies_the_offset():
+    after = local(2026, 1, 5, 10)
+    sunset = scheduler.compute_next_run({'type': 'sunset'}, after, location=LOCATION)
+    assert after < sunset < after + 86400
+    earlier = scheduler.compute_next_run({'type': 'sunset', 'offset': -15}, after, location=LOCATION)
+    assert earlier == sunset - 15 * 60
+    sunrise = scheduler.compute_next_run({'type': 'sunrise'}, sunset, location=LOCATION)
+    assert sunset < sunrise < sunset + 86400
+
+
+def test_sun_times_in_polar_night():
+    import datetime
+    assert scheduler.sun_times(datetime.date(2026, 12, 21), 80.0, 0.0) == (None, None)
+
+
+def test_catch_up_fires_the_latest_missed_job_and_records_its_run(db):
+    now = time.time()
+    daily = {'type': 'daily', 'at': '03:00'}
+    older = db.create_job('viejo', 'group', 'norte', 'off', daily, True, now - 7200)
+    latest = db.create_job('nuevo', 'group', 'norte', 'on', daily, True, now - 60)
+    fired = []
+    job_scheduler = scheduler.Scheduler(on_due=fired.extend).start()
+    job_scheduler.stop()
+
+    assert [job['id'] for job in fired] == [latest]
+    assert db.get_job(latest)['last_run'] == pytest.approx(now - 60)
+    assert db.get_job(older)['last_run'] is None
+    assert db.get_job(latest)['next_run'] > now
+
+
+def test_reload_keeps_due_jobs_for_the_scheduler_thread(db):
+    job_id = db.create_job('ahora', 'group', 'norte', 'on', {'type': 'once', 'at': time.time() + 60}, True,
+                           time.time() + 60)
+    fired = []
+    job_scheduler = scheduler.Scheduler(on_due=fired.extend).start()
+    try:
+        # Otro worker lo adelanta; el reload no debe reprogramarlo sin ejecutarlo
+        db.update_job(job_id, 'ahora', 'group', 'norte', 'on', {'type': 'once', 'at': time.time() - 1}, True,
+                      time.time() - 1)
+        job_scheduler.reload()
+        deadline = time.monotonic() + 2
+        while not fired and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        job_scheduler.stop()
+
+    assert [job['id'] for job in fired] == [job_id]